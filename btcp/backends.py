@@ -0,0 +1,421 @@
+"""Datagram backends under the lossy layer.
+
+The lossy layer only needs a way to get a datagram to the peer and to hear
+about datagrams from it. A backend provides that for one local address (IP
+and port, as in constants.py) and one remote address:
+
+    socket            the kernel socket, if the backend has one; the lossy
+                      layer then sizes its buffers and reads ancillary data
+    filenos()         file descriptors to wait on for input
+    idle()            called before the network thread waits: False if input
+                      is waiting already, so it should not
+    has_input(ready)  after the wait, given the descriptors that are ready:
+                      whether receive_into has a datagram
+    receive_into(buffer, size)
+                      (nbytes, address) of the next datagram, or None
+    name              what open_backend knows it as
+    send(segment)     number of bytes sent (all of them, even if the segment
+                      is lost on the way)
+    drops             segments send dropped because the peer had no room
+    close()
+
+UDPBackend is the default. For peers on the same host, UnixBackend uses
+AF_UNIX datagram sockets instead, which skip the IP stack, and
+SharedMemoryBackend passes segments through a ring buffer in shared memory,
+which costs no system call per segment at all: the receiver only needs
+waking up (with an eventfd) when it is about to sleep. open_backend picks
+one by name.
+
+Both peers have to use the same backend. The paths and names they use are
+derived from their addresses, so they find each other without further
+configuration.
+"""
+
+
+import array
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+from multiprocessing import resource_tracker, shared_memory
+
+from btcp.constants import SHM_RING_SIZE
+
+
+class UDPBackend:
+    """Plain UDP through the kernel's IP stack, the default, and the only
+    backend that reaches peers on other hosts."""
+    name = "udp"
+    # The kernel drops on the receiving end, see SocketStats.kernel_drops
+    drops = 0
+
+    def __init__(self, local, remote):
+        self._remote = remote
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(local)
+        self.receive_into = self.socket.recvfrom_into
+
+
+    def filenos(self):
+        return [self.socket.fileno()]
+
+
+    def idle(self):
+        return True
+
+
+    def has_input(self, ready):
+        return self.socket.fileno() in ready
+
+
+    def send(self, segment):
+        return self.socket.sendto(segment, self._remote)
+
+
+    def close(self):
+        self.socket.close()
+
+
+def socket_path(address, suffix):
+    """Path in the temporary directory for the bTCP endpoint at address."""
+    return os.path.join(tempfile.gettempdir(), "btcp-{}-{}.{}".format(address[0], address[1], suffix))
+
+
+def bind_unix(path):
+    """AF_UNIX datagram socket bound to path, replacing a stale one."""
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    unix_socket.bind(path)
+    return unix_socket
+
+
+class UnixBackend(UDPBackend):
+    """AF_UNIX datagram sockets, bound to socket_path(address, "sock").
+    Sends do not block: a datagram that finds no room in the peer's queue,
+    or that has no peer to go to, is lost, as with UDP. Blocking instead
+    would let two network threads that send to each other's full queue
+    wait on each other.
+
+    The queue holds net.unix.max_dgram_qlen datagrams, whatever their size,
+    and the default of 10 is far less than a window: raise it (sysctl) for
+    large windows, or expect the drops to be retransmitted.
+    """
+    name = "unix"
+
+    def __init__(self, local, remote):
+        self._remote = socket_path(remote, "sock")
+        self._path = socket_path(local, "sock")
+        self.socket = bind_unix(self._path)
+        self.socket.setblocking(False)
+        self.receive_into = self.socket.recvfrom_into
+        self.drops = 0
+
+
+    def send(self, segment):
+        try:
+            return self.socket.sendto(segment, self._remote)
+        except BlockingIOError:
+            self.drops += 1
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        return len(segment)
+
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
+# Ring header: head (written by the consumer), tail (by the producer), the
+# data capacity, whether the owner has closed it, whether the consumer sleeps
+RING_HEADER = struct.Struct("<QQQII")
+RING_DATA = 64
+RECORD = struct.Struct("<I")
+WRAP = 0xFFFFFFFF
+
+
+class Ring:
+    """Single producer, single consumer ring of datagrams in shared memory,
+    named after the address of its consumer. Each record is its length
+    followed by its data, padded to 4 bytes; a WRAP length (or too little
+    room for one) sends the reader back to the start.
+    """
+    def __init__(self, memory):
+        self.memory = memory
+        self.buffer = memory.buf
+        self.capacity = RING_HEADER.unpack_from(self.buffer)[2]
+
+
+    @classmethod
+    def create(cls, name, size):
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        memory = shared_memory.SharedMemory(name=name, create=True, size=RING_DATA + size)
+        RING_HEADER.pack_into(memory.buf, 0, 0, 0, size, 0, 0)
+        return cls(memory)
+
+
+    @classmethod
+    def attach(cls, name):
+        """The ring of another process, or None if there is none."""
+        try:
+            memory = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+        # It belongs to the other process: our resource tracker must not
+        # unlink it when we exit
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return cls(memory)
+
+
+    @property
+    def closed(self):
+        return struct.unpack_from("<I", self.buffer, 24)[0] != 0
+
+
+    @property
+    def sleeping(self):
+        return struct.unpack_from("<I", self.buffer, 28)[0] != 0
+
+
+    def set_closed(self):
+        struct.pack_into("<I", self.buffer, 24, 1)
+
+
+    def set_sleeping(self, sleeping):
+        struct.pack_into("<I", self.buffer, 28, sleeping)
+
+
+    def empty(self):
+        head, tail = struct.unpack_from("<QQ", self.buffer)
+        return head == tail
+
+
+    def put(self, data):
+        """Append a datagram. Returns False if it does not fit."""
+        head, tail = struct.unpack_from("<QQ", self.buffer)
+        need = RECORD.size + (len(data) + 3) // 4 * 4
+        position = tail % self.capacity
+        skip = self.capacity - position if self.capacity - position < need else 0
+        if tail + skip + need - head > self.capacity:
+            return False
+        if skip:
+            if skip >= RECORD.size:
+                RECORD.pack_into(self.buffer, RING_DATA + position, WRAP)
+            position = 0
+        start = RING_DATA + position
+        RECORD.pack_into(self.buffer, start, len(data))
+        self.buffer[start + RECORD.size:start + RECORD.size + len(data)] = data
+        # Publish the record only once it is complete
+        struct.pack_into("<Q", self.buffer, 8, tail + skip + need)
+        return True
+
+
+    def get_into(self, buffer, size):
+        """Copy the next datagram into buffer, truncated to size bytes.
+        Returns its length, or None if the ring is empty.
+        """
+        head, tail = struct.unpack_from("<QQ", self.buffer)
+        if head == tail:
+            return None
+        position = head % self.capacity
+        if self.capacity - position < RECORD.size or RECORD.unpack_from(self.buffer, RING_DATA + position)[0] == WRAP:
+            head += self.capacity - position
+            position = 0
+        start = RING_DATA + position
+        length = RECORD.unpack_from(self.buffer, start)[0]
+        n = min(length, size)
+        buffer[:n] = self.buffer[start + RECORD.size:start + RECORD.size + n]
+        struct.pack_into("<Q", self.buffer, 0, head + RECORD.size + (length + 3) // 4 * 4)
+        return n
+
+
+    def close(self, unlink=False):
+        self.buffer.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class SharedMemoryBackend:
+    """Segments pass through a Ring per direction, each owned by the
+    receiving end and named after its address. A sender only wakes the
+    receiver up when the receiver has said it is about to sleep, through an
+    eventfd of the receiver.
+
+    The eventfds are exchanged over AF_UNIX datagram sockets at
+    socket_path(address, "ctl"), with SCM_RIGHTS: a sender that has no
+    eventfd of its peer yet (or whose peer has restarted, which it sees on
+    the closed flag of the ring) sends a hello with its own instead, which
+    wakes the peer as well, and the peer answers with its own eventfd.
+
+    The producer writes the tail before it reads the sleeping flag, and the
+    consumer writes the flag before it reads the tail. Memory ordering
+    between processes is not guaranteed to keep these apart, so a wakeup can
+    in rare cases be missed; the network thread then still wakes up within
+    TIMER_TICK. Linux only (eventfd).
+    """
+    name = "shm"
+    HELLO = b'H'
+    REPLY = b'R'
+
+    def __init__(self, local, remote):
+        if not hasattr(os, "eventfd"):
+            raise OSError("The shared memory backend needs eventfd (Linux)")
+        self.socket = None
+        self._remote = remote
+        self._ring = Ring.create(self.ring_name(local), SHM_RING_SIZE)
+        self._eventfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self._control_path = socket_path(local, "ctl")
+        self._control = bind_unix(self._control_path)
+        self._control.setblocking(False)
+        self._peer_control_path = socket_path(remote, "ctl")
+
+        # The peer's ring and eventfd, once known. send may be called from
+        # either thread, the ring takes one producer at a time.
+        self._peer_ring = None
+        self._peer_eventfd = None
+        self._lock = threading.Lock()
+
+        # Segments dropped because the peer's ring was full
+        self.drops = 0
+
+
+    @staticmethod
+    def ring_name(address):
+        return "btcp-{}-{}".format(address[0], address[1])
+
+
+    def filenos(self):
+        return [self._eventfd, self._control.fileno()]
+
+
+    def idle(self):
+        if not self._ring.empty():
+            return False
+        self._ring.set_sleeping(1)
+        # A segment may have arrived before the producer could see the flag
+        if not self._ring.empty():
+            self._ring.set_sleeping(0)
+            return False
+        return True
+
+
+    def has_input(self, ready):
+        self._ring.set_sleeping(0)
+        if self._eventfd in ready:
+            try:
+                os.eventfd_read(self._eventfd)
+            except BlockingIOError:
+                pass
+        if self._control.fileno() in ready:
+            self._receive_control()
+        return not self._ring.empty()
+
+
+    def receive_into(self, buffer, size):
+        n = self._ring.get_into(buffer, size)
+        return None if n is None else (n, self._remote)
+
+
+    def _receive_control(self):
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(self._control, 16, 1)
+            except BlockingIOError:
+                return
+            with self._lock:
+                if not fds:
+                    continue
+                if self._peer_eventfd is not None:
+                    os.close(self._peer_eventfd)
+                self._peer_eventfd = fds[0]
+                if message == self.HELLO:
+                    # The peer (re)started: its ring may be a new one as well
+                    self._forget_peer_ring()
+                    self._send_control(self.REPLY)
+
+
+    def _send_control(self, message):
+        try:
+            self._control.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                               array.array("i", [self._eventfd]))],
+                                  0, self._peer_control_path)
+        except OSError:
+            # No peer (yet), or its queue is full: the next send tries again
+            pass
+
+
+    def _forget_peer_ring(self):
+        if self._peer_ring is not None:
+            self._peer_ring.close()
+            self._peer_ring = None
+
+
+    def send(self, segment):
+        with self._lock:
+            if self._peer_ring is not None and self._peer_ring.closed:
+                # The peer went away; whoever has its address now has a new ring
+                self._forget_peer_ring()
+                if self._peer_eventfd is not None:
+                    os.close(self._peer_eventfd)
+                    self._peer_eventfd = None
+            if self._peer_ring is None:
+                self._peer_ring = Ring.attach(self.ring_name(self._remote))
+                if self._peer_ring is None:
+                    # Nobody there: lost, like a UDP datagram to a closed port
+                    return len(segment)
+            if not self._peer_ring.put(segment):
+                self.drops += 1
+            elif self._peer_eventfd is None:
+                self._send_control(self.HELLO)
+            elif self._peer_ring.sleeping:
+                os.eventfd_write(self._peer_eventfd, 1)
+        return len(segment)
+
+
+    def close(self):
+        with self._lock:
+            self._ring.set_closed()
+            self._ring.close(unlink=True)
+            self._forget_peer_ring()
+            if self._peer_eventfd is not None:
+                os.close(self._peer_eventfd)
+                self._peer_eventfd = None
+        os.close(self._eventfd)
+        self._control.close()
+        try:
+            os.unlink(self._control_path)
+        except FileNotFoundError:
+            pass
+
+
+BACKENDS = {
+    "udp": UDPBackend,
+    "unix": UnixBackend,
+    "shm": SharedMemoryBackend,
+}
+
+
+def open_backend(name, local, remote):
+    """Backend name (see BACKENDS, None for UDP) between the local and
+    remote (IP, port) addresses.
+    """
+    try:
+        backend = BACKENDS[name or "udp"]
+    except KeyError:
+        raise ValueError("Unknown datagram backend {!r}, choose from {}".format(name, ", ".join(BACKENDS)))
+    return backend(local, remote)
@@ -1,5 +1,6 @@
 import struct
 from enum import Enum
+from btcp.constants import OPTION_END, SEQUENCE_SPACE
 
 
 class BTCPStates(Enum):
@@ -44,7 +45,10 @@ class BTCPSocket:
         if not buffer:
             return 0x0000
 
-        buffer += len(buffer) % 2 * b'\x00'
+        # Pad to an even length without touching the caller's buffer, which
+        # may be a memoryview into the lossy layer's receive buffer
+        if len(buffer) % 2:
+            buffer = bytes(buffer) + b'\x00'
 
         # Sum the entire run as 16-bit integers in network byte order.
         acc = sum(x for (x,) in struct.iter_unpack(R'!H', buffer))
@@ -59,6 +63,20 @@ class BTCPSocket:
         return acc if acc == 0xFFFF else (~acc & 0xFFFF)
 
 
+    @staticmethod
+    def seq_add(seqnum, count):
+        """Sequence number count places after seqnum, wrapping around."""
+        return (seqnum + count) % SEQUENCE_SPACE
+
+
+    @staticmethod
+    def seq_diff(a, b):
+        """How many places sequence number a is after b, wrapping around.
+        A result of SEQUENCE_SPACE // 2 or more means a is in fact before b.
+        """
+        return (a - b) % SEQUENCE_SPACE
+
+
     @staticmethod
     def build_segment_header(seqnum, acknum,
                              syn_set=False, ack_set=False, fin_set=False,
@@ -99,4 +117,104 @@ class BTCPSocket:
 
         sequence_number, acknowledgement_number, flags, window, data_length, checksum = struct.unpack('!HHBBHH', header)
 
-        return sequence_number, acknowledgement_number, flags, window, data_length, checksum
\ No newline at end of file
+        return sequence_number, acknowledgement_number, flags, window, data_length, checksum
+
+
+    @staticmethod
+    def build_segment(seqnum, acknum,
+                      syn_set=False, ack_set=False, fin_set=False,
+                      window=0x01, payload=b''):
+        """Build a complete segment: header, payload and a valid checksum."""
+        header = BTCPSocket.build_segment_header(
+                        seqnum, acknum,
+                        syn_set=syn_set, ack_set=ack_set, fin_set=fin_set,
+                        window=window, length=len(payload), checksum=0)
+        segment = bytearray(header)
+        segment += payload
+        checksum = BTCPSocket.in_cksum(bytes(segment))
+        segment[8:10] = struct.pack("!H", checksum)
+        return segment
+
+
+    @staticmethod
+    def set_ack(segment, acknum, window):
+        """Fill in the acknowledgement number and window of a segment (a
+        bytearray) that was built earlier, right before it is sent, so data
+        carries the latest acknowledgement of the other direction.
+
+        The checksum is updated for the changed header words only (RFC 1624)
+        rather than computed over the whole segment again. A checksum of 0
+        means the segment has none (see OPTION_DIGEST); it is left alone.
+        """
+        old_ack, old_flags_window = struct.unpack_from("!HH", segment, 2)
+        new_flags_window = (old_flags_window & 0xFF00) | window
+        struct.pack_into("!HH", segment, 2, acknum, new_flags_window)
+        BTCPSocket.adjust_checksum(segment, ((old_ack, acknum), (old_flags_window, new_flags_window)))
+
+
+    @staticmethod
+    def set_sequence_number(segment, seqnum):
+        """Fill in the sequence number of a segment (a bytearray) that was
+        prepared without one, e.g. by btcp/presegment.py, updating its
+        checksum as set_ack does.
+        """
+        old_seqnum = struct.unpack_from("!H", segment, 0)[0]
+        struct.pack_into("!H", segment, 0, seqnum)
+        BTCPSocket.adjust_checksum(segment, ((old_seqnum, seqnum),))
+
+
+    @staticmethod
+    def adjust_checksum(segment, changes):
+        """Update the checksum of segment for header words that changed,
+        given as (old, new) pairs (RFC 1624). A checksum of 0 is left alone.
+        """
+        checksum = struct.unpack_from("!H", segment, 8)[0]
+        if checksum == 0:
+            return
+        # HC' = ~(~HC + ~m + m') in one's complement arithmetic
+        acc = ~checksum & 0xFFFF
+        for old, new in changes:
+            acc += (~old & 0xFFFF) + new
+        while acc > 0xFFFF:
+            acc = (acc & 0xFFFF) + (acc >> 16)
+        # in_cksum never gives 0, which would read as no checksum at all
+        struct.pack_into("!H", segment, 8, (~acc & 0xFFFF) or 0xFFFF)
+
+
+    @staticmethod
+    def build_options(options):
+        """Encode a dict of {kind: value bytes} as handshake options, to be
+        sent as the payload of a SYN or SYNACK.
+        """
+        encoded = bytearray()
+        for kind, value in options.items():
+            encoded += struct.pack("!BB", kind, len(value)) + value
+        return bytes(encoded)
+
+
+    @staticmethod
+    def parse_options(payload):
+        """Decode handshake options into a dict of {kind: value bytes}.
+        Truncated options are ignored.
+        """
+        return BTCPSocket.split_options(payload)[0]
+
+
+    @staticmethod
+    def split_options(payload):
+        """Decode handshake options like parse_options, and also return the
+        data that follows OPTION_END (empty if there is none).
+        """
+        options = {}
+        i = 0
+        while i < len(payload):
+            if payload[i] == OPTION_END:
+                return options, payload[i + 1:]
+            if i + 2 > len(payload):
+                break
+            kind, length = struct.unpack("!BB", payload[i:i + 2])
+            if i + 2 + length > len(payload):
+                break
+            options[kind] = bytes(payload[i + 2:i + 2 + length])
+            i += 2 + length
+        return options, payload[len(payload):]
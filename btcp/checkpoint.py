@@ -0,0 +1,136 @@
+"""Checkpoints of transfers, so an interrupted one can be resumed.
+
+The server writes a transfer to its output file through a CheckpointedOutput.
+Every CHECKPOINT_INTERVAL bytes, and when the connection ends for whatever
+reason, it makes the data durable (flush and fsync) and then records the ID
+of the transfer and how many bytes of it the file holds in a checkpoint file
+next to the output. A checkpoint never claims more than is on disk: it is
+written to a temporary file, synced and renamed over the old one.
+
+When a client reconnects with the same transfer ID (see OPTION_RESUME), the
+server looks the checkpoint up, truncates the output to the recorded offset
+(the file may hold more, written after the last checkpoint) and appends from
+there. A transfer that completes removes its checkpoint.
+"""
+
+
+import os
+
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+CHECKPOINT_INTERVAL = 4 << 20
+
+
+class Checkpoint:
+    """ID and durable length of the transfer stored in output."""
+    def __init__(self, output, transfer_id, offset=0):
+        self.output = output
+        self.transfer_id = transfer_id
+        self.offset = offset
+
+
+    @property
+    def path(self):
+        return self.output + CHECKPOINT_SUFFIX
+
+
+    @classmethod
+    def load(cls, output):
+        """The checkpoint of output, or None if it has none (or an unreadable one)."""
+        try:
+            with open(output + CHECKPOINT_SUFFIX, encoding='utf-8') as f:
+                offset, transfer_id = f.read().rstrip("\n").split(" ", 1)
+            return cls(output, transfer_id, int(offset))
+        except (OSError, ValueError):
+            return None
+
+
+    def usable_offset(self):
+        """Offset to continue from: the recorded one, unless the output has
+        since lost data (0 if it is gone).
+        """
+        try:
+            return min(self.offset, os.path.getsize(self.output))
+        except OSError:
+            return 0
+
+
+    def save(self, offset):
+        """Record offset. The caller makes sure the output holds that much."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding='utf-8') as f:
+            f.write("{} {}\n".format(offset, self.transfer_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        # Make the rename itself durable
+        directory = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.offset = offset
+
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def find_checkpoints(directory):
+    """All checkpoints in directory, by transfer ID."""
+    checkpoints = {}
+    for entry in os.listdir(directory or "."):
+        if entry.endswith(CHECKPOINT_SUFFIX):
+            checkpoint = Checkpoint.load(os.path.join(directory, entry[:-len(CHECKPOINT_SUFFIX)]))
+            if checkpoint is not None:
+                checkpoints[checkpoint.transfer_id] = checkpoint
+    return checkpoints
+
+
+class CheckpointedOutput:
+    """Output file of a transfer that records its progress in checkpoint,
+    continuing at offset (see Checkpoint.usable_offset). Anything the file
+    holds beyond it is dropped.
+    """
+    def __init__(self, checkpoint, offset=0):
+        self.checkpoint = checkpoint
+        if offset > 0:
+            self._file = open(checkpoint.output, 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        else:
+            self._file = open(checkpoint.output, 'wb')
+        self.offset = offset
+        self._unsaved = 0
+        self.sync()
+
+
+    def write(self, data):
+        self._file.write(data)
+        self.offset += len(data)
+        self._unsaved += len(data)
+        if self._unsaved >= CHECKPOINT_INTERVAL:
+            self.sync()
+
+
+    def sync(self):
+        """Make everything written so far durable and record it."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.checkpoint.save(self.offset)
+        self._unsaved = 0
+
+
+    def close(self, complete):
+        """Close the file. A complete transfer needs no checkpoint anymore,
+        an incomplete one records how far it got.
+        """
+        if complete:
+            self._file.close()
+            self.checkpoint.remove()
+        else:
+            self.sync()
+            self._file.close()
@@ -1,10 +1,19 @@
 from btcp.btcp_socket import BTCPSocket, BTCPStates
 from btcp.lossy_layer import LossyLayer
+from btcp.compression import ChunkCompressor, CHUNK_SIZE
+from btcp.ring import SPSCRing
+from btcp.send_window import SendWindow
+from btcp.stream import ReceiveStream
+from btcp.pacing import TokenBucket, RateEstimator, burst_size
+from btcp.fec import FecEncoder
+from btcp.presegment import ParallelSegmenter, regular_file_size, MIN_FILE_SIZE
+from btcp.streams import StreamSender, STREAM_HEADER
 from btcp.constants import *
 
+import hashlib
 import io
-import time
-from queue import Queue
+import struct
+import threading
 
 class BTCPClientSocket(BTCPSocket):
     """bTCP client socket
@@ -30,27 +39,139 @@ class BTCPClientSocket(BTCPSocket):
     you probably want to use Queues, or a similar thread safe collection.
     """
 
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout, impairment=None, rx_impairment=None,
+                 compress_level=None, mss=PAYLOAD_SIZE, instrumentation=None,
+                 pacing_rate=None, digest=False, fec=None, network=None, workers=None,
+                 send_buffer_size=SEND_BUFFER_SIZE, backend=None):
         """Constructor for the bTCP client socket. Allocates local resources
         and starts an instance of the Lossy Layer.
 
+        impairment and rx_impairment are optional NetworkImpairments that
+        the lossy layer applies to outgoing and incoming segments.
+        instrumentation optionally measures the network thread, see
+        btcp/instrumentation.py.
+
+        compress_level is a zlib level (0-9) to offer stream compression to
+        the server during connect, or None to send uncompressed.
+
+        mss is the payload size per segment to ask for during connect, up to
+        MAX_PAYLOAD_SIZE. The server may lower it.
+
+        pacing_rate spreads new segments out in time instead of sending a
+        whole window at once: a rate in bytes per second, "auto" to follow
+        window / round trip time, or None not to pace.
+
+        digest offers the server to skip the checksum of every data segment
+        and check a digest of the whole stream at the end instead. Only for
+        paths that do not flip bits, e.g. loopback.
+
+        fec offers the server a parity segment per this many data segments,
+        from which it can rebuild a lost one without waiting for its
+        retransmission (see btcp/fec.py): a number, "auto" to follow the
+        loss rate, or None for no parity.
+
+        network replaces the lossy layer: it is called with the same
+        arguments as LossyLayer and must offer the same methods. The
+        simulator in btcp/simulation.py provides one that runs on a virtual
+        clock.
+
+        backend names the datagram transport of the lossy layer (see
+        btcp/backends.py): "udp" (None), or "unix" or "shm" when the server
+        runs on the same host and uses the same one.
+
+        workers is a number of processes that prepare the segments of large
+        files given to send, see btcp/presegment.py. None prepares them in
+        the application thread.
+
+        send_buffer_size bounds the bytes of segments that send builds ahead
+        of the window; send blocks while they do not fit.
+
         You can extend this method if you need additional attributes to be
         initialized, but do *not* call connect from here.
         """
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
 
-        # Global state of the program
+        # Global state of the program. Set before the lossy layer starts, a
+        # stray segment from an earlier connection may arrive right away.
+        self.state = BTCPStates.CLOSED
+
+        self._lossy_layer = (network or LossyLayer)(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT,
+                                                    impairment=impairment, rx_impairment=rx_impairment,
+                                                    instrumentation=instrumentation, backend=backend)
+
+        # Stream compression, offered in the SYN and used if the server agrees
+        self.compress_level = compress_level
+
+        # Payload size per segment: asked for in the SYN, set by the SYNACK
+        self.requested_mss = max(1, min(mss, MAX_PAYLOAD_SIZE))
+
+        # Transfer digest instead of segment checksums, offered in the SYN
+        self.offer_digest = digest
+
+        # Parity segments offered in the SYN, see btcp/fec.py
+        self.fec_group = fec
+
+        # Processes that prepare the segments of large files
+        self.workers = workers
+
+        # Bytes of segments send may build ahead of the window
+        self.send_buffer_size = send_buffer_size
+
+        # A LatencyHistogram (see btcp/instrumentation.py) that, if set,
+        # records the round trip times of the data segments
+        self.rtt_histogram = None
+
+        # Timers on the network thread, see start_timer
+        self.retransmit_timer = None
+        self.handshake_timer = None
+
+        # Retries of a FIN nobody answers before shutdown gives up
+        self.max_r = 5
+
+        # Send pacing, see btcp/pacing.py
+        self.pacing_rate = pacing_rate
+        self.pacing_timer = None
+
+        # How many segments of the server's data we take at a time, told to
+        # the server in the window field of our segments (one byte)
+        self.receive_window = max(1, min(window, 255))
+
+        # Set by the network thread once the connection is closed
+        self.closed = threading.Event()
+        self.handshake = threading.Event()
+
+        self.incoming = None
+        self.reset_connection()
+
+
+    def reset_connection(self, name=None, transfer_id=None, delta=False, streams=False):
+        """Forget everything about the previous connection, so the socket can
+        connect again. Only called while the socket is CLOSED.
+        """
         self.state = BTCPStates.CLOSED
 
-        # Mutex variable that is locked by the different parts of this program, and unlocked upon receiving a correct response
-        self.mutex = True
+        # Cleared while connecting, set by the network thread once the
+        # handshake got the response the application thread waits for
+        self.handshake.set()
 
-        # Sequence and acknoledgement numbers
+        # Sequence number of our data
         self.sequence_number = 0
-        self.ack_number = 0
         self.acked_until = 0
 
+        # Statistics of this connection: data segments sent for the first
+        # time, and sent again
+        self.segments_sent = 0
+        self.retransmissions = 0
+
+        # The server's stream: what it sends back, reassembled by the network
+        # thread and drained by recv (see btcp/stream.py). It holds our
+        # acknowledgement number. Once our FIN is answered, server_fin is where
+        # the server's stream ends.
+        if self.incoming is not None:
+            self.incoming.release_all()
+        self.incoming = ReceiveStream(4096)
+        self.server_fin = None
+
         # windowsize
         self.windowsize = 0
 
@@ -58,9 +179,62 @@ class BTCPClientSocket(BTCPSocket):
         self.previous_ack = 0
         self.same_ack_times = 0
 
-        # Send buffer
-        self.send_buffer = Queue()
-        self.unacked_list = []
+        # Recovery point: the end of the window when a loss was first
+        # resent, until the acknowledgements pass it (see handle_partial_ack)
+        self.recover = None
+
+        # Timeouts in a row of a FIN that is all that is left unacknowledged
+        self.fin_retries = 0
+
+        # Send buffer: segments built by the application thread, taken by the
+        # network thread in batches. The send window holds the segments in
+        # flight and is only used by the network thread; the window field of
+        # a header is one byte, so it never needs more than 256 slots.
+        self.send_buffer = SPSCRing(self.send_buffer_segments())
+        self.pending_segments = []
+        self.send_window = SendWindow(256)
+
+        # Pacing state of this connection, and the round trip time estimate.
+        # A fixed rate gets its bucket once the segment size is negotiated.
+        self.rtt = RateEstimator()
+        self.pacer = None
+
+        self.compressor = None
+        self.mss = PAYLOAD_SIZE
+
+        # Digest of the stream, if the server agreed to OPTION_DIGEST
+        self.digest = None
+
+        # Parity of our data segments, if the server agreed to OPTION_FEC
+        self.fec = None
+
+        # Name of the transfer, sent to the server in the SYN
+        self.transfer_name = name
+
+        # ID of the transfer to continue, and where the server continues it
+        self.transfer_id = transfer_id
+        self.resume_offset = 0
+
+        # Whether we offer to send a delta, and whether the server took it
+        self.offer_delta = delta
+        self.delta = False
+
+        # Whether we offer to send streams, and their state if the server
+        # agreed (see btcp/streams.py)
+        self.offer_streams = streams
+        self.streams = None
+
+        # Data carried in the SYN, and whether the server took it
+        self.fast_open_data = b''
+        self.fast_open_accepted = False
+
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self._lossy_layer.cancel_timer(self.handshake_timer)
+        self._lossy_layer.cancel_timer(self.pacing_timer)
+        self.retransmit_timer = None
+        self.handshake_timer = None
+        self.pacing_timer = None
+        self.closed.clear()
 
 
     ###########################################################################
@@ -77,12 +251,202 @@ class BTCPClientSocket(BTCPSocket):
 
 
     def sendAllSegements(self):
-        # while the unacked list is smaller than the window size and we still need to send packets
-        while( len(self.unacked_list) < self.windowsize and self.send_buffer.qsize()>0):
-            # get next packet and add it to list of unacknowledged packets
-            segment = self.send_buffer.get()
-            self._lossy_layer.send_segment(segment)
-            self.unacked_list.append(segment)  
+        # fill the window with packets we still need to send, taking them from the send buffer in one batch
+        room = min(self.windowsize - len(self.send_window), self.send_window.free())
+        if room > 0 and len(self.send_buffer) > 0:
+            now = self._lossy_layer.now()
+            if self.pacer is not None:
+                room = self.paced_room(room, now)
+            # get next packets and add them to the send window
+            segments = self.send_buffer.get_many(room)
+            self.segments_sent += len(segments)
+            for segment in segments:
+                self.transmit(segment)
+                self.send_window.append(segment, now)
+                if self.pacer is not None:
+                    self.pacer.consume(len(segment))
+                # Data segments go into the parity of their group, the FIN does not
+                if self.fec is not None and not segment[4] & 1 and len(segment) > HEADER_SIZE:
+                    self.send_parity(self.fec.add((segment[0] << 8) | segment[1], segment[HEADER_SIZE:]))
+            # Nothing behind these for now: protect them without waiting for more
+            if self.fec is not None and len(self.send_buffer) == 0:
+                self.send_parity(self.fec.flush())
+        else:
+            segments = ()
+
+        # the oldest unacknowledged segment needs a running retransmission timer
+        if len(self.send_window) > 0 and (self.retransmit_timer is None or not self.retransmit_timer.active):
+            self.start_retransmit_timer()
+        return len(segments)
+
+    def transmit(self, segment):
+        # Send one of our data segments, with the latest acknowledgement of
+        # the server's data piggybacked on it
+        super().set_ack(segment, self.incoming.ack_number, self.receive_window)
+        self._lossy_layer.send_segment(segment)
+
+    def send_parity(self, parity):
+        # Send a parity segment (see btcp/fec.py), if a group was completed
+        if parity is not None:
+            self._lossy_layer.send_segment(parity)
+            if self.pacer is not None:
+                self.pacer.consume(len(parity))
+
+    def send_ack(self):
+        # Acknowledge the server's data in a segment of its own
+        ACK = super().build_segment(
+                    self.sequence_number, self.incoming.ack_number,
+                    syn_set=False, ack_set=True, fin_set=False,
+                    window=self.receive_window, payload=b'')
+        self._lossy_layer.send_segment(ACK)
+
+    def paced_room(self, room, now):
+        # how many of room segments the token bucket lets us send now; if
+        # that is not all of them, come back once the balance they leave
+        # behind is paid back
+        segment_size = HEADER_SIZE + self.mss
+        self.pacer.refill(now)
+        allowed = self.pacer.allowed(segment_size, room)
+        if allowed < room and (self.pacing_timer is None or not self.pacing_timer.active):
+            wait = self.pacer.delay(segment_size * allowed)
+            self.pacing_timer = self._lossy_layer.start_timer(wait, self.sendAllSegements)
+        return allowed
+
+    def update_pacing_rate(self):
+        # automatic pacing: follow window / SRTT
+        rate = self.rtt.rate(self.windowsize * (HEADER_SIZE + self.mss))
+        if not rate:
+            return
+        if self.pacer is None:
+            self.pacer = TokenBucket(rate, burst_size(rate, HEADER_SIZE + self.mss))
+        else:
+            self.pacer.set_rate(rate, burst_size(rate, HEADER_SIZE + self.mss))
+
+    def start_timer(self, callback):
+        # start a timer that calls callback after the timeout, from the network thread
+        return self._lossy_layer.start_timer(self._timeout / 1000, callback)
+
+    def start_retransmit_timer(self):
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self.retransmit_timer = self.start_timer(self.retransmit_timeout)
+
+    def retransmit_timeout(self):
+        # Timeout, resend oldest package, if we have one
+        if (self.state in (BTCPStates.ESTABLISHED, BTCPStates.FIN_SENT) and len(self.send_window) > 0):
+            # Only the FIN is left: the server may be gone, so do not retry forever
+            if (self.state == BTCPStates.FIN_SENT and len(self.send_window) == 1):
+                self.fin_retries += 1
+                if (self.fin_retries > self.max_r):
+                    self.connection_closed()
+                    return
+            self.resend(self.send_window.base)
+            self.recover = self.send_window.end()
+            self.start_retransmit_timer()
+
+        elif (self.state == BTCPStates.FIN_SENT):
+            # Our FIN is acknowledged, but the server's stream has not ended
+            # yet, or its data is not all here: remind the server what we
+            # miss, and do not wait forever if it is gone
+            self.fin_retries += 1
+            if (self.fin_retries > self.max_r):
+                self.connection_closed()
+                return
+            self.send_ack()
+            self.start_retransmit_timer()
+
+    def resend(self, sequence_nr):
+        # send the segment with this sequence number again, it must be in flight
+        self.transmit(self.send_window.mark_resent(sequence_nr, self._lossy_layer.now()))
+        # The segments in flight may each still cause a duplicate
+        # acknowledgement of it. Only more duplicates than that mean that
+        # segments sent after this copy arrived without it: it is lost as well.
+        self.previous_ack = sequence_nr
+        self.same_ack_times = 3 - len(self.send_window)
+        self.retransmissions += 1
+        if self.fec is not None:
+            self.fec.resend()
+
+    def connection_closed(self):
+        # The FIN has been answered (or given up on): wake up shutdown and recv
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self._lossy_layer.cancel_timer(self.pacing_timer)
+        self.send_window.clear()
+        self.state = BTCPStates.CLOSED
+        self.incoming.ring.wake()
+        self.closed.set()
+
+    def build_syn(self):
+        # SYN segment, carrying the options we would like to use
+        options = {OPTION_MSS: struct.pack("!H", self.requested_mss)}
+        if self.compress_level is not None and not self.offer_streams:
+            options[OPTION_COMPRESSION] = bytes([self.compress_level])
+        if self.transfer_name:
+            options[OPTION_NAME] = self.transfer_name.encode('utf-8')[:255]
+        if self.offer_digest:
+            options[OPTION_DIGEST] = b''
+        if self.fec_group is not None:
+            options[OPTION_FEC] = bytes([0 if self.fec_group == "auto" else self.fec_group])
+        if self.transfer_id:
+            options[OPTION_RESUME] = self.transfer_id.encode('utf-8')[:255]
+        if self.offer_delta:
+            options[OPTION_DELTA] = b''
+        if self.offer_streams:
+            options[OPTION_STREAMS] = b''
+        payload = super().build_options(options)
+        if self.fast_open_data:
+            payload = super().build_options({OPTION_FASTOPEN: b''}) + payload
+            payload += bytes([OPTION_END]) + self.fast_open_data
+        return super().build_segment(
+                        self.sequence_number, self.incoming.ack_number,
+                        syn_set=True, ack_set=False, fin_set=False,
+                        window=self.receive_window, payload=payload)
+
+    def fast_open_room(self):
+        # How much data fits in the SYN next to the options, the server only
+        # receives segments of the default size before the handshake. Data
+        # on streams waits for the handshake: it needs to know their format.
+        if self.offer_streams:
+            return 0
+        saved = self.fast_open_data
+        self.fast_open_data = b''
+        used = len(self.build_syn()) - HEADER_SIZE
+        self.fast_open_data = saved
+        # OPTION_FASTOPEN and OPTION_END
+        return max(0, PAYLOAD_SIZE - used - 3)
+
+    def negotiate(self, options):
+        # Use the options the server echoed in its SYNACK
+        if OPTION_MSS in options:
+            self.mss = min(struct.unpack("!H", options[OPTION_MSS])[0], self.requested_mss)
+        else:
+            # A server without the option only handles the default size
+            self.mss = PAYLOAD_SIZE
+        self._lossy_layer.segment_size = HEADER_SIZE + self.mss
+        self._lossy_layer.size_buffers(max(self.windowsize, self._window), HEADER_SIZE + self.mss)
+        if OPTION_COMPRESSION in options and self.compress_level is not None:
+            self.compressor = ChunkCompressor(self.compress_level)
+        self.fast_open_accepted = bool(self.fast_open_data) and OPTION_FASTOPEN in options
+        if OPTION_DIGEST in options and self.offer_digest:
+            self.digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        if OPTION_RESUME in options and self.transfer_id and len(options[OPTION_RESUME]) == 8:
+            self.resume_offset = struct.unpack("!Q", options[OPTION_RESUME])[0]
+        self.delta = OPTION_DELTA in options and self.offer_delta
+        if OPTION_FEC in options and self.fec_group is not None:
+            self.fec = FecEncoder(self.fec_group)
+        if OPTION_STREAMS in options and self.offer_streams:
+            self.streams = StreamSender(digest=self.digest is not None)
+        if self.pacing_rate is not None and self.pacing_rate != "auto":
+            self.pacer = TokenBucket(self.pacing_rate, burst_size(self.pacing_rate, HEADER_SIZE + self.mss))
+
+    def handshake_timeout(self):
+        # Resend SYN until the server answers, the FIN is retransmitted like data
+        if (self.state == BTCPStates.SYN_SENT):
+            self._lossy_layer.send_segment(self.build_syn())
+
+        else:
+            return
+
+        self.handshake_timer = self.start_timer(self.handshake_timeout)
         
     def next_sequence_nr(self, sequence_nr):
         # get next sequence number we need
@@ -101,12 +465,31 @@ class BTCPClientSocket(BTCPSocket):
             self.previous_ack = acknowledgement_number
             self.same_ack_times = 1
 
-        # if we get the same acknowledgement number three times
-        if (self.same_ack_times == 3):
-            # reset first unacked packet
-            self._lossy_layer.send_segment(self.unacked_list[0])
-            # reset ack counter
-            self.same_ack_times = 0
+        # if we get the same acknowledgement number three times, resend the
+        # segment the server keeps asking for (see resend for how often).
+        # During recovery this also catches a hole the partial
+        # acknowledgement left to the timer.
+        if (self.same_ack_times == 3 and self.send_window.get(acknowledgement_number) is not None):
+            self.resend(acknowledgement_number)
+            if (self.recover is None):
+                self.recover = self.send_window.end()
+
+    def handle_partial_ack(self):
+        # During recovery, an acknowledgement that stops short of the
+        # recovery point means the new oldest segment is lost as well. Resend
+        # it now instead of waiting for the timer, unless it was resent
+        # already or was sent too recently to have been acknowledged.
+        if (self.recover is None):
+            return
+        if (not self.send_window.before(self.recover)):
+            # Everything up to the recovery point got through
+            self.recover = None
+            return
+        base = self.send_window.base
+        srtt = self.rtt.srtt or 0.0
+        if (self.send_window.retransmits(base) == 0
+                and self._lossy_layer.now() - self.send_window.sent_at(base) >= srtt / 2):
+            self.resend(base)
 
     def lossy_layer_segment_received(self, segment):           
         """Called by the lossy layer whenever a segment arrives.
@@ -129,38 +512,90 @@ class BTCPClientSocket(BTCPSocket):
         # Get the flags into a 3 character string
         flag_bits = "{0:3b}".format(flags)
 
+        # Ignore damaged segments: a flipped bit in an acknowledgement number
+        # would make us drop data the server never got. The server resends
+        # its SYNACK, and later ACKs repeat what this one said.
+        if (super().in_cksum(message) != 0xFFFF):
+            return
+
         # STATE MACHINE
 
         if (self.state == BTCPStates.SYN_SENT):
             # If ACK and SYN are set
             if (flag_bits[0] == "1" and flag_bits[1] == "1"):
                 # Unlock the thread
-                self.mutex = True
-                # Update ACK_client and adjust windowsize
-                self.ack_number = acknowledgement_number
+                self._lossy_layer.cancel_timer(self.handshake_timer)
+                # The server's stream starts at its sequence number; adjust windowsize
+                self.incoming.ack_number = sequence_number
+                self.send_window.clear(acknowledgement_number)
                 self.windowsize = window
+                self.negotiate(super().parse_options(message[10:10+data_length]))
+                self.handshake.set()
                 #Send segments after handshake is done
                 self.sendAllSegements()
 
-        elif (self.state == BTCPStates.ESTABLISHED):
+        elif (self.state in (BTCPStates.ESTABLISHED, BTCPStates.FIN_SENT)):
             # IF ACK is set
             if (flag_bits[1] == "1"):
-                # If we get a greater acknowledgement number
-                if (acknowledgement_number >= self.next_sequence_nr(self.ack_number)):
-                    # Remove those that can be removed and update ACK_client
-                    self.unacked_list = self.unacked_list[(acknowledgement_number - self.ack_number):]
-                    self.ack_number=acknowledgement_number
-
-                else:
-                    # Handle ack we previously got
+                # Round trip time sample from the newest segment this acknowledges,
+                # unless it was resent and we cannot tell which copy got through
+                newest = super().seq_add(acknowledgement_number, -1)
+                if (self.send_window.get(newest) is not None
+                        and self.send_window.retransmits(newest) == 0):
+                    rtt = self._lossy_layer.now() - self.send_window.sent_at(newest)
+                    self.rtt.sample(rtt)
+                    if self.pacing_rate == "auto":
+                        self.update_pacing_rate()
+                    if self.rtt_histogram is not None:
+                        self.rtt_histogram.record(rtt * 1e9)
+
+                # If the acknowledgement covers new segments, remove them
+                if (self.send_window.acknowledge(acknowledgement_number) > 0):
+                    self.fin_retries = 0
+
+                    # Progress, so restart the timer for the new oldest segment
+                    self.handle_partial_ack()
+                    if len(self.send_window) > 0:
+                        self.start_retransmit_timer()
+                    else:
+                        self._lossy_layer.cancel_timer(self.retransmit_timer)
+
+                elif (data_length == 0):
+                    # Handle ack we previously got. Only segments without data
+                    # count: the server's data repeats the same ack all along.
                     self.handle_triple_ack(acknowledgement_number)
 
-                self.sendAllSegements()
-
-        elif (self.state == BTCPStates.FIN_SENT):
-            # if message states that both FIN and ack, then we go to state BTCPStates.CLOSED and we send ACK.
-            if (flag_bits[1] == "1" and flag_bits[2] == "1"):
-                self.mutex = True
+                # FINACK: the server has everything up to and including our FIN,
+                # and its own stream ends at the FINACK's sequence number
+                if (self.state == BTCPStates.FIN_SENT and flag_bits[2] == "1"
+                        and acknowledgement_number == self.sequence_number):
+                    self.server_fin = sequence_number
+
+            # Data from the server (a resent SYNACK carries options, not data)
+            has_data = data_length > 0 and flag_bits[0] != "1"
+            if (has_data and self.incoming.receive(sequence_number, message[10:10+data_length], self._lossy_layer.keep_segment)):
+                self.fin_retries = 0
+
+            # Once we have all of the server's data, acknowledge the FINACK
+            # right away, so the server can stop lingering. Its FIN takes a
+            # sequence number, like ours.
+            if (self.server_fin is not None and self.incoming.ack_number == self.server_fin):
+                self.incoming.ack_number = super().seq_add(self.server_fin, 1)
+                self.send_ack()
+                self.connection_closed()
+                return
+
+            # Our FIN is acknowledged and the server is still there: wait for
+            # the rest of its stream, reminding it every timeout
+            if (self.state == BTCPStates.FIN_SENT and len(self.send_window) == 0):
+                self.fin_retries = 0
+                if (self.retransmit_timer is None or not self.retransmit_timer.active):
+                    self.start_retransmit_timer()
+
+            # Data of our own carries the acknowledgement of the server's; if
+            # there is none to send, it goes in a segment of its own
+            if (self.sendAllSegements() == 0 and has_data):
+                self.send_ack()
 
 
     def lossy_layer_tick(self):
@@ -186,32 +621,18 @@ class BTCPClientSocket(BTCPSocket):
         lossy_layer_tick. That kind of duplicated code would be a good
         candidate to put in a helper method which can be called from either
         lossy_layer_segment_received or lossy_layer_tick.
+
+        Retransmission of data, SYN and FIN segments is driven by timers on
+        the lossy layer instead (see start_timer), which fire on time even
+        while segments keep arriving.
         """
         
         # STATE MACHINE
-        if (self.state == BTCPStates.SYN_SENT):
-            SYN = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=True, ack_set=False, fin_set=False,
-                            window=0x01, length=0, checksum=0)
-
-            self._lossy_layer.send_segment(SYN)
-
-        elif (self.state == BTCPStates.FIN_SENT):
-            FIN = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=False, ack_set=False, fin_set=True,
-                            window=0x01, length=0, checksum=0)
-            self._lossy_layer.send_segment(FIN)
-
-        elif (self.state == BTCPStates.ESTABLISHED):
-            
-            # If timeout, resend oldest package, if we have one
-            if( len(self.unacked_list) > 0):
-                self._lossy_layer.send_segment(self.unacked_list[0])     
- 
-            elif ( self.send_buffer.qsize()> 0):
+        if (self.state in (BTCPStates.ESTABLISHED, BTCPStates.FIN_SENT)):
+            # Nothing in flight, but data waiting: get it going
+            if ( len(self.send_window) == 0 and len(self.send_buffer) > 0):
                 self.sendAllSegements()
+
     ###########################################################################
     ### You're also building the socket API for the applications to use.    ###
     ### The following section is the interface between the application      ###
@@ -229,50 +650,171 @@ class BTCPClientSocket(BTCPSocket):
     ### application thread and the network thread, remember to use a Queue  ###
     ### for its inherent thread safety.                                     ###
     ###                                                                     ###
-    ### Note that because this is the client socket, and our (initial)      ###
-    ### implementation of bTCP is one-way reliable data transfer, there is  ###
-    ### no recv() method available to the applications. You should still    ###
-    ### be able to receive segments on the lossy layer, however, because    ###
-    ### of acknowledgements and synchronization. You should implement that  ###
-    ### above.                                                              ###
+    ### Data flows both ways: recv() returns what the server sends back     ###
+    ### over the same connection, and our data carries the                  ###
+    ### acknowledgements of it.                                             ###
     ###########################################################################
 
-    def connect(self):
+    def send_buffer_segments(self):
+        # Slots of the send buffer: as many segments of the requested size
+        # (the negotiated one is never larger) as fit in send_buffer_size,
+        # down to a power of two, as the ring rounds up
+        segments = max(MIN_SEND_BUFFER_SEGMENTS, self.send_buffer_size // (HEADER_SIZE + self.requested_mss))
+        return 1 << (segments.bit_length() - 1)
+
+    def stream_blocks(self, data):
+        # Read the file and yield how many bytes of it were read together with
+        # the bytes that go on the wire, compressed if negotiated
+        blocksize = CHUNK_SIZE if self.compressor is not None else self.mss
+        while ( True ):
+            block = data.read(blocksize)
+
+            #Exit when we are at the end of the file
+            if len(block) == 0:
+                break
+
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+            if self.digest is not None:
+                self.digest.update(block)
+            size = len(block)
+            if self.compressor is not None:
+                block = self.compressor.compress(block)
+            yield size, block
+
+        if self.compressor is not None:
+            yield 0, self.compressor.flush()
+
+    def flush_segments(self):
+        # Hand the segments built so far to the network thread, in as few batches as fit
+        batch = self.pending_segments
+        self.pending_segments = []
+        while batch:
+            accepted = self.send_buffer.put_many(batch)
+            batch = batch[accepted:]
+            if accepted:
+                # Let the network thread start sending right away
+                self._lossy_layer.start_timer(0, self.sendAllSegements)
+            if batch:
+                self._lossy_layer.wait_until(lambda: self.send_buffer.free() > 0,
+                                             lambda: self.send_buffer.wait_for_space(0.1))
+
+    def queue_segment(self, message, fin_set=False):
+        # Turn at most mss bytes of payload into a segment for the send buffer,
+        # short segments are sent as they are, without padding. The FIN is the
+        # last segment of the stream and takes a sequence number like data.
+        message = bytes(message)
+
+        # Message length save
+        mlen = len(message)
+
+        # The acknowledgement number is filled in when the segment goes out
+        # (see transmit). Without a checksum it cannot be trusted, so with a
+        # transfer digest only the FIN has the ACK flag.
+        thisack = self.incoming.ack_number
+        ack_set = self.digest is None or fin_set
+
+        # Create segment
+        header = super().build_segment_header(
+                self.sequence_number, thisack,
+                syn_set=False, ack_set=ack_set, fin_set=fin_set,
+                window=self.receive_window, length=mlen, checksum=0)
+
+        segment = io.BytesIO()
+        segment.write(header)
+        segment.write(message)
+        segment = bytearray(segment.getvalue())
+
+        # With a transfer digest only the FIN (which carries it) is checksummed
+        if self.digest is None or fin_set:
+            checksum = super().in_cksum(segment)
+
+            header2 = super().build_segment_header(
+                    self.sequence_number, thisack,
+                    syn_set=False, ack_set=ack_set, fin_set=fin_set,
+                    window=self.receive_window, length=mlen, checksum=checksum)
+
+            segment[:10] = header2
+
+        self.queue_built(segment)
+
+    def queue_built(self, segment):
+        # Add a segment that carries the current sequence number to the next
+        # batch for the send buffer
+        self.pending_segments.append(segment)
+        if len(self.pending_segments) >= 64:
+            self.flush_segments()
+
+        # Increase sequence number
+        self.sequence_number = self.next_sequence_nr(self.sequence_number)
+
+    def connect(self, name=None, data=b'', transfer_id=None, delta=False, streams=False):
         """Perform the bTCP three-way handshake to establish a connection.
 
+        name optionally tells the server what is being sent, e.g. a file name
+        it can store the data under. A socket can connect again after
+        shutdown, to send several transfers in a row.
+
+        data optionally is the start of the stream (bytes). As much of it as
+        fits is sent in the SYN (fast open), so a small transfer is delivered
+        within the handshake. Whatever did not fit, or everything if the
+        server does not support fast open, is sent as if passed to send right
+        after connecting. Fast open data is never compressed.
+
+        transfer_id optionally asks the server to continue an earlier transfer
+        that was cut off (see OPTION_RESUME). After connect, resume_offset
+        is where the server continues: the stream starts there, so the
+        application skips that much of its input before calling send. Any
+        part of data before the offset is skipped here.
+
+        delta offers to send a delta against the server's copy of the
+        transfer instead of the data (see btcp/delta.py). If the delta
+        attribute says the server agreed, recv returns the signature of its
+        copy, and what is sent is a delta against that.
+
+        streams offers to send a number of independent streams instead of
+        one (see btcp/streams.py), e.g. a file each: a lost segment of one
+        then does not hold up the others at the server. If the streams
+        attribute says the server agreed, send takes the stream to send on.
+        Streams leave out compression and fast open (data goes on stream 0
+        after the handshake), and do not combine with transfer_id or delta.
+
         connect should *block* (i.e. not return) until the connection has been
         successfully established or the connection attempt is aborted. You will
         need some coordination between the application thread and the network
         thread for this, because the syn/ack from the server will be received
         in the network thread.
 
-        Hint: assigning to a boolean or enum attribute in thread A and reading
-        it in a loop in thread B (preferably with a short sleep to avoid
-        wasting a lot of CPU time) ensures that thread B will wait until the
-        boolean or enum has the expected value. We do not think you will need
-        more advanced thread synchronization in this project.
+        The network thread sets the handshake Event once the SYNACK arrives;
+        connect waits on it rather than polling, so that it does not hold the
+        GIL the network thread needs to handle that SYNACK.
         """
 
+        if streams and (transfer_id or delta):
+            raise ValueError("Streams cannot be combined with resume or delta")
+
+        # Start from a clean slate, the socket may have been used before
+        self.reset_connection(name, transfer_id, delta, streams)
+        data = bytes(data)
+        self.fast_open_data = data[:self.fast_open_room()]
+
         # Syn package is created
-        SYN = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=True, ack_set=False, fin_set=False,
-                            window=0x01, length=0, checksum=0)
+        SYN = self.build_syn()
 
-        # Update state, send package and lock the mutex
+        # Update state and send package, then wait for the handshake
+        self.handshake.clear()
         self.state = BTCPStates.SYN_SENT
         self._lossy_layer.send_segment(SYN)
-        self.mutex = False
+        self.handshake_timer = self.start_timer(self.handshake_timeout)
 
         # Wait for synack by server
-        while (self.mutex == False):
-            continue
+        self._lossy_layer.wait_until(self.handshake.is_set, self.handshake.wait)
 
         # Ack package is created
-        ACK = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
+        ACK = super().build_segment(
+                            self.sequence_number, self.incoming.ack_number,
                             syn_set=False, ack_set=True, fin_set=False,
-                            window=0x01, length=0, checksum=0)
+                            window=self.receive_window, payload=b'')
 
         # Update state and send package
         self.state = BTCPStates.ESTABLISHED
@@ -281,7 +823,17 @@ class BTCPClientSocket(BTCPSocket):
         # Show user that the client has connected.
         print("Client socket connected.")
 
-    def send(self, data):
+        # The SYNACK acknowledged the fast open data as sequence number 0
+        if self.fast_open_accepted:
+            self.sequence_number = self.next_sequence_nr(self.sequence_number)
+            data = data[len(self.fast_open_data):]
+            if self.digest is not None:
+                self.digest.update(self.fast_open_data)
+        data = data[self.resume_offset:]
+        if data:
+            self.send(io.BytesIO(data))
+
+    def send(self, data, stream=None, end=False):
         """Send data originating from the application in a reliable way to the
         server.
 
@@ -303,59 +855,88 @@ class BTCPClientSocket(BTCPSocket):
         for sending.
 
         Again, you should feel free to deviate from how this usually works.
-        """
 
-        counter = 0
-        while ( True ):
-            
-            #Read 1008 bytes into memory
-            message = data.read(1008)
+        This send only returns once all of data is in the send buffer, so it
+        always returns the length of data (from its position on). Segments are
+        built as the send buffer drains, so memory stays bounded by
+        send_buffer_size however large data is.
 
-            #Exit when we are at the end of the file
-            if len(message) == 0: 
+        On a connection with streams (see connect), data goes on stream, 0
+        unless given, and end says it is the last data of that stream.
+        Sending on several streams in turns interleaves them on the wire.
+        """
+        if self.streams is not None:
+            return self.send_stream(data, 0 if stream is None else stream, end)
+        if stream not in (None, 0) or end:
+            raise ValueError("This connection has a single stream, ended by shutdown")
+
+        # Large files can be cut into segments by worker processes; they are
+        # not compressed, the compressor works on the stream as a whole
+        if (self.workers and self.compressor is None
+                and (regular_file_size(data) or 0) >= MIN_FILE_SIZE):
+            return self.send_prepared(data)
+
+        # Cut the (possibly compressed) stream into payloads of the negotiated size
+        accepted = 0
+        pending = bytearray()
+        for size, block in self.stream_blocks(data):
+            accepted += size
+            pending += block
+            while len(pending) >= self.mss:
+                self.queue_segment(pending[:self.mss])
+                del pending[:self.mss]
+        if pending:
+            self.queue_segment(pending)
+        # Nothing waits for more data: the tail goes out now, the FIN follows on its own
+        self.flush_segments()
+        return accepted
+
+    def send_stream(self, data, stream_id, end):
+        # Cut data into pieces of stream_id (see btcp/streams.py). The last
+        # piece is held back until the input ends, so it can end the stream.
+        room = self.mss - STREAM_HEADER.size
+        if room < 1:
+            raise ValueError("A payload size of {} leaves no room for stream data".format(self.mss))
+        accepted = 0
+        pending = bytearray()
+        while ( True ):
+            block = data.read(room)
+            if len(block) == 0:
                 break
-            
-            message = bytearray(message, 'utf-8')
-
-            # Message length save
-            mlen = len(message)
-
-            # Padding
-            if( len(message) < 1008 ):
-                message = message + b'\x00'*(1008-len(message) )
-
-            # Keep ack
-            thisack = self.ack_number
-
-            # Create segment
-            header = super().build_segment_header(
-                    self.sequence_number, thisack,
-                    syn_set=False, ack_set=False, fin_set=False,
-                    window=0x01, length=mlen, checksum=0)
-
-            segment = io.BytesIO()
-            segment.write(header)
-            segment.write(message)
-            
-
-            checksum = super().in_cksum(segment.getvalue())
-            
-            header2 = super().build_segment_header(
-                    self.sequence_number, thisack,
-                    syn_set=False, ack_set=False, fin_set=False,
-                    window=0x01, length=mlen, checksum=checksum)
-            
-            segment= bytearray(segment.getvalue())
-            segment[:10] = header2
-
-            # Add segment to buffer
-            self.send_buffer.put(segment)
-
-            # Increase sequence number
-            self.sequence_number = self.next_sequence_nr(self.sequence_number)
-        while (self.send_buffer.qsize() > 0):
-            time.sleep(0.1)
-            continue
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+            accepted += len(block)
+            pending += block
+            while len(pending) > room:
+                self.queue_segment(self.streams.frame(stream_id, pending[:room]))
+                del pending[:room]
+        if pending or end:
+            self.queue_segment(self.streams.frame(stream_id, pending, end))
+        self.flush_segments()
+        return accepted
+
+    def send_prepared(self, f):
+        # Send the rest of the file f as segments prepared by worker processes
+        # (see btcp/presegment.py), which only need their sequence number
+        segmenter = ParallelSegmenter(f, self.mss, self.receive_window, self.workers,
+                                      ack_set=self.digest is None, checksum=self.digest is None)
+        for segment in segmenter.segments():
+            if self.digest is not None:
+                self.digest.update(memoryview(segment)[HEADER_SIZE:])
+            super().set_sequence_number(segment, self.sequence_number)
+            self.queue_built(segment)
+        self.flush_segments()
+        return segmenter.size
+
+    def recv(self):
+        """Return data the server sent back over the connection, e.g. the
+        answer to a request. Blocks until some has arrived; returns b'' once
+        the connection is closed and everything has been read.
+        """
+        self._lossy_layer.wait_until(
+            lambda: len(self.incoming.ring) > 0 or self.state == BTCPStates.CLOSED,
+            lambda: self.incoming.ring.wait_for_data(0.1))
+        return self.incoming.read()
 
     def shutdown(self):
         """Perform the bTCP three-way finish to shutdown the connection.
@@ -366,39 +947,28 @@ class BTCPClientSocket(BTCPSocket):
         thread for this, because the fin/ack from the server will be received
         in the network thread.
 
-        Hint: assigning to a boolean or enum attribute in thread A and reading
-        it in a loop in thread B (preferably with a short sleep to avoid
-        wasting a lot of CPU time) ensures that thread B will wait until the
-        boolean or enum has the expected value. We do not think you will need
-        more advanced thread synchronization in this project.
+        The FIN is the last segment of the stream, an empty one sent right
+        behind the data without waiting for the data to be acknowledged. The
+        network thread answers the server's FINACK with an ACK and sets the
+        closed Event, which this waits on. So it returns about one round
+        trip after the last data went out, or once the server has ended its
+        own stream if that is later (the server may still be answering).
         """
 
-        # Create FIN and ACK packages
-        FIN = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=False, ack_set=False, fin_set=True,
-                            window=0x01, length=0, checksum=0)
-
-        ACK = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=False, ack_set=True, fin_set=False,
-                            window=0x01, length=0, checksum=0)
+        # Queue the FIN. With a transfer digest it carries the digest.
+        if self.streams is not None and self.digest is not None:
+            self.queue_segment(self.streams.digest(), fin_set=True)
+        elif self.digest is not None:
+            self.queue_segment(self.digest.digest(), fin_set=True)
+        else:
+            self.queue_segment(b'', fin_set=True)
 
-        # Update state, send package and lock mutex        
+        # Update state, then let the network thread send the rest of the stream
         self.state = BTCPStates.FIN_SENT
-        self._lossy_layer.send_segment(FIN)
-        self.mutex = False
-
-        #Doesn't work commented for now!
-        # Wait for response from server
-        while (self.mutex == False):
-            self._lossy_layer.send_segment(FIN)
-            time.sleep(0.1)
-            continue
+        self.flush_segments()
 
-        # Update state and send package
-        self.state = BTCPStates.CLOSED
-        self._lossy_layer.send_segment(ACK)
+        # Wait for the FINACK, the FIN is retransmitted like data
+        self._lossy_layer.wait_until(self.closed.is_set, self.closed.wait)
         print("Client socket has shutdown.")
 
 
@@ -0,0 +1,115 @@
+"""Chunked stream compression for bTCP.
+
+When both ends agree on OPTION_COMPRESSION during the handshake, the client
+runs the application's byte stream through a ChunkCompressor before cutting it
+into segments, and the server runs the in-order byte stream through a
+ChunkDecompressor before handing it to the application.
+
+The compressed stream is a sequence of frames:
+
+    type (1 byte) | length (4 bytes, network order) | body
+
+type is FRAME_RAW or FRAME_ZLIB. Every chunk is compressed on its own, and sent
+raw when compression does not make it smaller, so incompressible data costs
+only the 5 byte frame header.
+
+Neither the length nor a decompressed body can exceed the chunk size, so a
+damaged or hostile stream shows as a ValueError from ChunkDecompressor
+rather than as unbounded buffering.
+"""
+
+
+import struct
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+FRAME_RAW = 0
+FRAME_ZLIB = 1
+FRAME_HEADER = struct.Struct("!BI")
+
+
+class ChunkCompressor:
+    """Compresses a byte stream into frames of at most CHUNK_SIZE input bytes."""
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, chunk_size=CHUNK_SIZE):
+        self.level = level
+        self.chunk_size = chunk_size
+        self._pending = bytearray()
+
+        # Statistics
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    def _frame(self, chunk):
+        compressed = zlib.compress(chunk, self.level)
+        if len(compressed) < len(chunk):
+            frame = FRAME_HEADER.pack(FRAME_ZLIB, len(compressed)) + compressed
+        else:
+            frame = FRAME_HEADER.pack(FRAME_RAW, len(chunk)) + bytes(chunk)
+        self.bytes_out += len(frame)
+        return frame
+
+
+    def compress(self, data):
+        """Add data to the stream. Returns the frames completed so far."""
+        self.bytes_in += len(data)
+        self._pending += data
+        frames = []
+        while len(self._pending) >= self.chunk_size:
+            frames.append(self._frame(bytes(self._pending[:self.chunk_size])))
+            del self._pending[:self.chunk_size]
+        return b''.join(frames)
+
+
+    def flush(self):
+        """Frame whatever is left, e.g. at the end of a send call."""
+        if not self._pending:
+            return b''
+        frame = self._frame(bytes(self._pending))
+        self._pending = bytearray()
+        return frame
+
+
+class ChunkDecompressor:
+    """Turns the in-order frame stream back into the original bytes. Frames
+    may be split over any number of calls to decompress.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._pending = bytearray()
+
+
+    def _inflate(self, body):
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(body, self.chunk_size + 1)
+        except zlib.error as error:
+            raise ValueError("Damaged compression frame: {}".format(error))
+        if len(data) > self.chunk_size or not inflater.eof:
+            raise ValueError("Damaged compression frame")
+        return data
+
+
+    def decompress(self, data):
+        """Add in-order stream bytes. Returns the data of all complete frames.
+        Raises ValueError when the stream is not a valid frame stream."""
+        self._pending += data
+        out = []
+        offset = 0
+        while len(self._pending) - offset >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self._pending, offset)
+            if kind not in (FRAME_RAW, FRAME_ZLIB):
+                raise ValueError("Unknown compression frame type {}".format(kind))
+            if length > self.chunk_size:
+                raise ValueError("Compression frame of {} bytes".format(length))
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self._pending):
+                break
+            body = bytes(self._pending[offset + FRAME_HEADER.size:end])
+            if kind == FRAME_ZLIB:
+                body = self._inflate(body)
+            out.append(body)
+            offset = end
+        del self._pending[:offset]
+        return b''.join(out)
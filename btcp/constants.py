@@ -9,6 +9,15 @@ TIMER_TICK:
 """
 TIMER_TICK = 100
 
+"""
+WAIT_POLL_INTERVAL:
+    seconds the application thread sleeps between checks when it waits in
+    LossyLayer.wait_until without a block function of its own. Short, so
+    it notices the network thread's progress quickly, but never zero: a
+    spinning thread holds the GIL the network thread needs.
+"""
+WAIT_POLL_INTERVAL = 0.0002
+
 """
 CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT:
     Constants used in the lossy_layer code to define the connection. bTCP as
@@ -30,3 +39,140 @@ HEADER_SIZE, PAYLOAD_SIZE, SEGMENT_SIZE:
 HEADER_SIZE = 10
 PAYLOAD_SIZE = 1008
 SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+
+"""
+SEQUENCE_SPACE:
+    Number of distinct sequence numbers: they count 0, 1, ..., 65534 and then
+    wrap around to 0. Compare them with BTCPSocket.seq_diff, never with < or >.
+"""
+SEQUENCE_SPACE = 65535
+
+"""
+MAX_PAYLOAD_SIZE:
+    Largest payload size that can be negotiated with OPTION_MSS: what is left
+    of the largest UDP datagram over IPv4 (65507 bytes) after the bTCP header.
+    PAYLOAD_SIZE stays the default when the peer does not negotiate.
+"""
+MAX_PAYLOAD_SIZE = 65507 - HEADER_SIZE
+
+"""
+OPTION_*:
+    Kinds of the handshake options a SYN or SYNACK can carry in its payload.
+    Every option is encoded as kind (1 byte), length (1 byte), value. A peer
+    ignores kinds it does not know, and the server only echoes the options it
+    accepts, so an option is in use only if it appears in the SYNACK.
+
+    OPTION_COMPRESSION: zlib compressed stream, value is the level (1 byte).
+    OPTION_MSS: largest payload per segment (2 bytes). The client offers what
+        it wants to send, the server answers with what it accepts.
+    OPTION_NAME: name of the transfer, e.g. the file being sent (utf-8, up
+        to 255 bytes). Only sent by the client; the server does not echo it.
+    OPTION_FASTOPEN: the SYN carries the first data of the stream (no value).
+        The data follows OPTION_END and takes sequence number 0. A server
+        that echoes the option has delivered it and acknowledges it in the
+        SYNACK; otherwise the client sends it again after the handshake.
+    OPTION_DIGEST: data segments are sent without a checksum (the field is
+        0 and not verified), for paths that are trusted not to flip bits. The
+        whole stream is protected by a BLAKE2b digest of DIGEST_SIZE bytes
+        instead, which is the payload of the FIN. The FIN itself is always
+        checksummed. No value.
+    OPTION_RESUME: continue an earlier, interrupted transfer. The client
+        sends an ID for the transfer (utf-8, up to 255 bytes); a server that
+        keeps checkpoints echoes the option with the offset in the stream
+        (8 bytes) to continue from, 0 if it has nothing of it yet. The stream
+        of the connection then starts at that offset, and the server does
+        not accept fast open data unless it is 0.
+    OPTION_DELTA: the client sends a delta against the server's copy of the
+        transfer instead of the data itself (see btcp/delta.py). The server
+        starts by sending the signature of its copy. No value; the server
+        only accepts it if its application handles deltas.
+    OPTION_FEC: the client follows groups of data segments with parity
+        segments, from which the server rebuilds a lost one (see
+        btcp/fec.py). The value is the number of segments per group the
+        client starts with (1 byte), 0 if it adapts it to the loss rate.
+        The server echoes the option if it uses the parity segments.
+    OPTION_STREAMS: the client's data is a number of independent streams
+        (see btcp/streams.py), every data segment a piece of one of them,
+        which the server delivers without waiting for the others. No value;
+        the server only accepts it if its application handles streams. It
+        is not combined with compression, fast open, resume or delta, and
+        with OPTION_DIGEST the FIN carries a digest of the streams' digests.
+    OPTION_END: a single byte that ends the options, anything after it is
+        data.
+"""
+OPTION_END = 0
+OPTION_COMPRESSION = 1
+OPTION_MSS = 2
+OPTION_NAME = 3
+OPTION_FASTOPEN = 4
+OPTION_DIGEST = 5
+OPTION_RESUME = 6
+OPTION_DELTA = 7
+OPTION_FEC = 8
+OPTION_STREAMS = 9
+
+"""
+PACING_BURST_TIME, PACING_GAIN, PACING_MIN_DELAY:
+    Send pacing (see btcp/pacing.py). The token bucket holds PACING_BURST_TIME
+    seconds worth of data at the pacing rate. Automatic pacing sends at
+    PACING_GAIN times window / SRTT, a little faster than the connection
+    drains, so it never limits throughput by itself. A pacing timer waits at
+    least PACING_MIN_DELAY seconds, so rounding cannot make it fire again
+    and again at the same moment without tokens flowing in.
+"""
+PACING_BURST_TIME = 0.001
+PACING_GAIN = 1.25
+PACING_MIN_DELAY = 0.00001
+
+"""
+SOCKET_BUFFER_WINDOWS, DATAGRAM_OVERHEAD:
+    The lossy layer grows the kernel's UDP socket buffers to hold
+    SOCKET_BUFFER_WINDOWS full windows of segments, so a burst does not
+    overflow the receive buffer before the network thread gets to it. The
+    kernel charges every datagram its size plus bookkeeping, about
+    DATAGRAM_OVERHEAD bytes.
+"""
+SOCKET_BUFFER_WINDOWS = 2
+DATAGRAM_OVERHEAD = 1024
+
+"""
+DIGEST_SIZE:
+    Size in bytes of the BLAKE2b digest of the stream that the FIN carries
+    when OPTION_DIGEST is in use.
+"""
+DIGEST_SIZE = 32
+
+"""
+PARITY_FLAG, FEC_MIN_GROUP, FEC_MAX_GROUP, FEC_RESIDUAL_LOSS, FEC_LOSS_WINDOW:
+    Forward error correction (see btcp/fec.py). A parity segment has
+    PARITY_FLAG set in its flags byte, next to SYN, ACK and FIN. When the
+    client adapts the group size, it picks the largest one between
+    FEC_MIN_GROUP and FEC_MAX_GROUP segments that should leave at most
+    FEC_RESIDUAL_LOSS of the data segments to be retransmitted, at the loss
+    rate seen over about the last FEC_LOSS_WINDOW segments.
+"""
+PARITY_FLAG = 0x08
+FEC_MIN_GROUP = 2
+FEC_MAX_GROUP = 32
+FEC_RESIDUAL_LOSS = 0.001
+FEC_LOSS_WINDOW = 1024
+
+"""
+SEND_BUFFER_SIZE, MIN_SEND_BUFFER_SEGMENTS:
+    Default size in bytes of the client's send buffer: the segments send has
+    built that the network thread has not taken into the window yet. send
+    blocks while it is full, so this bounds the memory a transfer takes on
+    top of the segments in flight, however large the input. It always holds
+    at least MIN_SEND_BUFFER_SEGMENTS segments.
+"""
+SEND_BUFFER_SIZE = 1 << 20
+MIN_SEND_BUFFER_SEGMENTS = 16
+
+"""
+SHM_RING_SIZE:
+    Bytes of segments the shared memory backend's ring holds, per receiving
+    end (see btcp/backends.py). A segment that does not fit is lost, as when
+    a UDP socket's receive buffer is full. Only the pages that are used take
+    memory.
+"""
+SHM_RING_SIZE = 16 << 20
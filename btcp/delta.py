@@ -0,0 +1,286 @@
+"""rsync-style delta transfers.
+
+When both ends agree on OPTION_DELTA, the server first sends the signature of
+its current copy of the output back over the connection: the block size, and
+for every whole block a weak rolling checksum (Adler-32) and a strong hash
+(BLAKE2b). The client slides a window of one block over the new version of
+the file. Wherever the weak checksum of the window is one of the server's and
+the strong hash agrees, it sends a reference to that block instead of the
+data, and moves on a whole block; otherwise it rolls the window on by one
+byte. The client's stream is then a sequence of operations:
+
+    OP_COPY    | first block (4 bytes) | count (4 bytes)
+    OP_LITERAL | length (4 bytes)      | data
+
+all in network order, and the server rebuilds the new version from its old
+copy and the literals with a DeltaPatcher. A file that is mostly unchanged
+costs little more than its changed regions and the signature.
+"""
+
+
+import hashlib
+import os
+import struct
+import zlib
+
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 64 * 1024
+STRONG_SIZE = 16
+READ_SIZE = 1 << 20
+OP_COPY = ord('C')
+OP_LITERAL = ord('L')
+SIGNATURE_HEADER = struct.Struct("!IQ")
+SIGNATURE_ENTRY = struct.Struct("!I{}s".format(STRONG_SIZE))
+COPY = struct.Struct("!BII")
+LITERAL = struct.Struct("!BI")
+ADLER_MOD = 65521
+
+
+def block_size_for(size):
+    """Block size for a file of size bytes: about its square root, as rsync
+    does, so the signature and the precision of matching grow together.
+    """
+    block = MIN_BLOCK_SIZE
+    while block < MAX_BLOCK_SIZE and block * block < size:
+        block <<= 1
+    return block
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+class Signature:
+    """Weak and strong checksums of the whole blocks of a file."""
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = []
+        # {weak checksum: {strong hash: first block with it}}
+        self.table = {}
+
+
+    def add(self, weak, strong):
+        self.table.setdefault(weak, {}).setdefault(strong, len(self.blocks))
+        self.blocks.append((weak, strong))
+
+
+    @classmethod
+    def of_file(cls, f, size):
+        """Signature of the open file f, which holds size bytes."""
+        signature = cls(block_size_for(size))
+        while True:
+            block = f.read(signature.block_size)
+            if len(block) < signature.block_size:
+                return signature
+            signature.add(zlib.adler32(block), strong_hash(block))
+
+
+    def encode(self):
+        return SIGNATURE_HEADER.pack(self.block_size, len(self.blocks)) + b''.join(
+            SIGNATURE_ENTRY.pack(weak, strong) for weak, strong in self.blocks)
+
+
+    @classmethod
+    def decode(cls, data):
+        """Signature from the start of data, and the number of bytes it took;
+        None and 0 if data does not hold all of it yet.
+        """
+        if len(data) < SIGNATURE_HEADER.size:
+            return None, 0
+        block_size, count = SIGNATURE_HEADER.unpack_from(data)
+        end = SIGNATURE_HEADER.size + count * SIGNATURE_ENTRY.size
+        if len(data) < end:
+            return None, 0
+        signature = cls(block_size)
+        for weak, strong in SIGNATURE_ENTRY.iter_unpack(data[SIGNATURE_HEADER.size:end]):
+            signature.add(weak, strong)
+        return signature, end
+
+
+class DeltaEncoder:
+    """Read-only file-like object over the delta of the new version in f
+    against signature, so it can be handed to BTCPClientSocket.send.
+    """
+    def __init__(self, f, signature):
+        self._file = f
+        self._signature = signature
+        self._output = bytearray()
+        self._data = b''
+        self._eof = False
+        self._done = False
+
+        # The window is _data[_position:_position + block_size], literal
+        # data not sent yet starts at _literal
+        self._position = 0
+        self._literal = 0
+
+        # A run of copied blocks that may still grow
+        self._copy_start = None
+        self._copy_count = 0
+
+        # Statistics
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+
+    def read(self, n=-1):
+        while not self._done and (n is None or n < 0 or len(self._output) < n):
+            self._encode_some()
+        if n is None or n < 0 or n > len(self._output):
+            n = len(self._output)
+        data = bytes(self._output[:n])
+        del self._output[:n]
+        return data
+
+
+    def _flush_literal(self, end):
+        if end > self._literal:
+            self._flush_copy()
+            self._output += LITERAL.pack(OP_LITERAL, end - self._literal)
+            self._output += self._data[self._literal:end]
+            self.literal_bytes += end - self._literal
+        self._literal = end
+
+
+    def _flush_copy(self):
+        if self._copy_count:
+            self._output += COPY.pack(OP_COPY, self._copy_start, self._copy_count)
+            self._copy_count = 0
+
+
+    def _copy(self, index):
+        if self._copy_count and self._copy_start + self._copy_count == index:
+            self._copy_count += 1
+        else:
+            self._flush_copy()
+            self._copy_start = index
+            self._copy_count = 1
+        self.copied_bytes += self._signature.block_size
+
+
+    def _refill(self):
+        # Drop what has been sent, and read on so a window and the byte after it fit
+        self._data = self._data[self._literal:] + self._file.read(READ_SIZE)
+        self._position -= self._literal
+        self._literal = 0
+        if len(self._data) - self._position <= self._signature.block_size:
+            self._eof = True
+
+
+    def _encode_some(self):
+        """Encode up to about READ_SIZE more bytes of the file into _output."""
+        n = self._signature.block_size
+        table = self._signature.table
+        if len(self._data) - self._position <= n and not self._eof:
+            self._refill()
+        data = self._data
+        end = len(data)
+        i = self._position
+        weak = None
+        # Stop at the end of the data, or early enough to keep literals bounded
+        limit = min(end - n, self._literal + READ_SIZE)
+        while i <= limit:
+            if weak is None:
+                weak = zlib.adler32(data[i:i + n])
+                a = weak & 0xFFFF
+                b = weak >> 16
+            candidates = table.get(weak)
+            if candidates is not None:
+                index = candidates.get(strong_hash(data[i:i + n]))
+                if index is not None:
+                    self._flush_literal(i)
+                    self._copy(index)
+                    i += n
+                    self._literal = i
+                    weak = None
+                    continue
+            if i + n >= end:
+                break
+            # Roll the window on by one byte
+            out_byte = data[i]
+            a = (a - out_byte + data[i + n]) % ADLER_MOD
+            b = (b - n * out_byte + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            i += 1
+        self._position = i
+        if self._eof and i + n >= end:
+            # Too little left for a block
+            self._flush_literal(end)
+            self._flush_copy()
+            self._done = True
+        elif i - self._literal >= READ_SIZE:
+            self._flush_literal(i)
+
+
+class DeltaPatcher:
+    """Rebuilds the new version of a file from the delta a client sends,
+    the old version in old (an open file, or None) and the signature's
+    block size, writing it to output.
+    """
+    def __init__(self, old, block_size, output):
+        self._old = old
+        self._block_size = block_size
+        self._output = output
+        self._pending = bytearray()
+        self._literal_left = 0
+
+        # Statistics
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+
+    def feed(self, data):
+        """Apply the next part of the delta."""
+        self._pending += data
+        pending = self._pending
+        start = 0
+        while start < len(pending):
+            if self._literal_left:
+                part = min(self._literal_left, len(pending) - start)
+                self._output.write(pending[start:start + part])
+                self._literal_left -= part
+                start += part
+            elif pending[start] == OP_LITERAL:
+                if len(pending) - start < LITERAL.size:
+                    break
+                _, self._literal_left = LITERAL.unpack_from(pending, start)
+                self.literal_bytes += self._literal_left
+                start += LITERAL.size
+            elif pending[start] == OP_COPY:
+                if len(pending) - start < COPY.size:
+                    break
+                _, first, count = COPY.unpack_from(pending, start)
+                self._copy(first, count)
+                start += COPY.size
+            else:
+                raise ValueError("Unknown delta operation {}".format(pending[start]))
+        del pending[:start]
+
+
+    def _copy(self, first, count):
+        if self._old is None:
+            raise ValueError("Delta refers to blocks of a file that does not exist")
+        self._old.seek(first * self._block_size)
+        left = count * self._block_size
+        while left > 0:
+            block = self._old.read(min(left, READ_SIZE))
+            if not block:
+                raise ValueError("Delta refers to blocks beyond the end of the old file")
+            self._output.write(block)
+            left -= len(block)
+        self.copied_bytes += count * self._block_size
+
+
+    def complete(self):
+        """Whether the delta so far ends on a whole operation."""
+        return not self._pending and not self._literal_left
+
+
+def file_signature(path):
+    """Signature of the file at path, or of an empty one if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            return Signature.of_file(f, os.fstat(f.fileno()).st_size)
+    except FileNotFoundError:
+        return Signature(MIN_BLOCK_SIZE)
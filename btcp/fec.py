@@ -0,0 +1,218 @@
+"""Forward error correction for the client's data segments.
+
+Without it, every lost segment costs at least a duplicate ACK round trip or
+a timeout before it is retransmitted. When both ends agree on OPTION_FEC, the
+client follows every group of data segments with a parity segment: the XOR
+of their payloads, each padded with zeros to the longest. The server keeps
+the payloads of recent segments, and when exactly one segment of a group is
+missing (lost, or dropped for a bad checksum), the parity and the others
+give it back right away.
+
+A parity segment has PARITY_FLAG in its flags byte and no sequence number
+of its own; its header fields describe the group:
+
+    sequence number    first segment of the group
+    ack number         XOR of the payload lengths of the group
+    window             number of segments in the group
+    length             length of the longest payload (of the parity)
+
+so groups can have any size, and the client can change it as it goes. It
+is never retransmitted, and segments that carry the FIN are not part of any
+group. The client either uses a fixed group size or adapts it to the loss
+rate it observes (see FecEncoder.adapt).
+
+XOR parity repairs one loss per group. Losses that come in bursts, as with
+netem's correlated loss, still need retransmissions, but fewer of them with
+smaller groups.
+"""
+
+
+import struct
+
+from btcp.btcp_socket import BTCPSocket
+from btcp.constants import (PARITY_FLAG, FEC_MIN_GROUP, FEC_MAX_GROUP,
+                            FEC_RESIDUAL_LOSS, FEC_LOSS_WINDOW, SEQUENCE_SPACE)
+
+
+def residual_loss(loss, group):
+    """Fraction of the data segments that still need a retransmission at
+    loss rate loss with groups of group segments: the segment is lost, and
+    so is another of the group or the parity.
+    """
+    return loss * (1 - (1 - loss) ** group)
+
+
+def loss_rate(residual, group):
+    """Loss rate that leaves residual of the segments for retransmission
+    with groups of group segments (inverse of residual_loss).
+    """
+    low, high = 0.0, 1.0
+    for _ in range(30):
+        middle = (low + high) / 2
+        if residual_loss(middle, group) < residual:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+class FecEncoder:
+    """Sending side: builds the parity segment of every group of data
+    segments. group_size is the number of segments per group, or "auto".
+    """
+    def __init__(self, group_size):
+        self.adaptive = group_size == "auto"
+        self.group_size = FEC_MAX_GROUP if self.adaptive else group_size
+
+        # The group being built
+        self._first = None
+        self._count = 0
+        self._value = 0
+        self._lengths = 0
+        self._longest = 0
+
+        # Data segments sent, and retransmitted, about the last
+        # FEC_LOSS_WINDOW of them
+        self.sent = 0
+        self.resent = 0
+
+        # Statistics
+        self.parities = 0
+
+
+    def add(self, sequence_number, payload):
+        """Add a data segment that is sent for the first time to the group.
+        Returns the parity segment if that completes the group, else None.
+        """
+        if self._count == 0:
+            self._first = sequence_number
+        self._value ^= int.from_bytes(payload, 'little')
+        self._lengths ^= len(payload)
+        self._longest = max(self._longest, len(payload))
+        self._count += 1
+        self.sent += 1
+        if self._count >= self.group_size:
+            return self.flush()
+        return None
+
+
+    def flush(self):
+        """The parity segment of the group so far, however small (None if it
+        is empty), e.g. because nothing else is waiting to be sent.
+        """
+        if self._count == 0:
+            return None
+        payload = self._value.to_bytes(self._longest, 'little')
+        segment = bytearray(struct.pack("!HHBBHH", self._first, self._lengths, PARITY_FLAG,
+                                        self._count, len(payload), 0))
+        segment += payload
+        segment[8:10] = struct.pack("!H", BTCPSocket.in_cksum(bytes(segment)))
+        self._count = 0
+        self._value = 0
+        self._lengths = 0
+        self._longest = 0
+        self.parities += 1
+        if self.adaptive:
+            self.adapt()
+        return segment
+
+
+    def resend(self):
+        """Count a retransmission: a loss the parity could not repair."""
+        self.resent += 1
+
+
+    def adapt(self):
+        """Pick the largest group that leaves at most FEC_RESIDUAL_LOSS of
+        the segments for retransmission, at the loss rate that explains the
+        retransmissions seen with the current group size.
+        """
+        if self.sent >= FEC_LOSS_WINDOW:
+            self.sent /= 2
+            self.resent /= 2
+        if self.sent < FEC_MAX_GROUP:
+            return
+        loss = loss_rate(self.resent / self.sent, self.group_size)
+        group = FEC_MIN_GROUP
+        while group < FEC_MAX_GROUP and residual_loss(loss, group + 1) <= FEC_RESIDUAL_LOSS:
+            group += 1
+        self.group_size = group
+
+
+class FecDecoder:
+    """Receiving side: remembers the payloads of recent data segments and
+    rebuilds the missing one of a group from its parity.
+    """
+    def __init__(self):
+        # {sequence number: (payload as an int, length)}
+        self._values = {}
+        # Parities still missing more than one segment,
+        # {first sequence number: (count, lengths, payload as an int, length)}
+        self._parities = {}
+
+        # Statistics
+        self.recovered = 0
+
+
+    def add(self, sequence_number, payload, ack_number):
+        """Take the payload of a data segment that arrived intact. Returns
+        the segments this lets a waiting parity rebuild, as a list of
+        (sequence number, payload).
+        """
+        if sequence_number in self._values:
+            return []
+        self._values[sequence_number] = (int.from_bytes(payload, 'little'), len(payload))
+        for first, parity in self._parities.items():
+            if BTCPSocket.seq_diff(sequence_number, first) < parity[0]:
+                return self._rebuild(first, ack_number)
+        return []
+
+
+    def add_parity(self, first, count, lengths, payload, ack_number):
+        """Take a parity segment. Returns the segment it rebuilds, if any,
+        as for add.
+        """
+        self._forget(ack_number)
+        self._parities[first] = (count, lengths, int.from_bytes(payload, 'little'), len(payload))
+        return self._rebuild(first, ack_number)
+
+
+    def _rebuild(self, first, ack_number):
+        count, lengths, value, longest = self._parities[first]
+        missing = None
+        for i in range(count):
+            sequence_number = BTCPSocket.seq_add(first, i)
+            have = self._values.get(sequence_number)
+            if have is not None:
+                value ^= have[0]
+                lengths ^= have[1]
+            elif BTCPSocket.seq_diff(sequence_number, ack_number) >= SEQUENCE_SPACE // 2:
+                # Delivered long ago and forgotten: the group is no use anymore
+                del self._parities[first]
+                return []
+            elif missing is not None:
+                # Two missing so far: wait for one of them
+                return []
+            else:
+                missing = sequence_number
+        del self._parities[first]
+
+        # A parity that does not add up (damaged data in digest mode) rebuilds nothing
+        if missing is None or lengths > longest or value.bit_length() > 8 * longest:
+            return []
+        payload = value.to_bytes(longest, 'little')[:lengths]
+        self._values[missing] = (int.from_bytes(payload, 'little'), lengths)
+        self.recovered += 1
+        return [(missing, payload)]
+
+
+    def _forget(self, ack_number):
+        # Segments well before the acknowledgement number cannot be in a
+        # group that is still missing one
+        horizon = BTCPSocket.seq_add(ack_number, -FEC_MAX_GROUP)
+        for sequence_number in [s for s in self._values
+                                if 0 < BTCPSocket.seq_diff(horizon, s) < SEQUENCE_SPACE // 2]:
+            del self._values[sequence_number]
+        for first in [f for f, parity in self._parities.items()
+                      if SEQUENCE_SPACE // 2 > BTCPSocket.seq_diff(ack_number, f) >= parity[0]]:
+            del self._parities[first]
@@ -0,0 +1,268 @@
+"""Userspace network impairment for the lossy layer.
+
+This module emulates the subset of `tc qdisc ... netem` that the test
+framework uses, without needing root and without touching the loopback
+interface of the whole machine. A NetworkImpairment is handed to a LossyLayer,
+which runs every outgoing (and optionally every incoming) segment through it.
+
+All randomness comes from a private random.Random seeded at construction, so
+two runs with the same seed and the same traffic make the same decisions.
+"""
+
+
+import random
+
+
+def parse_percentage(text):
+    """Turn a netem percentage like '10%' or '0.5' into a probability."""
+    if text.endswith('%'):
+        return float(text[:-1]) / 100
+    return float(text)
+
+
+def parse_time(text):
+    """Turn a netem time like '20ms', '1s' or '500us' into seconds."""
+    for suffix, scale in (('usec', 1e-6), ('us', 1e-6), ('msec', 1e-3),
+                          ('ms', 1e-3), ('sec', 1.0), ('s', 1.0)):
+        if text.endswith(suffix):
+            return float(text[:-len(suffix)]) * scale
+    # netem treats a bare number as microseconds
+    return float(text) * 1e-6
+
+
+def parse_rate(text):
+    """Turn a netem rate like '10mbit' or '1MBps' into bytes per second."""
+    units = (('gbit', 1e9 / 8), ('mbit', 1e6 / 8), ('kbit', 1e3 / 8),
+             ('bit', 1 / 8), ('GBps', 1e9), ('MBps', 1e6), ('KBps', 1e3),
+             ('Bps', 1.0), ('bps', 1.0))
+    for suffix, scale in units:
+        if text.endswith(suffix):
+            return float(text[:-len(suffix)]) * scale
+    # netem treats a bare number as bytes per second
+    return float(text)
+
+
+class CorrelatedRandom:
+    """Random source with netem's notion of correlation: every draw is a
+    weighted average of a fresh uniform value and the previous draw.
+    """
+    def __init__(self, rng, correlation=0.0):
+        self._rng = rng
+        self._correlation = correlation
+        self._last = rng.random()
+
+    def draw(self):
+        value = self._rng.random()
+        if self._correlation:
+            value = value * (1 - self._correlation) + self._last * self._correlation
+        self._last = value
+        return value
+
+    def chance(self, probability):
+        # Skip the draw entirely for disabled impairments, so enabling one
+        # impairment does not change the decisions of another.
+        if probability <= 0:
+            return False
+        return self.draw() < probability
+
+
+class GilbertElliott:
+    """Two state Markov loss model (netem's "loss gemodel p r 1-h 1-k").
+
+    p: probability of moving from the good state to the bad state
+    r: probability of moving from the bad state back to the good state
+    bad_loss: loss probability while in the bad state (1-h)
+    good_loss: loss probability while in the good state (1-k)
+    """
+    def __init__(self, rng, p, r=None, bad_loss=1.0, good_loss=0.0):
+        self._rng = rng
+        self.p = p
+        self.r = 1 - p if r is None else r
+        self.bad_loss = bad_loss
+        self.good_loss = good_loss
+        self.bad = False
+
+    def lost(self):
+        if self.bad:
+            if self._rng.random() < self.r:
+                self.bad = False
+        elif self._rng.random() < self.p:
+            self.bad = True
+        return self._rng.random() < (self.bad_loss if self.bad else self.good_loss)
+
+
+class NetworkImpairment:
+    """Decides the fate of every segment handed to it.
+
+    process() returns a list of (departure_time, segment) pairs: an empty list
+    for a lost segment, two pairs for a duplicated one, and a departure time in
+    the future for a delayed or rate limited one. Corrupted segments are
+    copies with a single bit flipped.
+
+    Construct it directly, or from a netem argument string with from_netem:
+
+        NetworkImpairment.from_netem("loss 10% 25%", seed=1)
+
+    Keyword arguments:
+    loss, loss_correlation -- random loss probability and its correlation
+    gemodel -- (p, r, 1-h, 1-k) Gilbert-Elliott burst loss, replaces loss
+    duplicate, duplicate_correlation -- duplication probability
+    corrupt, corrupt_correlation -- probability of flipping one bit
+    delay, jitter, delay_correlation -- added latency in seconds
+    reorder, reorder_correlation -- probability that a segment skips the
+        delay, which makes it overtake the segments in front of it
+    rate -- link bandwidth in bytes per second, None for unlimited
+    seed -- seed of the random number generator
+    """
+    def __init__(self, loss=0.0, loss_correlation=0.0, gemodel=None,
+                 duplicate=0.0, duplicate_correlation=0.0,
+                 corrupt=0.0, corrupt_correlation=0.0,
+                 delay=0.0, jitter=0.0, delay_correlation=0.0,
+                 reorder=0.0, reorder_correlation=0.0,
+                 rate=None, seed=None):
+        self._rng = random.Random(seed)
+        self.loss = loss
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.rate = rate
+
+        self._loss_rng = CorrelatedRandom(self._rng, loss_correlation)
+        self._gemodel = GilbertElliott(self._rng, *gemodel) if gemodel else None
+        self._duplicate_rng = CorrelatedRandom(self._rng, duplicate_correlation)
+        self._corrupt_rng = CorrelatedRandom(self._rng, corrupt_correlation)
+        self._delay_rng = CorrelatedRandom(self._rng, delay_correlation)
+        self._reorder_rng = CorrelatedRandom(self._rng, reorder_correlation)
+
+        # Time at which the emulated link finishes serializing the last segment
+        self._link_free_at = 0.0
+
+        # Counters, handy when comparing runs
+        self.segments = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.corrupted = 0
+        self.reordered = 0
+
+
+    @classmethod
+    def from_netem(cls, spec, seed=None):
+        """Build an impairment from the arguments of a netem qdisc, e.g. the
+        NETEM_* strings of testframework.py. Supports loss (random and
+        gemodel), duplicate, corrupt, delay, reorder and rate.
+        """
+        kwargs = {}
+        words = spec.split()
+        i = 0
+
+        def numbers(parse, limit):
+            # Collect up to limit optional arguments following a keyword
+            nonlocal i
+            values = []
+            while i < len(words) and len(values) < limit:
+                try:
+                    values.append(parse(words[i]))
+                except ValueError:
+                    break
+                i += 1
+            return values
+
+        while i < len(words):
+            keyword = words[i]
+            i += 1
+            if keyword == 'loss':
+                if i < len(words) and words[i] == 'random':
+                    i += 1
+                if i < len(words) and words[i] == 'gemodel':
+                    i += 1
+                    kwargs['gemodel'] = tuple(numbers(parse_percentage, 4))
+                    continue
+                values = numbers(parse_percentage, 2)
+                kwargs['loss'] = values[0]
+                if len(values) > 1:
+                    kwargs['loss_correlation'] = values[1]
+            elif keyword in ('duplicate', 'corrupt', 'reorder'):
+                values = numbers(parse_percentage, 2)
+                kwargs[keyword] = values[0]
+                if len(values) > 1:
+                    kwargs[keyword + '_correlation'] = values[1]
+            elif keyword == 'delay':
+                values = numbers(parse_time, 2)
+                kwargs['delay'] = values[0]
+                if len(values) > 1:
+                    kwargs['jitter'] = values[1]
+                corr = numbers(parse_percentage, 1)
+                if corr:
+                    kwargs['delay_correlation'] = corr[0]
+            elif keyword == 'rate':
+                kwargs['rate'] = parse_rate(words[i])
+                i += 1
+            else:
+                raise ValueError("Unsupported netem option: {}".format(keyword))
+
+        return cls(seed=seed, **kwargs)
+
+
+    def is_lost(self):
+        if self._gemodel is not None:
+            return self._gemodel.lost()
+        return self._loss_rng.chance(self.loss)
+
+
+    def corrupted_copy(self, segment):
+        """Return a copy of the segment with a single random bit flipped."""
+        segment = bytearray(segment)
+        if segment:
+            bit = self._rng.randrange(len(segment) * 8)
+            segment[bit // 8] ^= 1 << (bit % 8)
+        return bytes(segment)
+
+
+    def latency(self):
+        """Delay for one segment, honouring jitter and reordering."""
+        if not self.delay and not self.jitter:
+            return 0.0
+        if self._reorder_rng.chance(self.reorder):
+            self.reordered += 1
+            return 0.0
+        if not self.jitter:
+            return self.delay
+        # Uniform in [delay - jitter, delay + jitter], like netem without a
+        # distribution table
+        offset = (self._delay_rng.draw() * 2 - 1) * self.jitter
+        return max(0.0, self.delay + offset)
+
+
+    def departure(self, size, now):
+        """Time at which a segment of size bytes leaves the emulated link."""
+        if not self.rate:
+            return now
+        start = max(now, self._link_free_at)
+        self._link_free_at = start + size / self.rate
+        return self._link_free_at
+
+
+    def process(self, segment, now):
+        """Run one segment through the impairment. Returns a list of
+        (departure_time, segment) pairs, in any order.
+        """
+        self.segments += 1
+        if self.is_lost():
+            self.dropped += 1
+            return []
+
+        copies = 1
+        if self._duplicate_rng.chance(self.duplicate):
+            self.duplicated += 1
+            copies = 2
+
+        out = []
+        for _ in range(copies):
+            data = segment
+            if self._corrupt_rng.chance(self.corrupt):
+                self.corrupted += 1
+                data = self.corrupted_copy(segment)
+            out.append((self.departure(len(data), now) + self.latency(), data))
+        return out
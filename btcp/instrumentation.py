@@ -0,0 +1,198 @@
+"""Opt-in instrumentation of the network thread.
+
+Everything the network thread does delays every other datagram, so it helps
+to know how long its callbacks take under load. When a LossyLayer is given an
+Instrumentation (or the BTCP_INSTRUMENT environment variable is set), it
+records into LatencyHistograms:
+
+    segment_received  duration of lossy_layer_segment_received
+    tick              duration of lossy_layer_tick
+    send_segment      duration of send_segment, from either thread
+    queueing_delay    time from the kernel receiving a datagram until the
+                      network thread starts handling it (Linux only, from
+                      SO_TIMESTAMPNS)
+
+and prints a summary to stderr when the lossy layer is destroyed. With a
+profile path (BTCP_PROFILE), a SamplingProfiler also samples the stack of the
+network thread and writes it in the folded format that flamegraph.pl and
+speedscope read.
+
+When instrumentation is off, the lossy layer calls the plain methods: there
+is no wrapper and no check on the hot path.
+"""
+
+
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class LatencyHistogram:
+    """HDR-style histogram of durations in nanoseconds: every power of two
+    range is split into 2**SUB_BITS buckets, so any recorded value is known
+    to within about 3%, at a fixed cost per record and in fixed memory.
+    """
+    SUB_BITS = 5
+    BUCKETS = 64 * (1 << SUB_BITS)
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    @classmethod
+    def bucket_of(cls, value):
+        shift = max(0, value.bit_length() - (cls.SUB_BITS + 1))
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+
+    @classmethod
+    def highest_in_bucket(cls, index):
+        if index < (2 << cls.SUB_BITS):
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        mantissa = index - (shift << cls.SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.counts[self.bucket_of(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, p):
+        """Smallest recorded value (to bucket precision) that p percent of
+        the recorded values do not exceed.
+        """
+        if self.count == 0:
+            return 0
+        wanted = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.highest_in_bucket(index), self.max)
+        return self.max
+
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+    def summary(self):
+        """One line: count, mean and percentiles in microseconds."""
+        us = lambda ns: ns / 1000
+        return "{:<16} n={:<8} mean={:9.1f}us p50={:9.1f}us p90={:9.1f}us p99={:9.1f}us p99.9={:9.1f}us max={:9.1f}us".format(
+            self.name, self.count, us(self.mean()), us(self.percentile(50)), us(self.percentile(90)),
+            us(self.percentile(99)), us(self.percentile(99.9)), us(self.max))
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every interval seconds from a thread
+    of its own, and writes the samples as folded stacks: one line per
+    distinct stack, outermost frame first, frames separated by ';', followed
+    by the number of samples.
+    """
+    def __init__(self, path, interval=0.001):
+        self.path = path
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self, thread_ident):
+        self._target = thread_ident
+        self._thread = threading.Thread(target=self._run, name="btcp-profiler", daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+
+    def stop(self):
+        """Stop sampling and write the folded stacks to path."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class Instrumentation:
+    """The histograms (and optionally the profiler) of one lossy layer."""
+    def __init__(self, profile_path=None, profile_interval=0.001, output=sys.stderr):
+        self.histograms = collections.OrderedDict(
+            (name, LatencyHistogram(name))
+            for name in ("segment_received", "tick", "send_segment", "queueing_delay"))
+        self.profiler = SamplingProfiler(profile_path, profile_interval) if profile_path else None
+        self.output = output
+
+
+    @classmethod
+    def from_environment(cls, label=""):
+        """Instrumentation as asked for by the environment, or None:
+        BTCP_INSTRUMENT=1 turns on the histograms, BTCP_PROFILE=path also the
+        profiler. The path may contain {pid} and {label}, to keep the files
+        of client and server apart.
+        """
+        profile = os.environ.get("BTCP_PROFILE")
+        if not profile and os.environ.get("BTCP_INSTRUMENT", "0") in ("", "0"):
+            return None
+        if profile:
+            profile = profile.format(pid=os.getpid(), label=label)
+        return cls(profile_path=profile)
+
+
+    def timed(self, name, function):
+        """Wrap function so every call is recorded in histogram name."""
+        histogram = self.histograms[name]
+        clock = time.perf_counter_ns
+
+        def timed_call(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                histogram.record(clock() - start)
+        return timed_call
+
+
+    def start(self, thread):
+        """Start profiling the network thread, if asked for."""
+        if self.profiler is not None:
+            self.profiler.start(thread.ident)
+
+
+    def stop(self, label=""):
+        """Stop profiling and print the summary of the histograms."""
+        if self.profiler is not None:
+            self.profiler.stop()
+        print("bTCP network thread latencies{}:".format(" (" + label + ")" if label else ""), file=self.output)
+        for histogram in self.histograms.values():
+            print("  " + histogram.summary(), file=self.output)
+        if self.profiler is not None:
+            print("  profile written to {}".format(self.profiler.path), file=self.output)
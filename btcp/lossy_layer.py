@@ -1,23 +1,111 @@
-"""
-Students should NOT need to modify any code in this file!
+"""The unreliable segment delivery service under bTCP.
+
+LossyLayer carries segments between two addresses over a datagram backend
+(btcp/backends.py: UDP by default, AF_UNIX or shared memory on one host) and
+runs the "network thread", handle_incoming_segments, which hands received
+segments to the bTCP socket and runs its timers (btcp/timers.py).
 
-However, do read the docstrings to understand what's going on.
+Received datagrams go into buffers from a ReceiveBufferPool and reach bTCP
+as memoryviews, which it may keep past the callback with keep_segment.
+Where the kernel supplies them, ancillary data count the datagrams it
+dropped for lack of buffer space (SocketStats) and timestamp arrivals for
+the queueing delay histogram (btcp/instrumentation.py); size_buffers grows
+the kernel buffers to hold the window, so that such drops stay rare.
+
+bTCP reads the clock with now and blocks its application thread with
+wait_until, so that btcp/simulation.py can put both sockets on a virtual
+clock by providing the same methods. A NetworkImpairment on either
+direction emulates a bad network in userspace (btcp/impairment.py).
 """
 
 
+import collections
+import functools
 import socket
 import select
+import struct
 import sys
 import threading
+import time
+from btcp.backends import open_backend
 from btcp.constants import *
+from btcp.instrumentation import Instrumentation
+from btcp.timers import TimerService
+
+
+# Kernel receive timestamps, used to measure queueing delay when instrumented.
+# Python does not export the constant; 35 is its value on Linux.
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35 if sys.platform.startswith("linux") else None)
+TIMESPEC = struct.Struct("@ll")
+
+# Number of datagrams the kernel dropped on this socket because its receive
+# buffer was full, sent along with received datagrams. Linux only, 40 there.
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
+OVERFLOW_COUNT = struct.Struct("@I")
+
+# Set a buffer size above the system limit (net.core.rmem_max), if allowed
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33 if sys.platform.startswith("linux") else None)
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32 if sys.platform.startswith("linux") else None)
+
 
+class SocketStats:
+    """What the lossy layer knows about its datagram socket: datagrams sent
+    and received, datagrams the kernel dropped before bTCP saw them (these
+    look exactly like loss on the network), and the kernel buffer sizes in
+    bytes. Backends without a kernel socket report 0 for those.
+    """
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.kernel_drops = 0
+        self.receive_buffer = 0
+        self.send_buffer = 0
+
+
+    def summary(self):
+        return "sent={} received={} kernel_drops={} rcvbuf={} sndbuf={}".format(
+            self.sent, self.received, self.kernel_drops, self.receive_buffer, self.send_buffer)
+
+
+class ReceiveBufferPool:
+    """Preallocated bytearrays for the network thread to receive datagrams
+    into, so receiving does not allocate a new bytes object per segment.
+
+    acquire and release may be called from any thread: a deque's append and
+    pop are atomic. Buffers that are too small for the requested size (after
+    a larger segment size was negotiated) are dropped and replaced.
+    """
+    def __init__(self, size, count=128):
+        self.count = count
+        self._free = collections.deque(bytearray(size) for _ in range(count))
 
-def handle_incoming_segments(btcp_socket, event, udp_socket):
+
+    def acquire(self, size):
+        while True:
+            try:
+                buffer = self._free.pop()
+            except IndexError:
+                return bytearray(size)
+            if len(buffer) >= size:
+                return buffer
+
+
+    def release(self, buffer):
+        if len(self._free) < self.count:
+            self._free.append(buffer)
+
+
+def handle_incoming_segments(btcp_socket, event, backend, lossy_layer):
     """This is the main method of the "network thread".
 
-    Continuously read from the socket and whenever a segment arrives,
+    Continuously read from the backend and whenever a segment arrives,
     call the lossy_layer_segment_received method of the associated socket.
 
+    Whenever a timer scheduled on the lossy layer's TimerService expires, call
+    its callback. The wait in select ends at the earliest deadline, and expired
+    timers are run after every received segment as well, so a steady stream of
+    incoming segments cannot postpone them.
+
     If no segment is received for TIMER_TICK ms, call the lossy_layer_tick
     method of the associated socket.
 
@@ -27,16 +115,42 @@ def handle_incoming_segments(btcp_socket, event, udp_socket):
     the transport layer, or give one final tick if no segment is received in
     TIMER_TICK ms, then return.
 
-    Students should NOT need to modify any code in this method.
+    The thread only waits in select when the backend is idle: with the
+    shared memory backend, segments that are already in the ring are taken
+    without a system call.
     """
+    timers = lossy_layer.timers
+    wakeup = lossy_layer._wakeup_recv
+    tick = TIMER_TICK / 1000
+    last_activity = time.monotonic()
+    readable = backend.filenos() + [wakeup]
     while not event.is_set():
-        # We do not block here, because we might never check the loop condition in that case
-        rlist, wlist, elist = select.select([udp_socket], [], [], TIMER_TICK / 1000)
-        if rlist:
-            segment = udp_socket.recvfrom(SEGMENT_SIZE)
-            btcp_socket.lossy_layer_segment_received(segment)
-        else:
-            btcp_socket.lossy_layer_tick()
+        # We do not block indefinitely, because we might never check the loop condition in that case
+        now = time.monotonic()
+        timeout = max(0.0, last_activity + tick - now)
+        deadline = timers.next_deadline()
+        if deadline is not None:
+            timeout = max(0.0, min(timeout, deadline - now))
+        rlist = ()
+        if backend.idle():
+            rlist, wlist, elist = select.select(readable, [], [], timeout)
+            if wakeup in rlist:
+                wakeup.recv(4096)
+        if backend.has_input(rlist):
+            buffer = lossy_layer.buffers.acquire(lossy_layer.segment_size)
+            received = lossy_layer._receive_into(buffer, lossy_layer.segment_size)
+            if received is None:
+                lossy_layer.buffers.release(buffer)
+            else:
+                nbytes, address = received
+                lossy_layer.stats.received += 1
+                lossy_layer.receive((memoryview(buffer)[:nbytes], address), buffer)
+                last_activity = time.monotonic()
+        now = time.monotonic()
+        timers.run_expired(now)
+        if now - last_activity >= tick:
+            lossy_layer._tick()
+            last_activity = time.monotonic()
 
 
 class LossyLayer:
@@ -46,21 +160,102 @@ class LossyLayer:
     When the lossy layer is created, a thread (the "network thread") is started
     that calls handle_incoming_segments. When the lossy layer is destroyed, it
     will signal that thread to end, join it, wait for it to terminate, then
-    destroy its UDP socketet.
+    close its backend.
+
+    The backend carries the datagrams: UDP by default, or another of
+    btcp.backends.BACKENDS by name (backend), for peers on the same host.
+    Both ends must use the same one.
 
-    Students should NOT need to modify any code in this class.
+    segment_size is the largest datagram the network thread will receive.
+    It starts at SEGMENT_SIZE; bTCP raises it once a larger segment size has
+    been negotiated.
+
+    Datagrams are received into buffers from a ReceiveBufferPool, and handed
+    to lossy_layer_segment_received as (memoryview, address). The buffer is
+    reused as soon as that call returns, unless bTCP calls keep_segment from
+    within the call to hold on to it.
+
+    The lossy layer also owns the TimerService of the network thread, see
+    start_timer and cancel_timer. bTCP reads the clock with now and blocks
+    the application thread with wait_until, so that btcp.simulation can run
+    both sockets on a virtual clock instead.
+
+    Optionally, a btcp.impairment.NetworkImpairment can be given for outgoing
+    segments (impairment) and/or incoming segments (rx_impairment). This
+    emulates a bad network in userspace, see testframework.py.
+
+    Optionally, a btcp.instrumentation.Instrumentation records how long the
+    callbacks and send_segment take, see there. Without one, the environment
+    decides (BTCP_INSTRUMENT, BTCP_PROFILE); usually it stays off.
+
+    stats counts datagrams, including the ones the kernel dropped because the
+    receive buffer was full (Linux). bTCP calls size_buffers once it knows
+    the window and segment size, to keep that from happening (for
+    backends with a kernel socket).
     """
-    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port):
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 impairment=None, rx_impairment=None, instrumentation=None, backend=None):
         self._bTCP_socket = btcp_socket
         self._remote_ip = remote_ip
         self._remote_port = remote_port
-        self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._udp_socket.bind((local_ip, local_port))
+        self._backend = open_backend(backend, (local_ip, local_port), (remote_ip, remote_port))
+        # The kernel socket under the backend, if it has one
+        self._socket = self._backend.socket
         self._event = threading.Event()
+        self.segment_size = SEGMENT_SIZE
+        self.buffers = ReceiveBufferPool(SEGMENT_SIZE)
+        self._current_buffer = None
+        self._kept = False
+        self.stats = SocketStats()
+
+        # Lets other threads wake up the network thread when they schedule a
+        # timer that expires before the thread would otherwise wake up
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.timers = TimerService(on_schedule=self._wakeup)
+
+        self._impairment = impairment
+        self._rx_impairment = rx_impairment
+        # The impairments are shared between the application and network thread
+        self._impairment_lock = threading.Lock()
+
+        # What the network thread calls; wrapped with timing when instrumented
+        self._segment_received = btcp_socket.lossy_layer_segment_received
+        self._tick = btcp_socket.lossy_layer_tick
+        self._receive_into = self._backend.receive_into
+        self._ancillary_size = 0
+        if SO_RXQ_OVFL is not None and self._socket is not None:
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._ancillary_size += socket.CMSG_SPACE(OVERFLOW_COUNT.size)
+                self._receive_into = self._receive_ancillary
+            except OSError:
+                pass
+        self._label = "port {}".format(local_port)
+        if instrumentation is None:
+            instrumentation = Instrumentation.from_environment(str(local_port))
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self._segment_received = instrumentation.timed("segment_received", self._segment_received)
+            self._tick = instrumentation.timed("tick", self._tick)
+            self.send_segment = instrumentation.timed("send_segment", self.send_segment)
+            if SO_TIMESTAMPNS is not None and self._socket is not None:
+                try:
+                    self._socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                    self._ancillary_size += socket.CMSG_SPACE(TIMESPEC.size)
+                    self._receive_into = self._receive_ancillary
+                except OSError:
+                    pass
+        if self._socket is not None:
+            self.stats.receive_buffer = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            self.stats.send_buffer = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
         self._thread = threading.Thread(target=handle_incoming_segments,
-                                        args=(self._bTCP_socket, self._event, self._udp_socket))
+                                        args=(self._bTCP_socket, self._event, self._backend, self))
         self._thread.start()
+        if instrumentation is not None:
+            instrumentation.start(self._thread)
 
 
     def __del__(self):
@@ -69,18 +264,119 @@ class LossyLayer:
 
     def destroy(self):
         """Flag the thread that it can stop, wait for it to do so, then close
-        the lossy segment delivery service's UDP socket.
+        the lossy segment delivery service's backend.
 
         Should be safe to call multiple times, so safe to call from __del__.
         """
         if self._event is not None and self._thread is not None:
             self._event.set()
+            self._wakeup()
             self._thread.join()
-        if self._udp_socket is not None:
-            self._udp_socket.close()
+            if self.instrumentation is not None:
+                self.instrumentation.stop(self._label)
+                print("  socket: " + self.stats.summary(), file=self.instrumentation.output)
+            if self._backend.drops:
+                print("The {} backend dropped {} datagrams from {} because the peer's queue was full".format(
+                    self._backend.name, self._backend.drops, self._label), file=sys.stderr)
+            if self.stats.kernel_drops:
+                print("The kernel dropped {} datagrams on {} because the receive buffer ({} bytes) was full".format(
+                    self.stats.kernel_drops, self._label, self.stats.receive_buffer), file=sys.stderr)
+        if self._backend is not None:
+            self._backend.close()
+        if self._wakeup_recv is not None:
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
         self._event = None
         self._thread = None
-        self._udp_socket = None
+        self._backend = None
+        self._socket = None
+        self._wakeup_recv = None
+        self._wakeup_send = None
+
+
+    def _receive_ancillary(self, buffer, size):
+        # recvfrom_into that also reads the kernel's drop counter and, when
+        # instrumented, records how long the datagram waited since the kernel
+        # received it
+        nbytes, ancdata, flags, address = self._socket.recvmsg_into(
+            [memoryview(buffer)[:size]], self._ancillary_size)
+        for level, kind, data in ancdata:
+            if level != socket.SOL_SOCKET:
+                continue
+            if kind == SO_RXQ_OVFL and len(data) >= OVERFLOW_COUNT.size:
+                # The kernel sends the total since the socket was created
+                self.stats.kernel_drops = OVERFLOW_COUNT.unpack_from(data)[0]
+            elif kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                self.instrumentation.histograms["queueing_delay"].record(
+                    time.time_ns() - (seconds * 1000000000 + nanoseconds))
+        return nbytes, address
+
+
+    def size_buffers(self, window, segment_size):
+        """Grow the kernel's receive and send buffers of the datagram socket
+        to hold SOCKET_BUFFER_WINDOWS windows of segment_size datagrams.
+        Beyond the system limit only if the process may (CAP_NET_ADMIN);
+        buffers never shrink. Does nothing for backends without a kernel
+        socket. Safe to call from either thread.
+        """
+        kernel_socket = self._socket
+        if kernel_socket is None:
+            return
+        wanted = SOCKET_BUFFER_WINDOWS * window * (segment_size + DATAGRAM_OVERHEAD)
+        for option, force, field in ((socket.SO_RCVBUF, SO_RCVBUFFORCE, "receive_buffer"),
+                                     (socket.SO_SNDBUF, SO_SNDBUFFORCE, "send_buffer")):
+            # Linux reports twice what was set: the limit including bookkeeping
+            if kernel_socket.getsockopt(socket.SOL_SOCKET, option) < wanted:
+                try:
+                    kernel_socket.setsockopt(socket.SOL_SOCKET, force, wanted)
+                except (OSError, TypeError):
+                    kernel_socket.setsockopt(socket.SOL_SOCKET, option, wanted)
+            setattr(self.stats, field, kernel_socket.getsockopt(socket.SOL_SOCKET, option))
+
+
+    def _wakeup(self):
+        if self._wakeup_send is not None and threading.current_thread() is not self._thread:
+            try:
+                self._wakeup_send.send(b'\x00')
+            except BlockingIOError:
+                # Plenty of wakeups pending already
+                pass
+
+
+    def start_timer(self, delay, callback, *args):
+        """Call callback(*args) from the network thread after delay seconds.
+        Returns a Timer for cancel_timer. Safe to call from either thread.
+        """
+        return self.timers.schedule(delay, callback, *args)
+
+
+    def cancel_timer(self, timer):
+        """Cancel a timer returned by start_timer. None is ignored."""
+        self.timers.cancel(timer)
+
+
+    def now(self):
+        """The time in seconds that timers and send times are measured in."""
+        return time.monotonic()
+
+
+    def wait_until(self, condition, block=None, timeout=None):
+        """Block the application thread until condition() is true, calling
+        block() between checks; it should return once the condition may have
+        changed (or after a short while). Without block, sleeps
+        WAIT_POLL_INTERVAL seconds between checks; it never spins, which
+        would starve the network thread of the GIL. Returns whether the
+        condition became true, False after timeout seconds.
+        """
+        if block is None:
+            block = functools.partial(time.sleep, WAIT_POLL_INTERVAL)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not condition():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            block()
+        return True
 
 
     def send_segment(self, segment):
@@ -89,6 +385,66 @@ class LossyLayer:
         Should be safe to call from either the application thread or the
         network thread.
         """
-        bytes_sent = self._udp_socket.sendto(segment, (self._remote_ip, self._remote_port))
+        if self._impairment is None:
+            self._transmit(segment)
+            return
+        now = time.monotonic()
+        with self._impairment_lock:
+            copies = self._impairment.process(segment, now)
+        for due, data in copies:
+            if due <= now:
+                self._transmit(data)
+            else:
+                self.timers.schedule_at(due, self._transmit, data)
+
+
+    def keep_segment(self):
+        """Called from lossy_layer_segment_received to keep using the
+        memoryview of the segment being handled after the call returns.
+        Returns a function to call once the data has been consumed, which
+        hands the buffer back to the pool.
+        """
+        if self._current_buffer is None:
+            # Not a pooled buffer (e.g. delayed by an impairment); nothing to return
+            return lambda: None
+        self._kept = True
+        return functools.partial(self.buffers.release, self._current_buffer)
+
+
+    def receive(self, segment, buffer=None):
+        """Hand a segment that arrived from the backend to bTCP, passing it
+        through the receive side impairment if there is one. buffer is the
+        pool buffer the segment was received into.
+
+        Only called from the network thread.
+        """
+        if self._rx_impairment is None:
+            self._current_buffer = buffer
+            self._kept = False
+            try:
+                self._segment_received(segment)
+            finally:
+                if buffer is not None and not self._kept:
+                    self.buffers.release(buffer)
+                self._current_buffer = None
+            return
+        data, address = segment
+        # The impairment may hold on to the segment, so it cannot stay in the pool buffer
+        data = bytes(data)
+        if buffer is not None:
+            self.buffers.release(buffer)
+        now = time.monotonic()
+        with self._impairment_lock:
+            copies = self._rx_impairment.process(data, now)
+        for due, copy in copies:
+            if due <= now:
+                self._segment_received((copy, address))
+            else:
+                self.timers.schedule_at(due, self._segment_received, (copy, address))
+
+
+    def _transmit(self, segment):
+        self.stats.sent += 1
+        bytes_sent = self._backend.send(segment)
         if bytes_sent != len(segment):
             print("The lossy layer was only able to send {} bytes of that segment!".format(bytes_sent), file=sys.stderr)
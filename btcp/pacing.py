@@ -0,0 +1,96 @@
+"""Send pacing for the bTCP client.
+
+Without pacing, every ACK that opens the window releases a burst of segments
+into the UDP socket at once, which overflows socket and netem queues. A
+TokenBucket spreads them out: sending a segment costs its size in tokens,
+tokens flow in at the pacing rate, and the bucket holds at most a small burst.
+When the bucket runs dry the client schedules a timer on the network thread
+for the moment enough tokens will have flowed in.
+
+The rate is either fixed, or follows the connection: RateEstimator keeps a
+smoothed round trip time, and window / SRTT is what the connection can
+deliver anyway, so pacing at a little more than that costs no throughput.
+"""
+
+
+from btcp.constants import PACING_BURST_TIME, PACING_GAIN, PACING_MIN_DELAY
+
+
+class TokenBucket:
+    def __init__(self, rate, burst_bytes):
+        self.rate = rate
+        self.burst = burst_bytes
+        self.tokens = burst_bytes
+        self._last = None
+
+
+    def set_rate(self, rate, burst_bytes):
+        self.rate = rate
+        self.burst = burst_bytes
+        self.tokens = min(self.tokens, burst_bytes)
+
+
+    def refill(self, now):
+        """Add the tokens that flowed in since the last call."""
+        if self._last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+    def consume(self, amount):
+        """Spend tokens. The balance may go negative: a segment that is
+        larger than what is left is still sent, and paid back before the next.
+        """
+        self.tokens -= amount
+
+
+    def allowed(self, segment_size, limit):
+        """How many of limit segments of segment_size may go out now. One
+        always may while the balance is not negative, also when a segment is
+        larger than the whole bucket.
+        """
+        if self.tokens < 0:
+            return 0
+        return min(limit, int(self.tokens // segment_size) + 1)
+
+
+    def delay(self, amount):
+        """Seconds until amount tokens are available (0 if they are now),
+        at least PACING_MIN_DELAY otherwise.
+        """
+        if self.tokens >= amount:
+            return 0.0
+        return max(PACING_MIN_DELAY, (amount - self.tokens) / self.rate)
+
+
+def burst_size(rate, segment_size):
+    """Bucket size for a rate: PACING_BURST_TIME worth of data, but at least
+    two segments so the per-timer cost stays small at low rates.
+    """
+    return max(2 * segment_size, rate * PACING_BURST_TIME)
+
+
+class RateEstimator:
+    """Smoothed round trip time as in RFC 6298, and the pacing rate it implies
+    for a window of segments.
+    """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+
+    def rate(self, window_bytes):
+        """Pacing rate in bytes per second, or None while there is no sample."""
+        if self.srtt is None:
+            return None
+        # Loopback round trips can be shorter than the clock resolution
+        return PACING_GAIN * window_bytes / max(self.srtt, 1e-5)
@@ -0,0 +1,110 @@
+"""Deterministic test payloads for large transfers.
+
+Instead of a huge source file that has to be parsed before anything runs, the
+apps and the test framework generate the payload on the fly. A payload is
+fully determined by its size and seed: block i is produced by a
+random.Random seeded from (seed, i), so it can be generated in a stream, block
+by block, in constant memory, on both ends independently.
+
+The receiving end does not keep the payload either: it runs the received
+bytes through a StreamDigest and compares the result with payload_digest,
+which generates the expected payload and hashes it the same way.
+"""
+
+
+import hashlib
+import random
+
+
+BLOCK_SIZE = 64 * 1024
+
+
+def parse_size(text):
+    """Turn a size like '4096', '64K', '128M' or '1G' (binary units) into bytes."""
+    units = (('KiB', 1 << 10), ('MiB', 1 << 20), ('GiB', 1 << 30),
+             ('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30))
+    for suffix, scale in units:
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * scale)
+    return int(text)
+
+
+def payload_block(seed, index):
+    """Block number index (BLOCK_SIZE bytes) of the payload stream of seed."""
+    return random.Random((seed << 32) | index).randbytes(BLOCK_SIZE)
+
+
+class GeneratedPayload:
+    """Read-only file-like object over size bytes of the payload of seed, so it
+    can be handed to BTCPClientSocket.send like an opened file.
+    """
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+        self._position = 0
+        self._block = b''
+        self._block_index = -1
+
+
+    def __len__(self):
+        return self.size
+
+
+    def seek(self, offset):
+        self._position = max(0, min(offset, self.size))
+        return self._position
+
+
+    def tell(self):
+        return self._position
+
+
+    def read(self, n=-1):
+        remaining = self.size - self._position
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        parts = []
+        while n > 0:
+            index, offset = divmod(self._position, BLOCK_SIZE)
+            if index != self._block_index:
+                self._block = payload_block(self.seed, index)
+                self._block_index = index
+            part = self._block[offset:offset + n]
+            parts.append(part)
+            self._position += len(part)
+            n -= len(part)
+        return b''.join(parts)
+
+
+    def close(self):
+        self._block = b''
+
+
+class StreamDigest:
+    """Running digest and byte count of a stream that arrives in pieces."""
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.length = 0
+
+
+    def update(self, data):
+        self._hash.update(data)
+        self.length += len(data)
+
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def payload_digest(size, seed=0):
+    """Hex digest of the payload of size bytes and seed, computed in BLOCK_SIZE
+    pieces without holding the payload in memory.
+    """
+    digest = StreamDigest()
+    payload = GeneratedPayload(size, seed)
+    while True:
+        block = payload.read(BLOCK_SIZE)
+        if not block:
+            break
+        digest.update(block)
+    return digest.hexdigest()
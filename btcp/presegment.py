@@ -0,0 +1,141 @@
+"""Segment preparation in a process pool, for large files.
+
+Turning a file into segments costs the application thread a read, a header
+and, above all, a checksum per segment, in Python and under the GIL, which
+the network thread then waits for. A ParallelSegmenter hands that work to
+worker processes instead. Each worker maps its own range of the file (mmap)
+and writes complete segments for it into a slot of a shared memory block:
+the header with every field but the sequence and acknowledgement numbers,
+the payload and the checksum over all of it. The slots form a ring, so
+workers prepare the next ranges while the socket consumes earlier ones.
+
+The application thread copies the segments out in order and only fills in
+the sequence number, adjusting the checksum for that one word (see
+BTCPSocket.set_sequence_number); the acknowledgement number is filled in the
+same way when the segment goes out. How much this gains depends on the
+number of cores.
+"""
+
+
+import concurrent.futures
+import mmap
+import multiprocessing
+import os
+import stat
+
+from multiprocessing import shared_memory
+
+from btcp.btcp_socket import BTCPSocket
+from btcp.constants import HEADER_SIZE
+
+
+CHUNK_SIZE = 1 << 20
+SLOTS_PER_WORKER = 2
+# Below this, starting the workers costs more than they save
+MIN_FILE_SIZE = 16 * CHUNK_SIZE
+
+# State of a worker process, see _start_worker
+_file = None
+_shared = None
+
+
+def regular_file_size(f):
+    """Bytes left from the position of the file-like object f to its end,
+    or None if it is not a regular file that workers can open by its name
+    (a pipe, an in-memory stream...).
+    """
+    if not isinstance(getattr(f, "name", None), str):
+        return None
+    try:
+        status = os.fstat(f.fileno())
+        position = f.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(status.st_mode):
+        return None
+    return max(0, status.st_size - position)
+
+
+def _start_worker(path, shared_name):
+    global _file, _shared
+    _file = open(path, 'rb')
+    # Workers share the resource tracker of the socket's process, which
+    # unlinks the memory when it is done with it
+    _shared = shared_memory.SharedMemory(name=shared_name)
+
+
+def _prepare(slot, offset, length, mss, ack_set, window, checksum):
+    """Write the segments for length bytes of the file at offset into the
+    shared memory at slot. Returns the number of segments.
+    """
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    skip = offset - start
+    segment_size = HEADER_SIZE + mss
+    buffer = _shared.buf
+    count = 0
+    with mmap.mmap(_file.fileno(), skip + length, access=mmap.ACCESS_READ, offset=start) as data:
+        for position in range(skip, skip + length, mss):
+            payload = data[position:min(position + mss, skip + length)]
+            segment = bytearray(BTCPSocket.build_segment_header(
+                    0, 0, ack_set=ack_set, window=window, length=len(payload)))
+            segment += payload
+            if checksum:
+                segment[8:10] = BTCPSocket.in_cksum(segment).to_bytes(2, 'big')
+            at = slot + count * segment_size
+            buffer[at:at + len(segment)] = segment
+            count += 1
+    return count
+
+
+class ParallelSegmenter:
+    """Prepares the segments for the rest of the open file f in worker
+    processes: payloads of mss bytes, with the ACK flag if ack_set, the given
+    window, and a checksum unless checksum is False (see OPTION_DIGEST).
+    """
+    def __init__(self, f, mss, window, workers, ack_set=True, checksum=True):
+        self._file = f
+        self._mss = mss
+        self._window = window
+        self._workers = workers
+        self._ack_set = ack_set
+        self._checksum = checksum
+        self._start = f.tell()
+        self.size = regular_file_size(f)
+        self._end = self._start + self.size
+        self._chunk = max(1, CHUNK_SIZE // mss) * mss
+        self._slot_size = (self._chunk // mss) * (HEADER_SIZE + mss)
+
+
+    def segments(self):
+        """Yield the segments in order, as bytearrays without a sequence
+        number. Leaves the file positioned at its end.
+        """
+        chunks = [(offset, min(self._chunk, self._end - offset))
+                  for offset in range(self._start, self._end, self._chunk)]
+        if not chunks:
+            return
+        slots = min(len(chunks), self._workers * SLOTS_PER_WORKER)
+        shared = shared_memory.SharedMemory(create=True, size=slots * self._slot_size)
+        # A fresh interpreter per worker: fork does not mix with the network thread
+        pool = concurrent.futures.ProcessPoolExecutor(
+                self._workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_start_worker, initargs=(self._file.name, shared.name))
+        try:
+            submit = lambda i: pool.submit(_prepare, (i % slots) * self._slot_size, *chunks[i],
+                                           self._mss, self._ack_set, self._window, self._checksum)
+            pending = [submit(i) for i in range(slots)]
+            segment_size = HEADER_SIZE + self._mss
+            for i, (offset, length) in enumerate(chunks):
+                count = pending[i % slots].result()
+                slot = (i % slots) * self._slot_size
+                for n in range(count):
+                    at = slot + n * segment_size
+                    yield bytearray(shared.buf[at:at + HEADER_SIZE + min(self._mss, length - n * self._mss)])
+                # The slot is free again
+                if i + slots < len(chunks):
+                    pending[i % slots] = submit(i + slots)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            shared.close()
+            shared.unlink()
+        self._file.seek(self._end)
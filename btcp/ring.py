@@ -0,0 +1,128 @@
+"""Single producer, single consumer ring buffer for passing segments and data
+between the application thread and the network thread.
+
+Exactly one thread may call the put methods and exactly one (other) thread
+the get methods. The producer only ever writes the tail index and the
+consumer only the head index, and both indices only grow, so neither side
+needs a lock: under the GIL an attribute store is atomic, and a slot is
+written before the index that publishes it. Whole batches move per call.
+
+A side that has nothing to do can block in wait_for_data / wait_for_space.
+The other side only touches the Event when a waiter has announced itself, so
+the common path stays free of locks and notifications.
+"""
+
+
+import threading
+
+
+class SPSCRing:
+    def __init__(self, capacity):
+        # Round up to a power of two so an index maps to a slot with a mask
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self._mask = size - 1
+        self._slots = [None] * size
+        self._head = 0    # next slot to read, written by the consumer only
+        self._tail = 0    # next slot to write, written by the producer only
+
+        self._data_waiting = False
+        self._data_event = threading.Event()
+        self._space_waiting = False
+        self._space_event = threading.Event()
+
+
+    def __len__(self):
+        """Fill level: number of items waiting for the consumer."""
+        return self._tail - self._head
+
+
+    def free(self):
+        """Number of items the producer can still put."""
+        return self.capacity - (self._tail - self._head)
+
+
+    def put(self, item):
+        """Producer: add one item. Returns False if the ring is full."""
+        return self.put_many((item,)) == 1
+
+
+    def put_many(self, items):
+        """Producer: add as many of items (a sequence) as fit, in order.
+        Returns how many were added.
+        """
+        tail = self._tail
+        count = min(len(items), self.capacity - (tail - self._head))
+        slots = self._slots
+        mask = self._mask
+        for i in range(count):
+            slots[(tail + i) & mask] = items[i]
+        # Publish the batch only after its slots are filled
+        self._tail = tail + count
+        if count and self._data_waiting:
+            self._data_waiting = False
+            self._data_event.set()
+        return count
+
+
+    def get_many(self, limit=None):
+        """Consumer: take up to limit (default: all) waiting items, in order."""
+        head = self._head
+        count = self._tail - head
+        if limit is not None:
+            count = min(count, limit)
+        slots = self._slots
+        mask = self._mask
+        items = []
+        for i in range(head, head + count):
+            items.append(slots[i & mask])
+            # Drop the reference so the ring does not keep consumed items alive
+            slots[i & mask] = None
+        self._head = head + count
+        if count and self._space_waiting:
+            self._space_waiting = False
+            self._space_event.set()
+        return items
+
+
+    def wake(self):
+        """Wake up a blocked producer or consumer without moving any items,
+        e.g. because the connection was closed.
+        """
+        self._data_event.set()
+        self._space_event.set()
+
+
+    def wait_for_data(self, timeout=None):
+        """Consumer: block until an item is waiting or timeout seconds pass.
+        Returns whether there is data.
+        """
+        if self._tail != self._head:
+            return True
+        self._data_event.clear()
+        self._data_waiting = True
+        # Check again: the producer may have put just before we announced ourselves
+        if self._tail != self._head:
+            self._data_waiting = False
+            return True
+        self._data_event.wait(timeout)
+        self._data_waiting = False
+        return self._tail != self._head
+
+
+    def wait_for_space(self, timeout=None):
+        """Producer: block until there is room or timeout seconds pass.
+        Returns whether there is room.
+        """
+        if self.free() > 0:
+            return True
+        self._space_event.clear()
+        self._space_waiting = True
+        if self.free() > 0:
+            self._space_waiting = False
+            return True
+        self._space_event.wait(timeout)
+        self._space_waiting = False
+        return self.free() > 0
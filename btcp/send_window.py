@@ -0,0 +1,139 @@
+"""Send window of the bTCP client: the segments that are in flight.
+
+Segments enter the window in sequence number order and leave it, oldest
+first, when a cumulative acknowledgement covers them. They live in a ring of
+slots indexed by sequence number, so advancing the window and finding the
+segment with a given sequence number (e.g. the one the server asks for
+again) take constant time, also when sequence numbers wrap around. Every slot
+also records when its segment was last sent and how often it was resent.
+
+Only the network thread uses the window, so it needs no locking.
+"""
+
+
+from btcp.constants import SEQUENCE_SPACE
+
+
+class SendWindow:
+    def __init__(self, capacity, base=0):
+        # Round up to a power of two so a sequence offset maps to a slot with a mask
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self._mask = size - 1
+        self._segments = [None] * size
+        self._sent_at = [0.0] * size
+        self._retransmits = [0] * size
+        self._first = 0     # slot of the oldest segment in flight
+        self.base = base    # sequence number of the oldest segment in flight
+        self._count = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def free(self):
+        """Number of segments that can still be added."""
+        return self.capacity - self._count
+
+
+    def _offset(self, seqnum):
+        # Position of seqnum in the window, or None if it is not in flight
+        offset = (seqnum - self.base) % SEQUENCE_SPACE
+        if offset < self._count:
+            return offset
+        return None
+
+
+    def append(self, segment, now):
+        """Add the next segment of the stream, sent at time now. Returns its
+        sequence number.
+        """
+        if self._count == self.capacity:
+            raise ValueError("Send window is full")
+        slot = (self._first + self._count) & self._mask
+        self._segments[slot] = segment
+        self._sent_at[slot] = now
+        self._retransmits[slot] = 0
+        seqnum = (self.base + self._count) % SEQUENCE_SPACE
+        self._count += 1
+        return seqnum
+
+
+    def acknowledge(self, acknum):
+        """Process a cumulative acknowledgement: the peer expects acknum next.
+        Removes the segments it covers and returns how many that were; 0 for
+        a duplicate or an old acknowledgement.
+        """
+        acked = (acknum - self.base) % SEQUENCE_SPACE
+        if acked == 0 or acked > self._count:
+            return 0
+        segments = self._segments
+        mask = self._mask
+        for i in range(self._first, self._first + acked):
+            # Drop the reference, the segment will not be sent again
+            segments[i & mask] = None
+        self._first = (self._first + acked) & mask
+        self.base = acknum
+        self._count -= acked
+        return acked
+
+
+    def end(self):
+        """Sequence number of the next segment to enter the window."""
+        return (self.base + self._count) % SEQUENCE_SPACE
+
+
+    def before(self, seqnum):
+        """Whether segments in flight come before seqnum, which lies at most
+        at the end of the window (e.g. a past end).
+        """
+        return 0 < (seqnum - self.base) % SEQUENCE_SPACE <= self._count
+
+
+    def get(self, seqnum):
+        """The segment with sequence number seqnum, or None if it is not in flight."""
+        offset = self._offset(seqnum)
+        if offset is None:
+            return None
+        return self._segments[(self._first + offset) & self._mask]
+
+
+    def oldest(self):
+        """The oldest segment in flight, or None if there is none."""
+        if self._count == 0:
+            return None
+        return self._segments[self._first]
+
+
+    def sent_at(self, seqnum):
+        """When the segment with sequence number seqnum was last sent."""
+        return self._sent_at[(self._first + self._offset(seqnum)) & self._mask]
+
+
+    def retransmits(self, seqnum):
+        """How often the segment with sequence number seqnum has been resent."""
+        return self._retransmits[(self._first + self._offset(seqnum)) & self._mask]
+
+
+    def mark_resent(self, seqnum, now):
+        """Record that the segment with sequence number seqnum was sent again
+        at time now. Returns the segment.
+        """
+        slot = (self._first + self._offset(seqnum)) & self._mask
+        self._sent_at[slot] = now
+        self._retransmits[slot] += 1
+        return self._segments[slot]
+
+
+    def clear(self, base=None):
+        """Forget all segments in flight, and optionally start the window
+        at sequence number base.
+        """
+        self._segments = [None] * self.capacity
+        self._first = 0
+        self._count = 0
+        if base is not None:
+            self.base = base
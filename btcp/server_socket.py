@@ -1,16 +1,16 @@
 from btcp.btcp_socket import BTCPSocket, BTCPStates
 from btcp.lossy_layer import LossyLayer
+from btcp.compression import ChunkDecompressor
+from btcp.ring import SPSCRing
+from btcp.send_window import SendWindow
+from btcp.stream import ReceiveStream
+from btcp.fec import FecDecoder
+from btcp.streams import StreamReassembler, StreamReader
 from btcp.constants import *
 
-import time
-
-def insertTupleOrdered(someArray, element):
-    # inserts tuple into an ordered list at the right position, based on the key value of the tuple
-    for index in range(len(someArray)):
-        if (someArray[index][0] > element[0]):
-            return someArray[:index] + [element] + someArray[index:]
-    
-    return someArray + [element]
+import hashlib
+import struct
+import threading
 
 class BTCPServerSocket(BTCPSocket):
     """bTCP server socket
@@ -41,36 +41,183 @@ class BTCPServerSocket(BTCPSocket):
     """
 
 
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout, impairment=None, rx_impairment=None,
+                 compression=True, mss=MAX_PAYLOAD_SIZE, fast_open=True, instrumentation=None,
+                 digest=True, resume=None, idle_timeout=None, delta=False, fec=True,
+                 network=None, backend=None, streams=False):
         """Constructor for the bTCP server socket. Allocates local resources
         and starts an instance of the Lossy Layer.
 
+        impairment and rx_impairment are optional NetworkImpairments that
+        the lossy layer applies to outgoing and incoming segments.
+        instrumentation optionally measures the network thread, see
+        btcp/instrumentation.py.
+
+        compression says whether to accept a client's offer of stream
+        compression during the handshake.
+
+        mss is the largest payload per segment to accept from the client. A
+        client that does not ask for a size gets PAYLOAD_SIZE.
+
+        fast_open says whether to accept data carried in the client's SYN.
+
+        digest says whether to accept a client's offer to send data segments
+        without checksums and a digest of the stream with the FIN instead.
+        After recv has returned the end of the stream, transfer_verified
+        tells whether that digest matched (None if none was used).
+
+        resume is a function that takes the ID of a transfer a client wants
+        to continue (see OPTION_RESUME) and returns the offset to continue
+        from, 0 if it knows nothing of it. Without it, clients always start
+        from the beginning. The ID and offset of the current connection are
+        in transfer_id and resume_offset.
+
+        idle_timeout is a number of seconds after which a connection whose
+        client has gone silent is given up, e.g. because the client crashed.
+        recv then returns the end of the stream and aborted is True. None
+        waits forever. A compressed stream that cannot be decoded aborts
+        the connection the same way.
+
+        delta says whether to accept a client's offer to send a delta
+        against our copy of the transfer (see btcp/delta.py). The
+        application then has to send the signature of its copy after
+        accept, when the delta attribute says a connection uses one.
+
+        fec says whether to accept a client's offer to send parity segments,
+        which let us rebuild a lost data segment without waiting for its
+        retransmission (see btcp/fec.py).
+
+        network replaces the lossy layer, and backend picks its datagram
+        transport, as for the client socket.
+
+        streams says whether to accept a client's offer to send a number of
+        independent streams instead of one (see btcp/streams.py). The
+        application then reads them with recv(stream) or recv_stream, when
+        the streams attribute says a connection uses them.
+
         You can extend this method if you need additional attributes to be
         initialized, but do *not* call accept from here.
         """
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
 
-        # Global state of the program
+        # Global state of the program. Set before the lossy layer starts, a
+        # stray segment from an earlier connection may arrive right away.
         self.state = BTCPStates.CLOSED
+        self.digest = None
 
-        # Mutex variable that is locked by the different parts of this program, and unlocked upon receiving a correct response
-        self.mutex = True
+        self._lossy_layer = (network or LossyLayer)(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT,
+                                                    impairment=impairment, rx_impairment=rx_impairment,
+                                                    instrumentation=instrumentation, backend=backend)
 
-        # Sequence and acknoledgement numbers
-        self.sequence_number = 0
-        self.ack_number = 0
+        # The window we advertise, in segments; the header has one byte for it
+        self.windowsize = max(1, min(window, 255))
+
+        # Linger after the stream has ended, in timeouts: how long to keep
+        # answering retransmitted FINs if the client's last ACK does not come
+        self.max_r = 5
 
-        # Receive buffer
-        self.receive_buffer = []
-        self.ordered_receive = []
+        # Set by the network thread once a connection is completely closed
+        self.closed = threading.Event()
+        self.handshake = threading.Event()
+        self.closed.set()
+
+        # Handshake options we are willing to accept
+        self.compression = compression
+        self.max_mss = min(mss, MAX_PAYLOAD_SIZE)
+        self.fast_open = fast_open
+        self.accept_digest = digest
+        self.resume = resume
+        self.idle_timeout = idle_timeout
+        self.accept_delta = delta
+        self.accept_fec = fec
+        self.accept_streams = streams
+
+        # Timers on the network thread: resending SYNACK and FINACK, and
+        # resending our own data
+        self.handshake_timer = None
+        self.retransmit_timer = None
+        self.idle_timer = None
+
+        self.incoming = None
+        self.reset_connection()
+
+
+    def reset_connection(self):
+        """Forget everything about the previous connection, so the socket can
+        accept the next one. Only called while the socket is CLOSED.
+        """
+        self.state = BTCPStates.CLOSED
 
-        self.windowsize = 70
+        # Cleared while connecting, set by the network thread once the
+        # handshake got the response the application thread waits for
+        self.handshake.set()
 
-        # Retries
-        self.max_r = 5
-        self.shutdown_r = 0
-        
+        # Sequence number of our own data, which the client acknowledges
+        self.sequence_number = 0
+
+        # Hand back lossy layer buffers still held by data nobody read
+        if self.incoming is not None:
+            self.incoming.release_all()
+
+        # The client's stream, reassembled by the network thread and drained
+        # by recv in batches (see btcp/stream.py). It holds the acknowledgement
+        # number, and where the client's FIN is once it has arrived.
+        self.incoming = ReceiveStream(4096, deliver=self.deliver)
+
+        # Data we send back: segments built by send, taken by the network
+        # thread in batches, and the ones in flight. The client tells how many
+        # it takes in the window field of its SYN and acknowledgements.
+        self.send_buffer = SPSCRing(1024)
+        self.pending_segments = []
+        self.send_window = SendWindow(256)
+        self.peer_window = 1
+        self.mss = PAYLOAD_SIZE
+
+        # Whether the client acknowledged any of our data since the linger
+        # timer last went off
+        self.send_progress = False
+
+        # Whether the application has ended our stream (see shutdown), and
+        # whether the FINACK that tells the client where has gone out
+        self.stream_ended = False
+        self.fin_sent = False
+
+        # Handshake options in use, and the name the client gave the transfer
+        self.options = {}
+        self.decompressor = None
+        self.transfer_name = None
+        self.delta = False
+
+        # Transfer the client continues, and where its stream starts
+        self.transfer_id = None
+        self.resume_offset = 0
+
+        # Whether the connection was given up, and when the client was last heard
+        self.aborted = False
+        self.last_heard = self._lossy_layer.now()
+
+        # Digest of the delivered stream, the one the FIN carries, and the verdict
+        self.digest = None
+        self.fin_digest = None
+        self.transfer_verified = None
+
+        # Rebuilds lost segments from parity, if the client sends it
+        self.fec = None
+
+        # With streams: the network thread puts their pieces in order, the
+        # application thread sorts them out per stream
+        self.streams = None
+        self.stream_reader = None
+
+        # The next SYN may come from a client that has not negotiated a size yet
+        self._lossy_layer.segment_size = SEGMENT_SIZE
+
+        self._lossy_layer.cancel_timer(self.handshake_timer)
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self._lossy_layer.cancel_timer(self.idle_timer)
+        self.handshake_timer = None
+        self.retransmit_timer = None
+        self.idle_timer = None
 
     def next_ack(self, ack):
         # finds next acknowledgement number
@@ -79,61 +226,296 @@ class BTCPServerSocket(BTCPSocket):
         else:
             return 0
 
-    def main_received(self, message, sequence_number, acknowledgement_number, flags, window, data_length, checksum):
-        # builds generic acknowledgement for received message
-        ACK = super().build_segment_header(
-                        self.sequence_number, self.ack_number,
-                        syn_set=False, ack_set=True, fin_set=False,
-                        window=0x01, length=0, checksum=0)
-        
-        # if the checksum succeeds
-        if (super().in_cksum(message) == 0xFFFF):
-            # if the received sequence number is exactly equal to the expected acknowledgement number
-            if(self.ack_number == sequence_number):
-                # increase the expected acknowledgenumber 
-                self.ack_number = self.next_ack(self.ack_number)
-                
-                # add message to receive buffer
-                self.receive_buffer.append(message[10:10+data_length].decode('utf-8'))
-
-                # clear ordered receive buffer until we miss a packet again
-                cleared = 0 
-                for (seq, segment) in self.ordered_receive:
-                    if seq == self.ack_number:
-                        self.receive_buffer.append(segment)
-                        self.ack_number = self.next_ack(self.ack_number)
-                        cleared+=1
-
-                # delete all these packets out of the ordered receive buffer at once        
-                self.ordered_receive = self.ordered_receive[cleared:]
-                
-                # build new acknowledgement since ack number might have increased
-                ACK = super().build_segment_header(
-                        self.sequence_number, self.ack_number,
-                        syn_set=False, ack_set=True, fin_set=False,
-                        window=0x01, length=0, checksum=0)
-                        
-                self._lossy_layer.send_segment(ACK)
-            
-            elif (self.ack_number < sequence_number):
-                # Receive segment and add it to the ordered buffer as tuple with its sequence number
-                self.ordered_receive = insertTupleOrdered( self.ordered_receive, ( sequence_number, message[10:10+data_length].decode('utf-8') ))
-                
-                # Acknowledge previous message
-                self._lossy_layer.send_segment(ACK)
-
-            elif (self.ack_number > sequence_number and (sequence_number == 0 and self.ack_number < 60000 or sequence_number > 0) ):
-                # ACK got lost, reacknowledge (Should not happen, but just in case somehow it does)
-                self._lossy_layer.send_segment(ACK)
-            
-            else:
-                # Wrap numberspace around
-                self._lossy_layer.send_segment(ACK)
-                self.ack_number = 0
+    def start_timer(self, callback):
+        # start a timer that calls callback after the timeout, from the network thread
+        return self._lossy_layer.start_timer(self._timeout / 1000, callback)
+
+    def negotiate(self, options):
+        # Pick the options of the client's SYN that we support
+        self.options = {}
+        self.decompressor = None
+        if OPTION_NAME in options:
+            self.transfer_name = options[OPTION_NAME].decode('utf-8', errors='replace')
+        # Streams leave out what only works on a single one
+        streams = OPTION_STREAMS in options and self.accept_streams
+        mss = PAYLOAD_SIZE
+        if OPTION_MSS in options and len(options[OPTION_MSS]) == 2:
+            mss = max(1, min(struct.unpack("!H", options[OPTION_MSS])[0], self.max_mss))
+            self.options[OPTION_MSS] = struct.pack("!H", mss)
+        self.mss = mss
+        self._lossy_layer.segment_size = HEADER_SIZE + mss
+        self._lossy_layer.size_buffers(self.windowsize, HEADER_SIZE + mss)
+        if OPTION_COMPRESSION in options and self.compression and not streams:
+            self.options[OPTION_COMPRESSION] = options[OPTION_COMPRESSION]
+            self.decompressor = ChunkDecompressor()
+        if OPTION_DIGEST in options and self.accept_digest:
+            self.options[OPTION_DIGEST] = b''
+            self.digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        if OPTION_RESUME in options and self.resume is not None and not streams:
+            self.transfer_id = options[OPTION_RESUME].decode('utf-8', errors='replace')
+            self.resume_offset = self.resume(self.transfer_id)
+            self.options[OPTION_RESUME] = struct.pack("!Q", self.resume_offset)
+        if OPTION_FEC in options and self.accept_fec:
+            self.options[OPTION_FEC] = options[OPTION_FEC]
+            self.fec = FecDecoder()
+        if OPTION_DELTA in options and self.accept_delta and not streams:
+            self.options[OPTION_DELTA] = b''
+            self.delta = True
+        if streams:
+            self.options[OPTION_STREAMS] = b''
+            self.streams = StreamReassembler(digest=self.digest is not None)
+            self.stream_reader = StreamReader(self.incoming.ring)
+            self.incoming.ordered = False
+
+    def build_synack(self):
+        # SYNACK segment, echoing the options we accepted
+        return super().build_segment(
+                            self.sequence_number, self.incoming.ack_number,
+                            syn_set=True, ack_set=True, fin_set=False,
+                            window=self.windowsize, payload=super().build_options(self.options))
+
+    def deliver(self, payload, release=None):
+        # make in-order payload available to recv, decompressing it if negotiated.
+        # With streams, every new payload is a piece of one, in any order.
+        if self.streams is not None:
+            piece = self.streams.receive(payload)
+            if piece is not None:
+                self.incoming.ring.put((piece, None))
+            return
+        if self.decompressor is not None:
+            # the decompressor has its own copy
+            if release is not None:
+                release()
+                release = None
+            if self.state == BTCPStates.CLOSED:
+                return
+            try:
+                payload = self.decompressor.decompress(payload)
+            except ValueError as error:
+                self.stream_damaged(error)
+                return
+        if self.digest is not None:
+            self.digest.update(payload)
+        self.incoming.put(payload, release)
+
+    def handshake_timeout(self):
+        # Resend SYNACK until the client acknowledges it
+        if (self.state == BTCPStates.SYN_RCVD):
+            self._lossy_layer.send_segment(self.build_synack())
+
+        elif (self.state == BTCPStates.CLOSING):
+            # Lingered long enough, the client's last ACK got lost. Unless the
+            # client is still getting our data: then give it more time.
+            if (len(self.send_window) == 0 or not self.send_progress):
+                self.connection_closed()
+                return
+            self.send_progress = False
+            self.handshake_timer = self._lossy_layer.start_timer(
+                self.max_r * self._timeout / 1000, self.handshake_timeout)
+            return
+
+        else:
+            return
+
+        self.handshake_timer = self.start_timer(self.handshake_timeout)
+
+    def idle_check(self):
+        # Give up on a client that has gone silent, e.g. because it crashed,
+        # so the application can record how far it got and accept the next
+        if (self.state not in (BTCPStates.SYN_RCVD, BTCPStates.ESTABLISHED, BTCPStates.CLOSING)
+                or self.fin_sent):
+            return
+        idle = self._lossy_layer.now() - self.last_heard
+        if (idle < self.idle_timeout):
+            self.idle_timer = self._lossy_layer.start_timer(self.idle_timeout - idle, self.idle_check)
+            return
+        print("Client silent for {:.1f}s, connection aborted.".format(idle))
+        self.aborted = True
+        # accept may still be waiting for the handshake to finish
+        self.handshake.set()
+        self.connection_closed()
+
+    def send_finack(self):
+        # Acknowledge the whole stream, including the FIN. Its sequence number
+        # is the end of our own stream, and it takes that sequence number.
+        FINACK = super().build_segment(
+                            self.sequence_number, self.incoming.ack_number,
+                            syn_set=False, ack_set=True, fin_set=True,
+                            window=0x01, payload=b'')
+        self._lossy_layer.send_segment(FINACK)
+
+    def end_of_stream(self):
+        # Everything up to the FIN has been delivered: check the digest, let
+        # recv return, and acknowledge the FIN. Our own stream goes on (half
+        # close) until the application ends it, unless it already has.
+        if self.streams is not None and self.digest is not None:
+            self.transfer_verified = self.streams.digest() == self.fin_digest
+        elif self.digest is not None:
+            self.transfer_verified = self.digest.digest() == self.fin_digest
+        self.state = BTCPStates.CLOSING
+        self.incoming.ring.wake()
+        if self.stream_ended:
+            self.send_fin()
         else:
+            self.send_ack()
+
+    def send_fin(self):
+        # The client's stream and ours have both ended: tell the client where
+        # ours ends, and linger for its last ACK
+        if (self.state != BTCPStates.CLOSING or not self.stream_ended or self.fin_sent):
+            return
+        self.fin_sent = True
+        self.send_finack()
+        self._lossy_layer.cancel_timer(self.handshake_timer)
+        self.handshake_timer = self._lossy_layer.start_timer(
+            self.max_r * self._timeout / 1000, self.handshake_timeout)
+
+    def connection_closed(self):
+        # Lingering is over, and whatever we did not get across is dropped
+        self._lossy_layer.cancel_timer(self.handshake_timer)
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self.state = BTCPStates.CLOSED
+        self.send_window.clear()
+        self.send_buffer.get_many()
+        self.incoming.ring.wake()
+        self.closed.set()
+
+    def stream_damaged(self, error):
+        # The client's compressed stream cannot be decoded, so nothing after
+        # it can be either: give the connection up as idle_check does
+        print("Compressed stream damaged ({}), connection aborted.".format(error))
+        self.aborted = True
+        self.connection_closed()
+
+    def main_received(self, message, sequence_number, flags, data_length, intact):
+        # data and the FIN from the client; intact says whether the checksum
+        # holds, or that there is none to check (see OPTION_DIGEST)
+        if not intact:
             print("Checksum failed.")
+            self.send_ack()
+            return
+
+        payload = message[10:10+data_length]
+
+        # with a transfer digest, the FIN carries the digest instead of data
+        if (flags & 1 and self.digest is not None):
+            self.fin_digest = bytes(payload)
+            payload = b''
+
+        # In order data is delivered (without copying it out of the lossy
+        # layer's buffer), data ahead of a missing segment is kept for later
+        # and duplicates are ignored. Whatever happened, the acknowledgement
+        # tells the client what we are still missing.
+        recovered = ()
+        if (self.fec is not None and not flags & 1 and data_length > 0):
+            recovered = self.fec.add(sequence_number, payload, self.incoming.ack_number)
+        self.incoming.receive(sequence_number, payload, self._lossy_layer.keep_segment, fin=bool(flags & 1))
+        self.receive_recovered(recovered)
+        if self.state == BTCPStates.CLOSED:
+            # delivering it aborted the connection
+            return
+        self.stream_progressed()
+
+    def receive_recovered(self, recovered):
+        # segments rebuilt from parity, as (sequence number, payload); their
+        # payload is a copy, so there is no lossy layer buffer to keep
+        for sequence_number, payload in recovered:
+            self.incoming.receive(sequence_number, payload, lambda: None)
+
+    def stream_progressed(self):
+        # the FIN takes a sequence number, the stream ends once we get up to it
+        if self.incoming.complete():
+            self.end_of_stream()
+            return
+
+        self.send_ack()
+
+    def send_ack(self):
+        # Acknowledge what we have received so far: on our own data if there
+        # is some to send right now, in a segment of its own otherwise
+        if (self.send_pending() == 0):
+            ACK = super().build_segment(
+                        self.sequence_number, self.incoming.ack_number,
+                        syn_set=False, ack_set=True, fin_set=False,
+                        window=0x01, payload=b'')
             self._lossy_layer.send_segment(ACK)
 
+    def send_pending(self):
+        # Fill the client's window with our data from the send buffer, taken
+        # in one batch. Returns how many segments went out.
+        if (self.state not in (BTCPStates.ESTABLISHED, BTCPStates.CLOSING)):
+            return 0
+        room = min(self.peer_window - len(self.send_window), self.send_window.free())
+        if (room <= 0 or len(self.send_buffer) == 0):
+            return 0
+        now = self._lossy_layer.now()
+        segments = self.send_buffer.get_many(room)
+        for segment in segments:
+            self.transmit(segment)
+            self.send_window.append(segment, now)
+
+        # the oldest unacknowledged segment needs a running retransmission timer
+        if (self.retransmit_timer is None or not self.retransmit_timer.active):
+            self.start_retransmit_timer()
+        return len(segments)
+
+    def transmit(self, segment):
+        # Send one of our data segments, with the latest acknowledgement of
+        # the client's data piggybacked on it
+        super().set_ack(segment, self.incoming.ack_number, self.windowsize)
+        self._lossy_layer.send_segment(segment)
+
+    def handle_ack(self, acknowledgement_number, window):
+        # The client acknowledges our data, and tells us how much it can take.
+        # Returns whether it acknowledged any new data.
+        self.peer_window = window
+        if (self.send_window.acknowledge(acknowledgement_number) > 0):
+            self.send_progress = True
+            # Progress, so restart the timer for the new oldest segment
+            if len(self.send_window) > 0:
+                self.start_retransmit_timer()
+            else:
+                self._lossy_layer.cancel_timer(self.retransmit_timer)
+            return True
+        return False
+
+    def start_retransmit_timer(self):
+        self._lossy_layer.cancel_timer(self.retransmit_timer)
+        self.retransmit_timer = self.start_timer(self.retransmit_timeout)
+
+    def retransmit_timeout(self):
+        # The oldest of our segments was not acknowledged in time: resend it
+        if (self.state in (BTCPStates.ESTABLISHED, BTCPStates.CLOSING) and len(self.send_window) > 0):
+            self.transmit(self.send_window.mark_resent(self.send_window.base, self._lossy_layer.now()))
+            self.start_retransmit_timer()
+
+    def queue_segment(self, payload):
+        # One of our data segments for the send buffer. It always has the ACK
+        # flag: transmit fills in the acknowledgement number when it goes out.
+        segment = super().build_segment(
+                        self.sequence_number, 0,
+                        syn_set=False, ack_set=True, fin_set=False,
+                        window=self.windowsize, payload=payload)
+        self.pending_segments.append(segment)
+        if len(self.pending_segments) >= 64:
+            self.flush_segments()
+        self.sequence_number = self.next_ack(self.sequence_number)
+
+    def flush_segments(self):
+        # Hand the segments built so far to the network thread, in as few
+        # batches as fit. If the connection is given up meanwhile, they are dropped.
+        batch = self.pending_segments
+        self.pending_segments = []
+        while (batch and self.state in (BTCPStates.ESTABLISHED, BTCPStates.CLOSING)):
+            accepted = self.send_buffer.put_many(batch)
+            batch = batch[accepted:]
+            if accepted:
+                # Let the network thread start sending right away
+                self._lossy_layer.start_timer(0, self.send_pending)
+            if batch:
+                self._lossy_layer.wait_until(lambda: self.send_buffer.free() > 0,
+                                             lambda: self.send_buffer.wait_for_space(0.1))
+
     ###########################################################################
     ### The following section is the interface between the transport layer  ###
     ### and the lossy (network) layer. When a segment arrives, the lossy    ###
@@ -167,47 +549,106 @@ class BTCPServerSocket(BTCPSocket):
         Remember, we expect you to implement this *as a state machine!*
         """
 
+        # Nothing to do while closed, e.g. for a stray segment of an earlier
+        # connection that arrives while the constructor is still running
+        if (self.state == BTCPStates.CLOSED):
+            return
+
         # The unpacking of the segment message and the segment header
         message = segment[0]
+        self.last_heard = self._lossy_layer.now()
         sequence_number, acknowledgement_number, flags, window, data_length, checksum= super().unpack_segment_header(message[:10])
 
+        # Parity segments (see btcp/fec.py) only help while data is coming in
+        if (flags & PARITY_FLAG):
+            if (self.state == BTCPStates.ESTABLISHED and self.fec is not None
+                    and super().in_cksum(message) == 0xFFFF):
+                recovered = self.fec.add_parity(sequence_number, window, acknowledgement_number,
+                                                message[10:10+data_length], self.incoming.ack_number)
+                if recovered:
+                    self.receive_recovered(recovered)
+                    self.stream_progressed()
+            return
+
         # Get the flags into a 3 character string
         flag_bits = "{0:3b}".format(flags)
 
+        # Ignore damaged segments outside of the data transfer, the client
+        # sends them again. In ESTABLISHED the checksum is checked below;
+        # data that has none (see OPTION_DIGEST) only gets a FINACK later on.
+        unchecked = self.digest is not None and (flags & 3) == 0 and data_length > 0
+        if (self.state != BTCPStates.ESTABLISHED and not unchecked and super().in_cksum(message) != 0xFFFF):
+            return
+
         # STATE MACHINE
         if (self.state == BTCPStates.ACCEPTING):
-            if (flag_bits[0] == "1"):
-                self.mutex = True
+            # Only the first SYN counts, accept may not have answered it yet
+            if (flag_bits[0] == "1" and not self.handshake.is_set()):
+                options, data = super().split_options(message[10:10+data_length])
+                self.negotiate(options)
+                self.peer_window = window
+                # Fast open: the data in the SYN is sequence number 0, delivered
+                # as it is (never compressed) and acknowledged by the SYNACK.
+                # It is the start of the stream, not what a resumed one needs.
+                if (OPTION_FASTOPEN in options and self.fast_open and len(data) > 0
+                        and self.resume_offset == 0 and self.streams is None):
+                    self.options[OPTION_FASTOPEN] = b''
+                    if self.digest is not None:
+                        self.digest.update(data)
+                    self.incoming.put(bytes(data))
+                    self.incoming.ack_number = self.next_ack(self.incoming.ack_number)
+                self.handshake.set()
 
         elif (self.state == BTCPStates.SYN_RCVD):
-            if (flag_bits[1] == "1"):
-                self.mutex = True
+            # Anything but a resent SYN means the client got our SYNACK, even
+            # if its ACK was lost: data or a FIN can only follow the handshake
+            if (flag_bits[0] != "1"):
+                # Established from here on, so data right behind the ACK is not dropped
+                self._lossy_layer.cancel_timer(self.handshake_timer)
+                self.state = BTCPStates.ESTABLISHED
+                self.handshake.set()
+                self.lossy_layer_segment_received(segment)
 
         elif (self.state == BTCPStates.ESTABLISHED):
-            # if FIN is received
-            if (flag_bits[2] == "1"):
-                FINACK = super().build_segment_header(
-                                self.sequence_number, self.ack_number,
-                                syn_set=False, ack_set=True, fin_set=True,
-                                window=0x01, length=0, checksum=0)
-                self.state = BTCPStates.CLOSING
-                self._lossy_layer.send_segment(FINACK)
-
+            # With a transfer digest, data segments without the ACK flag carry
+            # no checksum at all; everything else must have a valid one
+            if (self.digest is not None and (flags & 3) == 0):
+                intact = True
             else:
-                self.main_received(message, sequence_number, acknowledgement_number, flags, window, data_length, checksum)
+                intact = super().in_cksum(message) == 0xFFFF
+
+            # The ACK flag says the acknowledgement number is valid: on pure
+            # ACKs of our data, on the client's data, and on the client's
+            # handshake ACK if that arrives late
+            if (flag_bits[1] == "1" and intact):
+                self.handle_ack(acknowledgement_number, window)
+
+            # data and the FIN, which is sequenced like data
+            if (data_length > 0 or flag_bits[2] == "1"):
+                self.main_received(message, sequence_number, flags, data_length, intact)
+            elif (intact):
+                self.send_pending()
 
         elif (self.state == BTCPStates.CLOSING):
-            # if FIN is received
-            if (flag_bits[2] == "1"):
-                FINACK = super().build_segment_header(
-                                self.sequence_number, self.ack_number,
-                                syn_set=False, ack_set=True, fin_set=True,
-                                window=0x01, length=0, checksum=0)
-                self._lossy_layer.send_segment(FINACK)
-                
-            # if ACK is received
-            elif (flag_bits[1] == "1"):
-                self.state = BTCPStates.CLOSED
+            progress = flag_bits[1] == "1" and self.handle_ack(acknowledgement_number, window)
+
+            if (flag_bits[1] == "1" and flag_bits[2] != "1" and data_length == 0):
+                # A pure ACK of our FIN: the client has everything, done lingering
+                if (self.fin_sent and acknowledgement_number == super().seq_add(self.sequence_number, 1)):
+                    self.connection_closed()
+                # The client has all our data but not the FINACK: it got lost
+                elif (self.fin_sent and len(self.send_window) == 0 and len(self.send_buffer) == 0):
+                    self.send_finack()
+                # Answer a reminder that brings nothing new, so the client
+                # knows we are still there while the application answers
+                elif (self.send_pending() == 0 and not progress and not self.fin_sent):
+                    self.send_ack()
+
+            # a retransmitted FIN or data: the client missed our acknowledgement
+            elif (self.fin_sent):
+                self.send_finack()
+            else:
+                self.send_ack()
 
     def lossy_layer_tick(self):
         """Called by the lossy layer whenever no segment has arrived for
@@ -224,34 +665,19 @@ class BTCPServerSocket(BTCPSocket):
         side, you may find you have no actual need for this method. Or maybe
         you do. See if it suits your implementation.
 
+        Resending of SYNACK and FINACK is driven by a timer on the lossy layer
+        instead (see start_timer), which fires on time even while segments
+        keep arriving.
+
         You will probably see some code duplication of code that doesn't handle
         the incoming segment among lossy_layer_segment_received and
         lossy_layer_tick. That kind of duplicated code would be a good
         candidate to put in a helper method which can be called from either
         lossy_layer_segment_received or lossy_layer_tick.
         """
-        
-        # STATE MACHINE
-        if (self.state == BTCPStates.SYN_RCVD):
-            
-            SYNACK = super().build_segment_header(
-                                self.sequence_number, self.ack_number,
-                                syn_set=True, ack_set=True, fin_set=False,
-                                window=0x01, length=0, checksum=0)
-
-            self._lossy_layer.send_segment(SYNACK)
-
-        elif (self.state == BTCPStates.CLOSING):
-            # shutdown after max retry of sending FINACK
-            if( self.shutdown_r < self.max_r):
-                FINACK = super().build_segment_header(
-                                    self.sequence_number, self.ack_number,
-                                    syn_set=False, ack_set=True, fin_set=True,
-                                    window=0x01, length=0, checksum=0)
-                self._lossy_layer.send_segment(FINACK)
-                self.shutdown_r +=1
-            else:
-                self.state = BTCPStates.CLOSED
+        # SYNACK and FINACK are resent by handshake_timeout, a timer on the
+        # lossy layer, so there is nothing to do on a tick.
+        pass
 
     ###########################################################################
     ### You're also building the socket API for the applications to use.    ###
@@ -273,12 +699,8 @@ class BTCPServerSocket(BTCPSocket):
     ### may find you can handle all receiving *and* sending of segments in  ###
     ### the lossy_layer_segment_received method.                            ###
     ###                                                                     ###
-    ### Note that because this is the server socket, and our (initial)      ###
-    ### implementation of bTCP is one-way reliable data transfer, there is  ###
-    ### no send() method available to the applications. You should still    ###
-    ### be able to send segments on the lossy layer, however, because       ###
-    ### of acknowledgements and synchronization. You should implement that  ###
-    ### above.                                                              ###
+    ### Data flows both ways: send() answers the client over the same      ###
+    ### connection, and acknowledgements ride on that data.                 ###
     ###########################################################################
 
     def accept(self):
@@ -292,43 +714,51 @@ class BTCPServerSocket(BTCPSocket):
         this, because the syn and final ack from the client will be received in
         the network thread.
 
-        Hint: assigning to a boolean or enum attribute in thread A and reading
-        it in a loop in thread B (preferably with a short sleep to avoid
-        wasting a lot of CPU time) ensures that thread B will wait until the
-        boolean or enum has the expected value. We do not think you will need
-        more advanced thread synchronization in this project.
+        The network thread sets the handshake Event when the SYN arrives and
+        again once the client acknowledges the SYNACK; accept waits on it
+        rather than polling, so that it does not hold the GIL the network
+        thread needs to handle those segments.
+
+        accept can be called again once recv has signalled the end of the
+        previous connection, to serve several connections in a row; it ends
+        our stream of that connection if the application did not (see
+        shutdown). The name
+        the client gave the new connection, if any, is in transfer_name, and
+        where a resumed transfer continues in resume_offset.
         """
 
-        # Update state and lock mutex
+        # Let the previous connection finish lingering, then start from a clean slate
+        self.shutdown()
+        self._lossy_layer.wait_until(self.closed.is_set, self.closed.wait)
+        self.reset_connection()
+        self.closed.clear()
+
+        # Update state, the handshake starts with the client's SYN
+        self.handshake.clear()
         self.state = BTCPStates.ACCEPTING
-        self.mutex = False
 
-        # Wait for appropriate message
-        while (self.mutex == False):
-            continue
+        # Wait for appropriate message; this may take a while, so do not spin
+        self._lossy_layer.wait_until(self.handshake.is_set, self.handshake.wait)
 
         # Create SYNACK segment
-        SYNACK = super().build_segment_header(
-                            self.sequence_number, self.ack_number,
-                            syn_set=True, ack_set=True, fin_set=False,
-                            window=self.windowsize, length=0, checksum=0)
+        SYNACK = self.build_synack()
 
-        # Update state, send segment and lock mutex
+        # Update state and send segment, then wait for the handshake
+        self.handshake.clear()
         self.state = BTCPStates.SYN_RCVD
         self._lossy_layer.send_segment(SYNACK)
-        self.mutex = False
-
-        # Wait for appropriate response
-        while (self.mutex == False):
-            continue
+        self.handshake_timer = self.start_timer(self.handshake_timeout)
+        if self.idle_timeout is not None:
+            self.idle_timer = self._lossy_layer.start_timer(self.idle_timeout, self.idle_check)
 
-        # Update state
-        self.state = BTCPStates.ESTABLISHED
+        # Wait for appropriate response; the network thread moves us to
+        # ESTABLISHED (and possibly further, if the client is quick)
+        self._lossy_layer.wait_until(self.handshake.is_set, self.handshake.wait)
 
         # Show user server has connected
         print("Server connected.")
 
-    def recv(self):
+    def recv(self, stream=None):
         """Return data that was received from the client to the application in
         a reliable way.
 
@@ -358,15 +788,92 @@ class BTCPServerSocket(BTCPSocket):
         that the connection has been terminated.
 
         Again, you should feel free to deviate from how this usually works.
-        """
-        while ( len(self.receive_buffer) < 1 and self.state != BTCPStates.CLOSED):
-            time.sleep(0.1)
-            continue
-
-        data = bytes(''.join(self.receive_buffer), 'utf-8')
-        self.receive_buffer = []
 
-        return data
+        On a connection with streams (see the streams attribute), recv
+        returns data of stream, 0 unless given, and b'' once that stream
+        has ended. recv_stream returns data of whichever stream has some.
+        """
+        if self.streams is not None:
+            return self.recv_streams(0 if stream is None else stream)
+        if stream not in (None, 0):
+            raise ValueError("This connection has a single stream")
+
+        # The stream has ended once the network thread has moved on to CLOSING
+        self._lossy_layer.wait_until(
+            lambda: len(self.incoming.ring) > 0 or self.state in (BTCPStates.CLOSING, BTCPStates.CLOSED),
+            lambda: self.incoming.ring.wait_for_data(0.1))
+
+        return self.incoming.read()
+
+    def recv_stream(self):
+        """Return (stream ID, data) of whichever stream has data waiting,
+        the one that has waited longest, blocking until one does. data is b''
+        once that stream has ended, and (None, b'') means the connection has
+        ended and everything has been read. A connection without streams
+        has a single one, 0.
+        """
+        if self.streams is None:
+            data = self.recv()
+            return (0, data) if data else (None, b'')
+        return self.recv_streams(None)
+
+    def stream_waiting(self, stream_id):
+        # Sort out what the network thread delivered, then see whether there
+        # is something to return for stream_id (any stream if None)
+        self.stream_reader.pull()
+        if stream_id is None:
+            return self.stream_reader.ready() is not None
+        return self.stream_reader.has(stream_id)
+
+    def recv_streams(self, stream_id):
+        # recv and recv_stream on a connection with streams. Once the
+        # network thread has moved on to CLOSING, it has delivered everything.
+        self._lossy_layer.wait_until(
+            lambda: self.stream_waiting(stream_id) or self.state in (BTCPStates.CLOSING, BTCPStates.CLOSED),
+            lambda: self.incoming.ring.wait_for_data(0.1))
+        self.stream_reader.pull()
+        if stream_id is not None:
+            return self.stream_reader.read(stream_id)
+        item = self.stream_reader.read_any()
+        return item if item is not None else (None, b'')
+
+    def send(self, data):
+        """Send data back to the client over the current connection, e.g. the
+        answer to a request. data is a file-like object, as for the client's
+        send, and like there this does not wait for acknowledgements: the
+        data rides in segments that also carry our acknowledgements.
+
+        This also works after recv has returned the end of the client's
+        stream, so a whole request can be read before it is answered. Our
+        stream ends with shutdown (or close, or the next accept); sending
+        after that raises ValueError.
+        """
+        if (self.stream_ended or self.state not in (BTCPStates.ESTABLISHED, BTCPStates.CLOSING)):
+            raise ValueError("The stream to the client has ended")
+
+        # Cut the stream into payloads of the negotiated size
+        while (self.state in (BTCPStates.ESTABLISHED, BTCPStates.CLOSING)):
+            block = data.read(self.mss)
+            if len(block) == 0:
+                break
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+            self.queue_segment(block)
+        self.flush_segments()
+
+    def shutdown(self):
+        """End the stream we send back to the client. Once the client's
+        stream has ended as well, the FINACK tells the client where ours
+        ends; it waits until it has everything up to there. Does not block:
+        close waits for the client's last ACK.
+
+        close and accept end the stream if the application did not.
+        """
+        if (self.stream_ended or self.state == BTCPStates.CLOSED):
+            return
+        self.flush_segments()
+        self.stream_ended = True
+        self._lossy_layer.start_timer(0, self.send_fin)
 
     def close(self):
         """Cleans up any internal state by at least destroying the instance of
@@ -384,9 +891,23 @@ class BTCPServerSocket(BTCPSocket):
             1. check whether the reference to the resource is not None.
                 2. if so, destroy the resource.
             3. set the reference to None.
+
+        close ends our stream (see shutdown) if that has not happened yet. If
+        the connection is still lingering after the end of the stream, close
+        waits for that to finish: until the client has our stream, or stops
+        making progress for the linger time.
         """
         if self._lossy_layer is not None:
-            self._lossy_layer.destroy()
+            try:
+                self.shutdown()
+                # Lingering ends by itself once the client stops making progress
+                # (see handshake_timeout); a client that never ended its stream
+                # is only waited for as long
+                linger = None if self.state == BTCPStates.CLOSING else self.max_r * self._timeout / 1000
+                self._lossy_layer.wait_until(self.closed.is_set, lambda: self.closed.wait(0.1), linger)
+            finally:
+                # Even when interrupted: the network thread would outlive us
+                self._lossy_layer.destroy()
         self._lossy_layer = None
 
 
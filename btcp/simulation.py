@@ -0,0 +1,387 @@
+"""Discrete-event simulation of bTCP connections.
+
+Over the lossy layer, a transfer takes as long as it takes in real time, and
+no two runs see the same timing. A Simulation runs the unchanged client and
+server sockets against a virtual clock instead. Its layer method stands in for
+LossyLayer (see the network argument of the sockets): segments go through a
+NetworkImpairment, which models the link (loss, delay, rate, reordering,
+...), and arrive by a direct call of lossy_layer_segment_received. Timers,
+lossy_layer_tick and arrivals are events on the same clock, and the clock
+jumps straight to the next one.
+
+The applications run as actors: threads of which only one runs at a time,
+and only while the event loop waits for it. An actor that blocks in
+wait_until hands control back, and the loop resumes it once its condition
+holds or its timeout has passed. Nothing runs concurrently and all randomness
+is seeded, so a simulation gives the same result for the same seed, and
+waiting costs nothing: a run takes only as long as the work of the sockets.
+
+    python -m btcp.simulation -g 1G -m 16384 -d -n "loss 1% delay 10ms rate 1gbit" -w 50 100 200
+
+runs a transfer for every combination of the given windows, timeouts and
+seeds, and prints one line per run.
+"""
+
+
+import argparse
+import contextlib
+import io
+import itertools
+import threading
+import time
+
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.constants import *
+from btcp.impairment import NetworkImpairment
+from btcp.lossy_layer import SocketStats
+from btcp.payload import GeneratedPayload, StreamDigest, parse_size, payload_digest
+from btcp.timers import TimerService
+
+
+class SimulationError(Exception):
+    pass
+
+
+class Actor:
+    """An application function running in a thread of its own, under the
+    control of a Simulation.
+    """
+    def __init__(self, simulation, function, args):
+        self.go = threading.Event()
+        self.waiting = None
+        self.done = False
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(simulation, function, args),
+                                       name="btcp-actor", daemon=True)
+
+
+    def _run(self, simulation, function, args):
+        self.go.wait()
+        self.go.clear()
+        try:
+            self.result = function(*args)
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.done = True
+            simulation._yielded.set()
+
+
+    def ready(self, now):
+        # Not started yet, or what it waits for has happened
+        if self.waiting is None:
+            return True
+        condition, deadline = self.waiting
+        return condition() or (deadline is not None and now >= deadline)
+
+
+class Simulation:
+    """Virtual clock, event loop and actors of one simulation run."""
+    def __init__(self):
+        self._now = 0.0
+        # Segments in flight and the deadlines of waiting actors
+        self.network = TimerService(clock=self.now)
+        self._layers = {}
+        self._actors = []
+        self._actor_of = {}
+        self._yielded = threading.Event()
+
+
+    def now(self):
+        return self._now
+
+
+    def layer(self, *args, **kwargs):
+        """A SimulatedLayer, called like LossyLayer: pass this method as the
+        network argument of a socket.
+        """
+        return SimulatedLayer(self, *args, **kwargs)
+
+
+    def spawn(self, function, *args):
+        """Run function(*args) as an actor once the simulation runs. Returns
+        the Actor, whose result holds what the function returned.
+        """
+        actor = Actor(self, function, args)
+        self._actors.append(actor)
+        self._actor_of[actor.thread] = actor
+        actor.thread.start()
+        return actor
+
+
+    def run(self, limit=3600.0):
+        """Run until every actor has returned. Raises SimulationError when
+        the virtual clock passes limit seconds, or when nothing is left to
+        happen while actors still wait; an error in an actor is raised here.
+        """
+        while True:
+            self._resume_ready()
+            if all(actor.done for actor in self._actors):
+                return
+            services = [self.network] + [layer.timers for layer in self._layers.values()]
+            deadlines = [d for d in (service.next_deadline() for service in services) if d is not None]
+            if not deadlines:
+                raise SimulationError("Simulation stalled at {:.3f}s: actors wait, but nothing is scheduled".format(self._now))
+            deadline = min(deadlines)
+            if deadline > limit:
+                raise SimulationError("Simulation passed its limit of {}s".format(limit))
+            self._now = max(self._now, deadline)
+            for service in services:
+                service.run_expired(self._now)
+
+
+    def _resume_ready(self):
+        resumed = True
+        while resumed:
+            resumed = False
+            for actor in self._actors:
+                if not actor.done and actor.ready(self._now):
+                    actor.waiting = None
+                    self._yielded.clear()
+                    actor.go.set()
+                    self._yielded.wait()
+                    if actor.error is not None:
+                        raise actor.error
+                    resumed = True
+
+
+    def wait_until(self, condition, timeout=None):
+        """LossyLayer.wait_until for actors: yield to the event loop until
+        condition() is true, or until timeout seconds of virtual time have
+        passed. Outside of an actor (e.g. close from a destructor after the
+        run) it does not block.
+        """
+        actor = self._actor_of.get(threading.current_thread())
+        if actor is None:
+            return condition()
+        deadline = None
+        if timeout is not None:
+            deadline = self._now + timeout
+            self.network.schedule_at(deadline, _nothing)
+        while not condition():
+            if deadline is not None and self._now >= deadline:
+                return False
+            actor.waiting = (condition, deadline)
+            self._yielded.set()
+            actor.go.wait()
+            actor.go.clear()
+        return True
+
+
+    def deliver(self, address, segment, source):
+        layer = self._layers.get(address)
+        if layer is not None:
+            layer.receive(segment, source)
+
+
+def _nothing():
+    pass
+
+
+class SimulatedLayer:
+    """Stands in for LossyLayer in a Simulation, with the same methods.
+    impairment and rx_impairment model the link, as for LossyLayer; without
+    them, segments arrive at once and intact. instrumentation and backend
+    are ignored.
+    """
+    def __init__(self, simulation, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 impairment=None, rx_impairment=None, instrumentation=None, backend=None):
+        self._simulation = simulation
+        self._bTCP_socket = btcp_socket
+        self._address = (local_ip, local_port)
+        self._remote = (remote_ip, remote_port)
+        self._impairment = impairment
+        self._rx_impairment = rx_impairment
+        self.segment_size = SEGMENT_SIZE
+        self.stats = SocketStats()
+        self.timers = TimerService(clock=simulation.now)
+        self._tick_interval = TIMER_TICK / 1000
+        self._last_activity = simulation.now()
+        self.timers.schedule(self._tick_interval, self._tick)
+        simulation._layers[self._address] = self
+
+
+    def destroy(self):
+        # Segments still on their way here are lost, timers never fire
+        if self._simulation._layers.get(self._address) is self:
+            del self._simulation._layers[self._address]
+
+
+    def size_buffers(self, window, segment_size):
+        pass
+
+
+    def start_timer(self, delay, callback, *args):
+        return self.timers.schedule(delay, callback, *args)
+
+
+    def cancel_timer(self, timer):
+        self.timers.cancel(timer)
+
+
+    def now(self):
+        return self._simulation.now()
+
+
+    def wait_until(self, condition, block=None, timeout=None):
+        return self._simulation.wait_until(condition, timeout)
+
+
+    def send_segment(self, segment):
+        self.stats.sent += 1
+        # The sender may reuse its buffer while the segment is in flight
+        segment = bytes(segment)
+        now = self._simulation.now()
+        copies = [(now, segment)] if self._impairment is None else self._impairment.process(segment, now)
+        for due, data in copies:
+            self._simulation.network.schedule_at(due, self._simulation.deliver, self._remote, data, self._address)
+
+
+    def keep_segment(self):
+        # Every segment has a buffer of its own
+        return _nothing
+
+
+    def receive(self, segment, source):
+        self.stats.received += 1
+        # Like a UDP socket, truncate datagrams that do not fit the buffer
+        segment = segment[:self.segment_size]
+        if self._rx_impairment is None:
+            self._segment_received(segment, source)
+            return
+        now = self._simulation.now()
+        for due, data in self._rx_impairment.process(segment, now):
+            self.timers.schedule_at(due, self._segment_received, data, source)
+
+
+    def _segment_received(self, segment, source):
+        self._last_activity = self._simulation.now()
+        self._bTCP_socket.lossy_layer_segment_received((memoryview(segment), source))
+
+
+    def _tick(self):
+        # As in the network thread: tick after TIMER_TICK without segments
+        now = self._simulation.now()
+        if now >= self._last_activity + self._tick_interval:
+            self._bTCP_socket.lossy_layer_tick()
+            self._last_activity = now
+        self.timers.schedule_at(self._last_activity + self._tick_interval, self._tick)
+
+
+class TransferResult:
+    """Outcome of simulate_transfer. duration is the virtual time from the
+    start until the server has the whole stream, wall_time the real time the
+    simulation took.
+    """
+    def __init__(self, size, duration, verified, client_stats, server_stats, dropped, wall_time):
+        self.size = size
+        self.duration = duration
+        self.verified = verified
+        self.client_stats = client_stats
+        self.server_stats = server_stats
+        self.dropped = dropped
+        self.wall_time = wall_time
+
+
+    def throughput(self):
+        """Goodput in bytes per second of virtual time."""
+        return self.size / self.duration if self.duration > 0 else float('inf')
+
+
+    def summary(self):
+        return "{} in {:.3f}s ({:.2f} MB/s) client_sent={} server_sent={} dropped={} wall={:.1f}s".format(
+            "verified" if self.verified else "CORRUPTED", self.duration, self.throughput() / 1e6,
+            self.client_stats.sent, self.server_stats.sent, self.dropped, self.wall_time)
+
+
+def simulate_transfer(size, window=100, timeout=100, netem=None, seed=0, payload_seed=0,
+                      client_options=None, server_options=None, limit=3600.0, quiet=True):
+    """Send a generated payload of size bytes from a client to a server in a
+    new Simulation and check that it arrives intact. netem describes both
+    directions of the link (as for testframework.py, where netem is set on
+    loopback), each with a random generator of its own derived from seed.
+    client_options and server_options are further keyword arguments for
+    the sockets. quiet keeps what the sockets print off stdout.
+    Returns a TransferResult.
+    """
+    started = time.perf_counter()
+    simulation = Simulation()
+    forward = backward = None
+    if netem:
+        forward = NetworkImpairment.from_netem(netem, seed=2 * seed)
+        backward = NetworkImpairment.from_netem(netem, seed=2 * seed + 1)
+    server = BTCPServerSocket(window, timeout, impairment=backward, network=simulation.layer,
+                              **(server_options or {}))
+    client = BTCPClientSocket(window, timeout, impairment=forward, network=simulation.layer,
+                              **(client_options or {}))
+    # close lets go of the layers, their counters are still of interest
+    client_layer, server_layer = client._lossy_layer, server._lossy_layer
+
+    def send():
+        client.connect(name="simulated")
+        client.send(GeneratedPayload(size, payload_seed))
+        client.shutdown()
+        client.close()
+
+    def receive():
+        server.accept()
+        digest = StreamDigest()
+        while True:
+            data = server.recv()
+            if len(data) == 0:
+                break
+            digest.update(data)
+        finished = simulation.now()
+        server.close()
+        return digest, finished
+
+    output = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        receiver = simulation.spawn(receive)
+        simulation.spawn(send)
+        simulation.run(limit)
+
+    digest, finished = receiver.result
+    verified = (server.transfer_verified is not False and digest.length == size
+                and digest.hexdigest() == payload_digest(size, payload_seed))
+    dropped = sum(impairment.dropped for impairment in (forward, backward) if impairment is not None)
+    return TransferResult(size, finished, verified, client_layer.stats, server_layer.stats,
+                          dropped, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate bTCP transfers on a virtual clock")
+    parser.add_argument("-g", "--generate", type=parse_size, default=16 << 20,
+                        help="Size of the payload to transfer, e.g. 64M or 1G")
+    parser.add_argument("-w", "--window", type=int, nargs='+', default=[100],
+                        help="Window sizes to try")
+    parser.add_argument("-t", "--timeout", type=int, nargs='+', default=[100],
+                        help="Timeouts in milliseconds to try")
+    parser.add_argument("-s", "--seed", type=int, nargs='+', default=[0],
+                        help="Seeds of the link model to try")
+    parser.add_argument("-n", "--netem", default=None,
+                        help="netem arguments that model the link, e.g. 'loss 1%% delay 10ms rate 100mbit'")
+    parser.add_argument("-m", "--mss", type=int, default=PAYLOAD_SIZE,
+                        help="Payload size per segment")
+    parser.add_argument("-d", "--digest", action="store_true",
+                        help="Skip per-segment checksums, check a digest of the stream instead")
+    parser.add_argument("-c", "--compress", type=int, default=None,
+                        help="Offer stream compression at this zlib level (0-9)")
+    parser.add_argument("--fec", default=None,
+                        help="Send a parity segment per this many data segments, or 'auto'")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show what the sockets print")
+    args = parser.parse_args()
+
+    fec = args.fec if args.fec in (None, "auto") else int(args.fec)
+    client_options = dict(mss=args.mss, digest=args.digest, compress_level=args.compress, fec=fec)
+    for window, timeout, seed in itertools.product(args.window, args.timeout, args.seed):
+        result = simulate_transfer(args.generate, window, timeout, args.netem, seed,
+                                   client_options=client_options, quiet=not args.verbose)
+        print("window={} timeout={} seed={}: {}".format(window, timeout, seed, result.summary()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Receiving side of one direction of a bTCP connection.
+
+Data flows both ways over a connection: the server receives the client's
+stream and the client receives what the server sends back. Both ends put the
+segments that arrive, in whatever order, into a ReceiveStream, which hands
+them on in order and remembers the ones that arrived ahead of a missing one.
+Its ack_number is what the receiving end acknowledges.
+
+In-order payloads go into an SPSCRing for the application thread, as
+(payload, release) pairs: release hands the lossy layer's receive buffer
+back once the payload has been copied out. When the ring is full, an
+in-order segment is not taken, so it is not acknowledged either and the
+sender slows down to the pace of the application.
+
+A ReceiveStream that is not ordered delivers every new segment as soon as
+it arrives instead, for streams within the connection (see
+btcp/streams.py), and only remembers the sequence numbers of those ahead of
+a missing one for the acknowledgement number.
+"""
+
+
+from btcp.btcp_socket import BTCPSocket
+from btcp.constants import SEQUENCE_SPACE
+from btcp.ring import SPSCRing
+
+
+class ReceiveStream:
+    def __init__(self, capacity=4096, deliver=None, ordered=True):
+        """deliver(payload, release) is called for every in-order payload;
+        by default it puts the payload into ring. Give another one to
+        transform payloads first, e.g. to decompress them. Unless ordered,
+        it is called for every new payload in order of arrival, without a
+        release: it has to copy what it keeps.
+        """
+        self.ring = SPSCRing(capacity)
+        self.deliver = deliver if deliver is not None else self.put
+        self.ordered = ordered
+
+        # Next sequence number we expect, i.e. the acknowledgement number
+        self.ack_number = 0
+
+        # Segments that arrived ahead of a missing one, as
+        # {sequence number: (payload, release)}
+        self.out_of_order = {}
+
+        # Sequence number of the FIN, once it has arrived. The FIN is
+        # sequenced like data; the stream is complete once it is delivered.
+        self.fin_sequence = None
+
+
+    def put(self, payload, release=None):
+        if payload:
+            self.ring.put((payload, release))
+        elif release is not None:
+            release()
+
+
+    def receive(self, sequence_number, payload, keep, fin=False):
+        """Take the segment with sequence_number and payload. keep is called
+        without arguments if the payload has to outlive this call, and
+        returns the function that releases it (see LossyLayer.keep_segment).
+
+        Returns whether the segment moved the stream forward.
+        """
+        if fin and self.fin_sequence is None:
+            self.fin_sequence = sequence_number
+
+        if not self.ordered:
+            return self.receive_unordered(sequence_number, payload)
+
+        if sequence_number == self.ack_number:
+            # The application has to leave room for it
+            if self.ring.free() == 0:
+                return False
+            self.ack_number = BTCPSocket.seq_add(self.ack_number, 1)
+            self.deliver(payload, keep())
+
+            # segments we already had can follow until we miss one again
+            while self.ack_number in self.out_of_order and self.ring.free() > 0:
+                self.deliver(*self.out_of_order.pop(self.ack_number))
+                self.ack_number = BTCPSocket.seq_add(self.ack_number, 1)
+            return True
+
+        # Ahead of what we expect (also across the wrap around): keep it for
+        # later, unless we have it already. Behind: a duplicate, ignore it.
+        if (BTCPSocket.seq_diff(sequence_number, self.ack_number) < SEQUENCE_SPACE // 2
+                and sequence_number not in self.out_of_order):
+            self.out_of_order[sequence_number] = (payload, keep())
+        return False
+
+
+    def receive_unordered(self, sequence_number, payload):
+        # Deliver a new segment right away, wherever it is in the sequence;
+        # only while the application leaves room, as for in-order ones
+        ahead = BTCPSocket.seq_diff(sequence_number, self.ack_number)
+        if (ahead >= SEQUENCE_SPACE // 2 or sequence_number in self.out_of_order
+                or self.ring.free() == 0):
+            return False
+        self.deliver(payload, None)
+        if ahead > 0:
+            self.out_of_order[sequence_number] = None
+            return False
+        self.ack_number = BTCPSocket.seq_add(self.ack_number, 1)
+        while self.ack_number in self.out_of_order:
+            del self.out_of_order[self.ack_number]
+            self.ack_number = BTCPSocket.seq_add(self.ack_number, 1)
+        return True
+
+
+    def complete(self):
+        """Whether everything up to and including the FIN has been delivered."""
+        return (self.fin_sequence is not None
+                and self.ack_number == BTCPSocket.seq_add(self.fin_sequence, 1))
+
+
+    def read(self):
+        """Application thread: everything delivered so far, as one bytes."""
+        buffered = self.ring.get_many()
+        data = b''.join(payload for (payload, _) in buffered)
+
+        # the data has been copied, so the lossy layer can reuse its buffers
+        for (_, release) in buffered:
+            if release is not None:
+                release()
+        return data
+
+
+    def release_all(self):
+        """Hand back the lossy layer buffers still held by data nobody read."""
+        # (unordered streams only remember sequence numbers)
+        held = [entry for entry in self.out_of_order.values() if entry is not None]
+        for (_, release) in held + self.ring.get_many():
+            if release is not None:
+                release()
+        self.out_of_order = {}
@@ -0,0 +1,189 @@
+"""Independent streams within one bTCP connection.
+
+Sending several files used to take a connection each, every one with a
+handshake of its own. When both ends agree on OPTION_STREAMS, the client's
+data is a number of streams instead of one, which it can send in turns.
+Every data segment carries a piece of one stream: its payload starts with a
+STREAM_HEADER, the stream ID and the offset of the piece in that stream,
+with STREAM_FIN set in the ID on the last piece of a stream (which may be
+empty). A stream exists once its first piece is sent; no handshake needed.
+
+The segments still form one sequence, so the streams share the
+acknowledgements, retransmissions, window, pacing and parity of the
+connection. What changes is delivery: the server hands on a piece as soon
+as it has its stream up to there, while segments of other streams may
+still be missing. A lost segment only holds up its own stream.
+
+StreamSender (client) builds the pieces. StreamReassembler (server, network
+thread) puts the pieces of each stream in order and hands them on;
+StreamReader (server, application thread) sorts them into a buffer per
+stream for recv.
+
+With OPTION_DIGEST every stream has a digest of its own, as the streams do
+not arrive in the order they were sent in. The FIN carries their
+combined_digest.
+"""
+
+
+import collections
+import hashlib
+import struct
+
+from btcp.constants import DIGEST_SIZE
+
+
+STREAM_HEADER = struct.Struct("!HQ")
+STREAM_FIN = 0x8000
+MAX_STREAM_ID = STREAM_FIN - 1
+
+
+def combined_digest(digests):
+    """Digest of the connection from the digests of its streams, as
+    {stream ID: hashlib object}: each ID and digest, in order of ID.
+    """
+    combined = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for stream_id in sorted(digests):
+        combined.update(struct.pack("!H", stream_id))
+        combined.update(digests[stream_id].digest())
+    return combined.digest()
+
+
+class StreamSender:
+    """Client side: the next offset of every stream, and the streams that
+    have ended. Keeps a digest per stream if digest is set.
+    """
+    def __init__(self, digest=False):
+        self._offsets = {}
+        self._ended = set()
+        self._digests = {} if digest else None
+
+
+    def frame(self, stream_id, data, end=False):
+        """The payload of a segment that carries data as the next piece of
+        stream_id, the last one if end is set.
+        """
+        if not 0 <= stream_id <= MAX_STREAM_ID:
+            raise ValueError("Stream IDs go from 0 to {}".format(MAX_STREAM_ID))
+        if stream_id in self._ended:
+            raise ValueError("Stream {} has ended".format(stream_id))
+        offset = self._offsets.get(stream_id, 0)
+        self._offsets[stream_id] = offset + len(data)
+        if end:
+            self._ended.add(stream_id)
+        if self._digests is not None:
+            self._digests.setdefault(stream_id, hashlib.blake2b(digest_size=DIGEST_SIZE)).update(data)
+        return STREAM_HEADER.pack(stream_id | (STREAM_FIN if end else 0), offset) + bytes(data)
+
+
+    def digest(self):
+        return combined_digest(self._digests)
+
+
+class StreamReassembler:
+    """Server side, network thread: the pieces that arrive, in whatever
+    order, put back in order per stream. Each new segment is given to
+    receive exactly once (duplicates are dropped before, see ReceiveStream),
+    so a piece is never seen twice.
+    """
+    def __init__(self, digest=False):
+        # {stream ID: offset of the next piece to hand on}
+        self._next = {}
+        # Pieces that arrived ahead of a missing one,
+        # {stream ID: {offset: (data, end of stream)}}
+        self._held = {}
+        self._digests = {} if digest else None
+
+
+    def receive(self, payload):
+        """Take the payload of a data segment. Returns what that lets us
+        hand on for its stream, as (stream ID, data, end of stream), or None.
+        The data is a copy: the segment's buffer can be reused right away.
+        """
+        if len(payload) < STREAM_HEADER.size:
+            # Not a piece (an empty FIN), or damaged beyond use
+            return None
+        word, offset = STREAM_HEADER.unpack_from(payload)
+        stream_id, end = word & MAX_STREAM_ID, bool(word & STREAM_FIN)
+        data = bytes(payload[STREAM_HEADER.size:])
+        expected = self._next.get(stream_id, 0)
+        if offset != expected:
+            if offset > expected:
+                self._held.setdefault(stream_id, {})[offset] = (data, end)
+            return None
+
+        # Pieces we already had can follow until we miss one again
+        pieces = [data]
+        offset += len(data)
+        held = self._held.get(stream_id)
+        while held and not end and offset in held:
+            data, end = held.pop(offset)
+            pieces.append(data)
+            offset += len(data)
+        self._next[stream_id] = offset
+        if end:
+            self._held.pop(stream_id, None)
+        data = b''.join(pieces)
+        if self._digests is not None:
+            self._digests.setdefault(stream_id, hashlib.blake2b(digest_size=DIGEST_SIZE)).update(data)
+        return stream_id, data, end
+
+
+    def digest(self):
+        return combined_digest(self._digests)
+
+
+class StreamReader:
+    """Server side, application thread: what the network thread handed on
+    (items in ring, as put by the server's deliver), sorted per stream.
+    """
+    def __init__(self, ring):
+        self._ring = ring
+        # {stream ID: [data]} not read yet
+        self._buffers = {}
+        self._ended = set()
+        # Streams with data or an end not returned yet, first come first
+        self._ready = collections.OrderedDict()
+
+
+    def pull(self):
+        """Sort everything waiting in the ring. Returns whether there was any."""
+        items = self._ring.get_many()
+        for (stream_id, data, end), _ in items:
+            if data:
+                self._buffers.setdefault(stream_id, []).append(data)
+            if end:
+                self._ended.add(stream_id)
+            self._ready.setdefault(stream_id)
+        return len(items) > 0
+
+
+    def has(self, stream_id):
+        """Whether read(stream_id) has something to return: data, or the end."""
+        return stream_id in self._ready or stream_id in self._ended
+
+
+    def ready(self):
+        """The stream read_any would return, or None."""
+        return next(iter(self._ready), None)
+
+
+    def read(self, stream_id):
+        """The data of stream_id that arrived so far, b'' if it has ended
+        (or nothing arrived, see has).
+        """
+        data = b''.join(self._buffers.pop(stream_id, ()))
+        self._ready.pop(stream_id, None)
+        if data and stream_id in self._ended:
+            # Its end comes with the next read
+            self._ready[stream_id] = None
+        return data
+
+
+    def read_any(self):
+        """(stream ID, data) of the stream that has been waiting longest,
+        with b'' as data when it has ended; None if nothing is waiting.
+        """
+        stream_id = self.ready()
+        if stream_id is None:
+            return None
+        return stream_id, self.read(stream_id)
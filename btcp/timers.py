@@ -0,0 +1,104 @@
+"""Deadline based timers for the network thread.
+
+The lossy layer owns one TimerService. bTCP schedules callbacks on it (from
+either thread) and the network thread runs them once their deadline passes,
+whether or not segments keep arriving in the meantime.
+"""
+
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+    """Handle for a scheduled callback. Cancelling is cheap: the entry stays
+    in the heap and is skipped when it comes up.
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def active(self):
+        return not self.cancelled
+
+
+class TimerService:
+    """Min-heap of Timers ordered by deadline (time.monotonic seconds).
+
+    schedule and cancel may be called from any thread. run_expired is only
+    called from the network thread, and calls the callbacks there, so they can
+    touch the same state as lossy_layer_segment_received without locking.
+
+    on_schedule is called (outside the lock) when a new timer becomes the
+    earliest one, so the network thread can be woken up to shorten its wait.
+    clock replaces time.monotonic, e.g. with the virtual clock of a simulation.
+    """
+    def __init__(self, on_schedule=None, clock=time.monotonic):
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._on_schedule = on_schedule
+        self._clock = clock
+
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) in the network thread after delay seconds.
+        Returns a Timer that can be cancelled.
+        """
+        return self.schedule_at(self._clock() + delay, callback, *args)
+
+
+    def schedule_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, next(self._counter), timer))
+            earliest = self._heap[0][2] is timer
+        if earliest and self._on_schedule is not None:
+            self._on_schedule()
+        return timer
+
+
+    @staticmethod
+    def cancel(timer):
+        """Cancel a timer; None and already fired timers are ignored."""
+        if timer is not None:
+            timer.cancel()
+
+
+    def next_deadline(self):
+        """Deadline of the earliest pending timer, or None."""
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+
+    def run_expired(self, now=None):
+        """Run every timer whose deadline has passed, in deadline order.
+        Timers scheduled by these callbacks run in the same call if they are
+        already due. Returns the number of callbacks run.
+        """
+        if now is None:
+            now = self._clock()
+        ran = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return ran
+                timer = heapq.heappop(self._heap)[2]
+            if timer.cancelled:
+                continue
+            # Mark as done so a late cancel (or a check of .active) is harmless
+            timer.cancelled = True
+            timer.callback(*timer.args)
+            ran += 1
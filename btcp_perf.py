@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import signal
+import sys
+import threading
+import time
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.impairment import NetworkImpairment
+from btcp.instrumentation import LatencyHistogram
+from btcp.constants import PAYLOAD_SIZE, MAX_PAYLOAD_SIZE
+from btcp.payload import parse_size
+from btcp.backends import BACKENDS
+
+"""btcp-perf measures bTCP end to end, in the manner of iperf. Start a server,
+then run clients against it:
+
+    python3 btcp_perf.py server
+    python3 btcp_perf.py client -T 10             bulk data for 10 seconds
+    python3 btcp_perf.py client -g 256M -m 16384  bulk data, 256 MiB
+    python3 btcp_perf.py client --ping 1000       1000 round trips of 64 bytes
+    python3 btcp_perf.py client --backend shm     over shared memory (both ends)
+
+Bulk data is synthetic, so no disk is involved on either end. Both ends
+report every interval and at the end: goodput, and the CPU time the process
+spent per MB. The client adds the retransmission rate and the round trip
+times of its data segments (or of the messages, with --ping). With --json
+the report is one JSON object instead.
+
+The client names the connection after the test, so the server knows whether
+to count the data or echo it. run_client and run_server take the network
+argument of the sockets, so both ends can also run in a Simulation (see
+btcp/simulation.py).
+"""
+
+
+BULK_NAME = "btcp-perf bulk"
+PING_NAME = "btcp-perf ping"
+BLOCK_SIZE = 64 * 1024
+
+
+class SyntheticData:
+    """Read-only file-like object of size bytes, or of as many as are read
+    within duration seconds of the first read. All reads return (part of)
+    the same block, so producing the data costs next to nothing.
+    """
+    def __init__(self, size=None, duration=None):
+        self._block = bytes(range(256)) * (BLOCK_SIZE // 256)
+        self._left = size
+        self._duration = duration
+        self._deadline = None
+        self.bytes_read = 0
+
+
+    def read(self, n=-1):
+        if self._deadline is None and self._duration is not None:
+            self._deadline = time.monotonic() + self._duration
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            return b''
+        if n is None or n < 0 or n > BLOCK_SIZE:
+            n = BLOCK_SIZE
+        if self._left is not None:
+            n = min(n, self._left)
+            self._left -= n
+        self.bytes_read += n
+        return self._block[:n]
+
+
+class Report:
+    """Measurements of one test. sample returns the cumulative counters:
+    bytes, and for the client data segments sent and retransmitted. Every
+    interval seconds the change since the last interval is printed (unless
+    the report is JSON), and finish prints the whole test. Reports go to
+    output.
+    """
+    def __init__(self, role, test, sample, interval, as_json, output=sys.stdout):
+        self.role = role
+        self.test = test
+        self._sample = sample
+        self._interval = interval
+        self._as_json = as_json
+        self._output = output
+        self.intervals = []
+        self._start = time.monotonic()
+        self._cpu_start = time.process_time()
+        self._last = (self._start, self._cpu_start, sample())
+        self._stop = threading.Event()
+        self._thread = None
+        if interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._record()
+
+
+    def _record(self):
+        now, cpu, counters = time.monotonic(), time.process_time(), self._sample()
+        then, cpu_then, before = self._last
+        self._last = (now, cpu, counters)
+        entry = self.measure(then - self._start, now - self._start, cpu - cpu_then,
+                             [c - b for c, b in zip(counters, before)])
+        self.intervals.append(entry)
+        if not self._as_json:
+            print(self.line(entry), file=self._output, flush=True)
+
+
+    @staticmethod
+    def measure(start, end, cpu, counters):
+        length = max(end - start, 1e-9)
+        entry = dict(start=round(start, 3), end=round(end, 3), bytes=counters[0],
+                     goodput_mbit=counters[0] * 8 / length / 1e6,
+                     cpu_ms_per_mb=cpu * 1000 / (counters[0] / 1e6) if counters[0] else None)
+        if len(counters) > 2:
+            entry.update(segments=counters[1], retransmissions=counters[2],
+                         retransmission_rate=counters[2] / counters[1] if counters[1] else 0.0)
+        return entry
+
+
+    @staticmethod
+    def line(entry):
+        text = "[{:7.2f}-{:7.2f} s] {:10.2f} MB {:10.2f} Mbit/s".format(
+            entry['start'], entry['end'], entry['bytes'] / 1e6, entry['goodput_mbit'])
+        if 'retransmissions' in entry:
+            text += "  retransmitted {:6.2%} ({}/{})".format(
+                entry['retransmission_rate'], entry['retransmissions'], entry['segments'])
+        if entry['cpu_ms_per_mb'] is not None:
+            text += "  cpu {:.1f} ms/MB".format(entry['cpu_ms_per_mb'])
+        return text
+
+
+    def finish(self, rtt=None, **extra):
+        """Stop the intervals and print the total, with the percentiles of
+        the LatencyHistogram rtt (if any) and the extra items.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        total = self.measure(0, time.monotonic() - self._start, time.process_time() - self._cpu_start,
+                             self._sample())
+        if rtt is not None and rtt.count:
+            total['rtt_ms'] = {name: rtt.percentile(p) / 1e6 for name, p in
+                               (("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9))}
+            total['rtt_ms'].update(mean=rtt.mean() / 1e6, max=rtt.max / 1e6, count=rtt.count)
+        total.update(extra)
+        if self._as_json:
+            print(json.dumps(dict(role=self.role, test=self.test, total=total, intervals=self.intervals)),
+                  file=self._output, flush=True)
+            return
+        print("{} {} total:".format(self.role, self.test), file=self._output)
+        print(self.line(total), file=self._output)
+        if 'rtt_ms' in total:
+            rtt_ms = total['rtt_ms']
+            print("  rtt: " + "  ".join("{} {:.3f} ms".format(name, rtt_ms[name])
+                                        for name in ("p50", "p90", "p99", "p99.9", "mean", "max"))
+                  + "  ({} samples)".format(rtt_ms['count']), file=self._output)
+        for name, value in extra.items():
+            print("  {}: {}".format(name, value), file=self._output)
+        self._output.flush()
+
+
+def impairment_from(args, seed):
+    if not args.netem:
+        return None
+    return NetworkImpairment.from_netem(args.netem, seed=seed)
+
+
+def run_client(args, output, network=None):
+    s = BTCPClientSocket(args.window, args.timeout, impairment=impairment_from(args, args.seed),
+                         mss=args.mss, digest=args.digest, network=network, backend=args.backend)
+    if args.ping:
+        rtt = LatencyHistogram("ping")
+        report = Report("client", "ping", lambda: (rtt.count * args.ping_size, s.segments_sent, s.retransmissions),
+                        args.interval, args.json, output)
+        s.connect(name=PING_NAME)
+        message = b'p' * args.ping_size
+        for _ in range(args.ping):
+            start = time.perf_counter_ns()
+            s.send(io.BytesIO(message))
+            echoed = 0
+            while echoed < len(message):
+                data = s.recv()
+                if len(data) == 0:
+                    sys.exit("The server closed the connection")
+                echoed += len(data)
+            rtt.record(time.perf_counter_ns() - start)
+        s.shutdown()
+        report.finish(rtt, messages=rtt.count, message_size=args.ping_size)
+    else:
+        s.rtt_histogram = LatencyHistogram("rtt")
+        source = SyntheticData(args.generate, args.duration)
+        report = Report("client", "bulk", lambda: (source.bytes_read, s.segments_sent, s.retransmissions),
+                        args.interval, args.json, output)
+        s.connect(name=BULK_NAME)
+        s.send(source)
+        # Only returns once the server has acknowledged everything
+        s.shutdown()
+        report.finish(s.rtt_histogram, mss=s.mss)
+    s.close()
+
+
+def serve_connection(s, args, output):
+    received = [0]
+    test = "ping" if s.transfer_name == PING_NAME else "bulk"
+    report = Report("server", test, lambda: (received[0],), args.interval, args.json, output)
+    while True:
+        data = s.recv()
+        if len(data) == 0:
+            break
+        received[0] += len(data)
+        if test == "ping":
+            s.send(io.BytesIO(data))
+    extra = {}
+    if s.transfer_verified is not None:
+        extra['verified'] = s.transfer_verified
+    report.finish(**extra)
+
+
+def run_server(args, output, network=None):
+    s = BTCPServerSocket(args.window, args.timeout, impairment=impairment_from(args, args.seed + 1),
+                         mss=args.mss, network=network, backend=args.backend)
+    try:
+        while True:
+            s.accept()
+            serve_connection(s, args, output)
+            if args.one_off:
+                break
+    except KeyboardInterrupt:
+        pass
+    s.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure bTCP throughput and latency")
+    parser.add_argument("role", choices=("server", "client"))
+    parser.add_argument("-w", "--window",
+                        help="Define bTCP window size",
+                        type=int, default=100)
+    parser.add_argument("-t", "--timeout",
+                        help="Define bTCP timeout in milliseconds",
+                        type=int, default=100)
+    parser.add_argument("-m", "--mss",
+                        help="Payload size per segment: the client asks for it, the server accepts up to it",
+                        type=int, default=None)
+    parser.add_argument("-g", "--generate",
+                        help="Client: bytes of bulk data to send, e.g. 256M",
+                        type=parse_size, default=None)
+    parser.add_argument("-T", "--duration",
+                        help="Client: seconds to send bulk data for (default 10, unless --generate is given)",
+                        type=float, default=None)
+    parser.add_argument("--ping",
+                        help="Client: measure this many round trips of small messages instead",
+                        type=int, default=None)
+    parser.add_argument("--ping-size",
+                        help="Client: bytes per --ping message",
+                        type=int, default=64)
+    parser.add_argument("-d", "--digest",
+                        help="Client: offer a transfer digest instead of per-segment checksums",
+                        action="store_true")
+    parser.add_argument("-i", "--interval",
+                        help="Seconds between interim reports, 0 for none",
+                        type=float, default=1.0)
+    parser.add_argument("-J", "--json",
+                        help="Report as one JSON object",
+                        action="store_true")
+    parser.add_argument("-1", "--one-off",
+                        help="Server: exit after one test",
+                        action="store_true")
+    parser.add_argument("-n", "--netem",
+                        help="Emulate a netem profile in userspace, e.g. 'loss 1%% delay 10ms'",
+                        default=None)
+    parser.add_argument("-s", "--seed",
+                        help="Seed for the userspace network emulation",
+                        type=int, default=1)
+    parser.add_argument("--backend",
+                        help="Datagram transport: udp, or unix or shm when both ends run on this host",
+                        choices=sorted(BACKENDS), default="udp")
+    args = parser.parse_args(argv)
+    if args.mss is None:
+        args.mss = MAX_PAYLOAD_SIZE if args.role == "server" else PAYLOAD_SIZE
+    if args.generate is None and args.duration is None:
+        args.duration = 10.0
+    return args
+
+
+def btcp_perf():
+    args = parse_args()
+
+    # Keep what the sockets print out of the JSON
+    output = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        if args.role == "server":
+            # Stop on SIGTERM as well as on Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            run_server(args, output)
+        else:
+            run_client(args, output)
+
+
+if __name__ == "__main__":
+    btcp_perf()
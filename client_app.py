@@ -3,19 +3,72 @@
 # TEST
 
 import argparse
+import io
+import os
 from btcp.client_socket import BTCPClientSocket
+from btcp.impairment import NetworkImpairment, parse_rate
+from btcp.constants import PAYLOAD_SIZE, SEND_BUFFER_SIZE
+from btcp.payload import GeneratedPayload, parse_size
+from btcp.delta import DeltaEncoder, Signature
+from btcp.backends import BACKENDS
 
-"""This exposes a constant bytes object called TEST_BYTES_128MIB which, as the
-name suggests, is 128 MiB in size. You can send it, receive it, and check it
-for equality on the receiving end.
+"""Large test transfers do not need a file: --generate sends a deterministic
+payload of any size, produced on the fly (see btcp/payload.py). Run the server
+with --verify and the same size and seed to check it on the receiving end.
 
-Pycharm may complain about an unresolved reference. This is a lie. It simply
-cannot deal with a python source file this large so it cannot resolve the
-reference. Python itself will run it fine, though.
-
-You can also use the file large_input.py as-is for file transfer.
+With --streams all input files go over a single connection, each on a stream
+of its own (see btcp/streams.py) that starts with the file's name and a
+newline, so the server knows where to store it.
 """
-# from large_input import TEST_BYTES_128MIB
+
+
+# Bytes of one file sent before it is the next file's turn
+STREAM_TURN = 64 * 1024
+
+
+def transfer_id(path):
+    """ID under which the server checkpoints the transfer of a file, so a
+    later run can resume it. It changes when the file does.
+    """
+    stat = os.stat(path)
+    return "{}-{}-{}".format(stat.st_size, stat.st_mtime_ns, os.path.basename(path))
+
+
+def send_delta(s, f):
+    """Send the delta of the file f against the server's copy, whose
+    signature the server sends first.
+    """
+    received = b''
+    signature = None
+    while signature is None:
+        data = s.recv()
+        if len(data) == 0:
+            print("Connection closed before the server sent its signature")
+            return
+        received += data
+        signature, _ = Signature.decode(received)
+    delta = DeltaEncoder(f, signature)
+    s.send(delta)
+    print("Delta: {} bytes sent, {} bytes reused".format(delta.literal_bytes, delta.copied_bytes))
+
+
+def send_streams(s, paths):
+    """Send the files at paths over the current connection, each on a
+    stream of its own, starting with its name and a newline. The files take
+    turns, so a lost segment of one does not hold up the others.
+    """
+    files = []
+    for stream_id, path in enumerate(paths):
+        files.append(open(path, 'rb'))
+        s.send(io.BytesIO(os.path.basename(path).encode('utf-8') + b'\n'), stream=stream_id)
+    active = list(range(len(files)))
+    while active:
+        for stream_id in list(active):
+            block = files[stream_id].read(STREAM_TURN)
+            s.send(io.BytesIO(block), stream=stream_id, end=len(block) < STREAM_TURN)
+            if len(block) < STREAM_TURN:
+                files[stream_id].close()
+                active.remove(stream_id)
 
 
 def btcp_file_transfer_client():
@@ -31,21 +84,120 @@ def btcp_file_transfer_client():
                         help="Define bTCP timeout in milliseconds",
                         type=int, default=100)
     parser.add_argument("-i", "--input",
-                        help="File to send",
-                        default="large_input.py")
+                        help="File(s) to send, one connection each (unless --streams), reusing the same socket",
+                        nargs="+", default=None)
+    parser.add_argument("-f", "--fast-open",
+                        help="Send the start of each transfer in the SYN",
+                        action="store_true")
+    parser.add_argument("-g", "--generate",
+                        help="Send a generated payload of this size (e.g. 128M) instead of files. This is the default, with 128M",
+                        type=parse_size, default=None)
+    parser.add_argument("--payload-seed",
+                        help="Seed of the generated payload",
+                        type=int, default=0)
+    parser.add_argument("-n", "--netem",
+                        help="Emulate a bad network in userspace, using tc netem arguments, e.g. \"loss 10%% 25%%\"",
+                        default=None)
+    parser.add_argument("-s", "--seed",
+                        help="Seed for the --netem random number generator",
+                        type=int, default=None)
+    parser.add_argument("-c", "--compress",
+                        help="Offer zlib stream compression at this level (0-9)",
+                        type=int, default=None, choices=range(10))
+    parser.add_argument("-m", "--mss",
+                        help="Payload size per segment to ask the server for, in bytes",
+                        type=int, default=PAYLOAD_SIZE)
+    parser.add_argument("-d", "--digest",
+                        help="Skip segment checksums and check a digest of the whole transfer instead, for trusted paths",
+                        action="store_true")
+    parser.add_argument("-r", "--rate",
+                        help="Pace sending at this rate, netem style (e.g. 20mbit), or 'auto' to follow window / round trip time",
+                        type=lambda text: text if text == "auto" else parse_rate(text), default=None)
+    parser.add_argument("--fec",
+                        help="Send a parity segment per this many data segments (1-255), or 'auto' to follow the loss rate",
+                        type=lambda text: text if text == "auto" else int(text), default=None)
+    parser.add_argument("--resume",
+                        help="Continue where an earlier run of the same transfer was cut off, if the server kept a checkpoint",
+                        action="store_true")
+    parser.add_argument("--delta",
+                        help="Only send what differs from the server's copy of each file, rsync style",
+                        action="store_true")
+    parser.add_argument("-j", "--workers",
+                        help="Prepare the segments of large input files in this many processes",
+                        type=int, default=None)
+    parser.add_argument("-b", "--send-buffer",
+                        help="Bytes of segments to build ahead of the window, e.g. 256K",
+                        type=parse_size, default=SEND_BUFFER_SIZE)
+    parser.add_argument("--backend",
+                        help="Datagram transport: udp, or unix or shm with a server on this host using the same",
+                        choices=sorted(BACKENDS), default="udp")
+    parser.add_argument("--streams",
+                        help="Send all input files over one connection, a stream each",
+                        action="store_true")
     args = parser.parse_args()
+    if args.streams and (args.input is None or args.resume or args.delta or args.fast_open):
+        parser.error("--streams sends input files, and cannot be combined with --resume, --delta or --fast-open")
+    if args.delta and (args.resume or args.fast_open):
+        parser.error("--delta cannot be combined with --resume or --fast-open")
+    if args.fec not in (None, "auto") and not 1 <= args.fec <= 255:
+        parser.error("--fec takes 1 to 255 segments per parity segment")
+
+    impairment = None
+    if args.netem:
+        impairment = NetworkImpairment.from_netem(args.netem, seed=args.seed)
 
     # Create a bTCP client socket with the given window size and timeout value
-    s = BTCPClientSocket(args.window, args.timeout)
+    s = BTCPClientSocket(args.window, args.timeout, impairment=impairment,
+                         compress_level=args.compress, mss=args.mss, pacing_rate=args.rate,
+                         digest=args.digest, fec=args.fec, workers=args.workers,
+                         send_buffer_size=args.send_buffer, backend=args.backend)
     
     # TODO Write your file transfer client code using your implementation of
     # BTCPClientSocket's connect, send, and disconnect methods.
-    s.connect()
-    f = open(args.input)
-    s.send(f)
-    s.shutdown()
+    if args.input is None:
+        size = args.generate if args.generate is not None else 128 << 20
+        payload = GeneratedPayload(size, args.payload_seed)
+        name = "generated-{}-{}".format(size, args.payload_seed)
+        s.connect(name=name,
+                  data=payload.read(PAYLOAD_SIZE) if args.fast_open else b'',
+                  transfer_id=name if args.resume else None, delta=args.delta)
+        payload.seek(max(payload.tell(), s.resume_offset))
+        if s.delta:
+            send_delta(s, payload)
+        else:
+            s.send(payload)
+        s.shutdown()
+        s.close()
+        return
+
+    if args.streams:
+        s.connect(name="streams", streams=True)
+        if s.streams is None:
+            # The server takes a single stream: one connection per file after all
+            s.shutdown()
+            print("The server does not take streams")
+        else:
+            send_streams(s, args.input)
+            s.shutdown()
+            s.close()
+            return
+
+    for path in args.input:
+        f = open(path, 'rb')
+        s.connect(name=os.path.basename(path),
+                  data=f.read(PAYLOAD_SIZE) if args.fast_open else b'',
+                  transfer_id=transfer_id(path) if args.resume else None, delta=args.delta)
+        # The stream starts where the server has it up to
+        if s.resume_offset > 0:
+            print("Resuming {} at byte {}".format(path, s.resume_offset))
+            f.seek(max(f.tell(), s.resume_offset))
+        if s.delta:
+            send_delta(s, f)
+        else:
+            s.send(f)
+        s.shutdown()
+        f.close()
     # Clean up any state
-    f.close()
     s.close()
 
 
@@ -1,19 +1,213 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
+import os
+import signal
+import sys
 from btcp.server_socket import BTCPServerSocket
+from btcp.impairment import NetworkImpairment
+from btcp.constants import MAX_PAYLOAD_SIZE
+from btcp.payload import StreamDigest, payload_digest, parse_size
+from btcp.checkpoint import Checkpoint, CheckpointedOutput, find_checkpoints
+from btcp.delta import DeltaPatcher, file_signature
+from btcp.backends import BACKENDS
 
-"""This exposes a constant bytes object called TEST_BYTES_128MIB which, as the
-name suggests, is 128 MiB in size. You can send it, receive it, and check it
-for equality on the receiving end.
+"""Large test transfers do not need a file: with --verify the server checks a
+generated payload (see btcp/payload.py) against a streaming digest instead of
+storing it. The client sends one with --generate.
 
-Pycharm may complain about an unresolved reference. This is a lie. It simply
-cannot deal with a python source file this large so it cannot resolve the
-reference. Python itself will run it fine, though.
+With --resume the server keeps a checkpoint next to every output file (see
+btcp/checkpoint.py), so a client that runs again after a transfer was cut off
+only sends what is missing. A client that sends with --delta only sends what
+differs from the file the server already has (see btcp/delta.py).
 
-You can also use the file large_input.py as-is for file transfer.
+A client that sends several files with --streams sends them over one
+connection, a stream each (see btcp/streams.py). Every stream starts with
+the file's name and a newline, and is stored as a transfer of its own.
 """
-# from large_input import TEST_BYTES_128MIB
+
+
+def output_path(template, number, name):
+    """Where to store transfer number (counting from 0) of a persistent
+    server. The template may use {n} and {name}, the latter being the file
+    name the client sent (without any directories). A template without
+    either gets the number appended.
+    """
+    name = os.path.basename(name or "") or "transfer-{}".format(number)
+    path = template.format(n=number, name=name)
+    if path == template:
+        path = "{}.{}".format(template, number)
+    return path
+
+
+def digest_ok(s):
+    """After the end of a transfer: False if the client protected it with a
+    digest (instead of segment checksums) and that did not match.
+    """
+    if s.transfer_verified is False:
+        print("Transfer digest mismatch: the data was damaged on the way", file=sys.stderr)
+        return False
+    return True
+
+
+def resume_function(checkpoints):
+    """The server socket's resume function: where to continue the transfer
+    with an ID, according to checkpoints (by transfer ID).
+    """
+    def resume(transfer_id):
+        checkpoint = checkpoints.get(transfer_id)
+        return 0 if checkpoint is None else checkpoint.usable_offset()
+    return resume
+
+
+def transfer_checkpoint(s, checkpoints, path):
+    """Where to store the transfer of the current connection, and the
+    checkpoint to record it in (None if the client cannot resume it). A
+    resumed transfer continues in its earlier output file.
+    """
+    if s.transfer_id is None:
+        return path, None
+    checkpoint = checkpoints.get(s.transfer_id)
+    if checkpoint is None or s.resume_offset == 0:
+        checkpoint = Checkpoint(path, s.transfer_id)
+        checkpoints[s.transfer_id] = checkpoint
+    else:
+        print("Resuming {} at byte {}".format(checkpoint.output, s.resume_offset))
+    return checkpoint.output, checkpoint
+
+
+def receive_file(s, path, checkpoint=None):
+    """Write everything received on the current connection to path. With a
+    checkpoint the stream starts at s.resume_offset, and how far it got is
+    recorded; that is kept if the connection was aborted.
+    Returns whether the transfer completed and its digest, if any, matched.
+    """
+    if checkpoint is None:
+        f = open(path, 'wb')
+    else:
+        f = CheckpointedOutput(checkpoint, s.resume_offset)
+    while(True):
+        data = s.recv()
+        if(len(data)> 0):
+            f.write(data)
+
+        if len(data) == 0:
+            break
+    if checkpoint is None:
+        f.close()
+    else:
+        # Only an aborted transfer keeps its checkpoint, one that arrived
+        # damaged starts over next time
+        f.close(complete=not s.aborted)
+    if s.aborted:
+        print("Transfer incomplete: the client went silent", file=sys.stderr)
+        return False
+    return digest_ok(s)
+
+
+def receive_streams(s, template, first):
+    """Write every stream of the current connection to a file of its own,
+    stream n to output_path(template, first + n, its name), as the streams
+    come in. Returns whether all of them completed and the digest, if any,
+    matched, and how many streams there were.
+    """
+    # {stream ID: open file}, or the bytes so far while its name is incomplete
+    outputs = {}
+    ended = set()
+    while True:
+        stream_id, data = s.recv_stream()
+        if stream_id is None:
+            break
+        if len(data) == 0:
+            ended.add(stream_id)
+            output = outputs.get(stream_id, b'')
+            if isinstance(output, bytes):
+                # Ended before its name did: store what there is
+                path = output_path(template, first + stream_id, None)
+                with open(path, 'wb') as f:
+                    f.write(output)
+                outputs[stream_id] = output = f
+            output.close()
+            print("Stored transfer {} in {}".format(first + stream_id, output.name))
+            continue
+        output = outputs.get(stream_id, b'')
+        if isinstance(output, bytes):
+            output += data
+            if b'\n' not in output:
+                outputs[stream_id] = output
+                continue
+            name, data = output.split(b'\n', 1)
+            path = output_path(template, first + stream_id, name.decode('utf-8', 'replace'))
+            output = outputs[stream_id] = open(path, 'wb')
+        output.write(data)
+    for stream_id, output in outputs.items():
+        if stream_id not in ended and not isinstance(output, bytes):
+            output.close()
+    if s.aborted or len(ended) < len(outputs):
+        print("Transfer incomplete: {} of {} streams ended".format(len(ended), len(outputs)), file=sys.stderr)
+        return False, len(outputs)
+    return digest_ok(s), len(outputs)
+
+
+def receive_delta(s, path):
+    """Send the signature of the current version of path, then rebuild
+    the new version from the delta received on the current connection. It
+    replaces the old one only once it is complete.
+    Returns whether it completed and the transfer digest, if any, matched.
+    """
+    signature = file_signature(path)
+    s.send(io.BytesIO(signature.encode()))
+
+    old = open(path, 'rb') if os.path.exists(path) else None
+    temporary = path + ".delta"
+    f = open(temporary, 'wb')
+    patcher = DeltaPatcher(old, signature.block_size, f)
+    ok = True
+    while(True):
+        data = s.recv()
+        if len(data) == 0:
+            break
+        # After an error keep reading, so the connection ends normally
+        if ok:
+            try:
+                patcher.feed(data)
+            except ValueError as e:
+                print("Bad delta: {}".format(e), file=sys.stderr)
+                ok = False
+    f.close()
+    if old is not None:
+        old.close()
+
+    if s.aborted:
+        print("Transfer incomplete: the client went silent", file=sys.stderr)
+    ok = ok and not s.aborted and patcher.complete() and digest_ok(s)
+    if ok:
+        os.replace(temporary, path)
+        print("Delta applied: {} bytes sent, {} bytes reused".format(patcher.literal_bytes, patcher.copied_bytes))
+    else:
+        os.remove(temporary)
+    return ok
+
+
+def receive_verified(s, expected, size):
+    """Digest everything received on the current connection and compare it
+    with the expected digest of a generated payload of size bytes.
+    Returns whether they match.
+    """
+    digest = StreamDigest()
+    while(True):
+        data = s.recv()
+        if len(data) == 0:
+            break
+        digest.update(data)
+    if not digest_ok(s):
+        return False
+    if digest.length != size or digest.hexdigest() != expected:
+        print("Payload mismatch: received {} bytes, digest {}".format(digest.length, digest.hexdigest()))
+        return False
+    print("Payload verified: {} bytes".format(size))
+    return True
 
 
 def btcp_file_transfer_server():
@@ -29,28 +223,130 @@ def btcp_file_transfer_server():
                         help="Define bTCP timeout in milliseconds",
                         type=int, default=100)
     parser.add_argument("-o", "--output",
-                        help="Where to store the file",
+                        help="Where to store the file. With --persistent a template, see output_path",
                         default="output.file")
+    parser.add_argument("-p", "--persistent",
+                        help="Keep accepting transfers, each to its own file, until interrupted",
+                        action="store_true")
+    parser.add_argument("-n", "--netem",
+                        help="Emulate a bad network in userspace, using tc netem arguments, e.g. \"loss 10%% 25%%\"",
+                        default=None)
+    parser.add_argument("-s", "--seed",
+                        help="Seed for the --netem random number generator",
+                        type=int, default=None)
+    parser.add_argument("--no-compression",
+                        help="Refuse stream compression offered by the client",
+                        action="store_true")
+    parser.add_argument("--no-fast-open",
+                        help="Refuse data in the client's SYN",
+                        action="store_true")
+    parser.add_argument("--no-digest",
+                        help="Refuse to replace segment checksums by a transfer digest",
+                        action="store_true")
+    parser.add_argument("-m", "--mss",
+                        help="Largest payload size per segment to accept, in bytes",
+                        type=int, default=MAX_PAYLOAD_SIZE)
+    parser.add_argument("--resume",
+                        help="Keep checkpoints next to the output, so clients can resume interrupted transfers",
+                        action="store_true")
+    parser.add_argument("--idle-timeout",
+                        help="Give up on a client that is silent this many seconds (default: 10 with --resume, never otherwise)",
+                        type=float, default=None)
+    parser.add_argument("--no-fec",
+                        help="Ignore parity segments, and have the client retransmit every lost segment",
+                        action="store_true")
+    parser.add_argument("--no-delta",
+                        help="Refuse deltas against the existing output, clients send whole files",
+                        action="store_true")
+    parser.add_argument("--verify",
+                        help="Check a generated payload of this size (e.g. 128M) instead of storing it",
+                        type=parse_size, default=None)
+    parser.add_argument("--payload-seed",
+                        help="Seed of the generated payload",
+                        type=int, default=0)
+    parser.add_argument("--backend",
+                        help="Datagram transport: udp, or unix or shm with clients on this host using the same",
+                        choices=sorted(BACKENDS), default="udp")
     args = parser.parse_args()
 
+    impairment = None
+    if args.netem:
+        impairment = NetworkImpairment.from_netem(args.netem, seed=args.seed)
+
+    # Checkpoints of interrupted transfers, by transfer ID. A generated
+    # payload is checked as a whole and cannot be resumed.
+    checkpoints = {}
+    resume = None
+    if args.resume and args.verify is None:
+        if args.persistent:
+            checkpoints = find_checkpoints(os.path.dirname(args.output))
+        else:
+            checkpoint = Checkpoint.load(args.output)
+            if checkpoint is not None:
+                checkpoints[checkpoint.transfer_id] = checkpoint
+        resume = resume_function(checkpoints)
+        if args.idle_timeout is None:
+            args.idle_timeout = 10
+
     # Create a bTCP server socket
-    s = BTCPServerSocket(args.window, args.timeout)
+    s = BTCPServerSocket(args.window, args.timeout, impairment=impairment,
+                         compression=not args.no_compression, mss=args.mss,
+                         fast_open=not args.no_fast_open, digest=not args.no_digest,
+                         resume=resume, idle_timeout=args.idle_timeout,
+                         delta=not args.no_delta and args.verify is None, fec=not args.no_fec,
+                         streams=args.verify is None, backend=args.backend)
     # TODO Write your file transfer server code here using your
     # BTCPServerSocket's accept, and recv methods.
 
 
-    f = open(args.output, 'w')
-    # Clean up any state
-    s.accept()
-    while(True):
-        data = s.recv()
-        if(len(data)> 0):
-            f.write(data.decode('utf-8'))
+    expected = None
+    if args.verify is not None:
+        expected = payload_digest(args.verify, args.payload_seed)
 
-        if len(data) == 0:
-            break
+    if not args.persistent:
+        s.accept()
+        if s.streams is not None:
+            ok, _ = receive_streams(s, args.output, 0)
+        elif s.delta:
+            ok = receive_delta(s, args.output)
+        elif expected is None:
+            ok = receive_file(s, *transfer_checkpoint(s, checkpoints, args.output))
+        else:
+            ok = receive_verified(s, expected, args.verify)
+        # Clean up any state
+        s.close()
+        sys.exit(0 if ok else 1)
 
-    f.close()
+    # Stop on SIGTERM as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    number = 0
+    try:
+        while(True):
+            s.accept()
+            if expected is not None:
+                receive_verified(s, expected, args.verify)
+            elif s.streams is not None:
+                _, count = receive_streams(s, args.output, number)
+                number += count
+                continue
+            elif s.delta:
+                path = output_path(args.output, number, s.transfer_name)
+                receive_delta(s, path)
+                print("Stored transfer {} in {}".format(number, path))
+            else:
+                path, checkpoint = transfer_checkpoint(
+                    s, checkpoints, output_path(args.output, number, s.transfer_name))
+                receive_file(s, path, checkpoint)
+                if checkpoint is not None and not s.aborted:
+                    del checkpoints[s.transfer_id]
+                print("Stored transfer {} in {}".format(number, path))
+            number += 1
+    except KeyboardInterrupt:
+        # A second signal must not interrupt the cleanup: the network thread
+        # would keep the process alive
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Clean up any state
     s.close()
 
 
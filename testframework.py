@@ -1,20 +1,39 @@
 import unittest
+import contextlib
 import filecmp
+import io
+import json
 import threading
-import time
 import sys
-
-"""This exposes a constant bytes object called TEST_BYTES_128MIB which, as the
-name suggests, is 128 MiB in size. You can send it, receive it, and check it
-for equality on the receiving end.
-
-Pycharm may complain about an unresolved reference. This is a lie. It simply
-cannot deal with a python source file this large so it cannot resolve the
-reference. Python itself will run it fine, though.
-
-You can also use the file large_input.py as-is for file transfer.
+import os
+import select
+import time
+import tempfile
+import zlib
+
+import btcp_perf
+from btcp.simulation import Simulation, simulate_transfer
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.impairment import NetworkImpairment
+from btcp.backends import open_backend
+from btcp.btcp_socket import BTCPSocket
+from btcp.checkpoint import Checkpoint, CheckpointedOutput, find_checkpoints
+from btcp.compression import ChunkCompressor, ChunkDecompressor
+from btcp.delta import DeltaEncoder, DeltaPatcher, Signature, MIN_BLOCK_SIZE
+from btcp.fec import FecEncoder, FecDecoder
+from btcp.pacing import TokenBucket, burst_size
+from btcp.presegment import ParallelSegmenter
+from btcp.ring import SPSCRing
+from btcp.send_window import SendWindow
+from btcp.streams import StreamSender, StreamReassembler
+from btcp.timers import TimerService
+
+"""Large transfers use a payload generated on the fly by the apps (see
+btcp/payload.py): the client sends it with --generate and the server checks it
+against a streaming digest with --verify, so nothing large is imported, stored
+or compared here. Set its size with --large-size, e.g. 128M.
 """
-from large_input import TEST_BYTES_128MIB
 
 
 INPUTFILE  = "testdata2.txt"
@@ -31,10 +50,13 @@ NETEM_LOSS    = "loss 10% 25%"
 NETEM_REORDER = "delay 20ms reorder 25% 50%"
 NETEM_DELAY   = "delay " + str(TIMEOUT) + "ms 20ms"
 NETEM_ALL     = "{} {} {} {}".format(NETEM_CORRUPT, NETEM_DUP, NETEM_LOSS, NETEM_REORDER)
+USERSPACE = False
+SEED = 1
+LARGE_SIZE = "1M"
 
 
-def run_command_with_output(command, input=None, cwd=None, shell=True):
-    """run command and retrieve output"""
+def run_command_with_output(command, input=None, cwd=None, shell=True, returncodes=None):
+    """run command and retrieve output, appending its exit code to returncodes if given"""
     import subprocess
     try:
         process = subprocess.Popen(command, cwd=cwd, shell=shell, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
@@ -47,6 +69,8 @@ def run_command_with_output(command, input=None, cwd=None, shell=True):
         print(stderrdata, file=sys.stderr)
         print("problem running command : \n   ", str(command), "\n return value: ", process.returncode, file=sys.stderr)
 
+    if returncodes is not None:
+        returncodes.append(process.returncode)
     return stdoutdata
 
 def run_command(command,cwd=None, shell=True):
@@ -73,15 +97,62 @@ class TestbTCPFramework(unittest.TestCase):
 
         This is an example test setup that uses the client and server process
         to test your application. Feel free to use a different test setup.
+
+        With --userspace, no tc rules are installed; instead the client and
+        server apps emulate the netem profile themselves (see btcp/impairment.py),
+        which needs no root and does not touch the loopback interface.
         """
         # default netem rule (does nothing)
-        run_command(NETEM_ADD)
-        
-        # launch localhost server
+        if not USERSPACE:
+            run_command(NETEM_ADD)
+        self._netem = None
+        self._server_thread = None
+        self._server_returncodes = []
+
+
+    def start_server(self, extra=""):
+        """launch localhost server, impaired the same way as the client"""
         self._server_thread = threading.Thread(target=run_command_with_output,
-                                               args=("python3 server_app.py -w {} -t {} -o {}".format(WINSIZE, TIMEOUT, OUTPUTFILE), ))
+                                               args=("python3 server_app.py -w {} -t {} -o {}{}{}".format(
+                                                   WINSIZE, TIMEOUT, OUTPUTFILE, self.netem_args(SEED + 1), extra), ),
+                                               kwargs={"returncodes": self._server_returncodes})
         self._server_thread.start()
-        
+
+
+    def set_netem(self, profile):
+        """apply one of the NETEM_* profiles to the network"""
+        if USERSPACE:
+            self._netem = profile
+        else:
+            run_command(NETEM_CHANGE.format(profile))
+
+
+    def netem_args(self, seed):
+        """extra app arguments for userspace impairment, if any"""
+        if self._netem is None:
+            return ""
+        return ' -n "{}" -s {}'.format(self._netem, seed)
+
+
+    def run_client(self, extra=""):
+        """launch localhost client connecting to server"""
+        self.start_server()
+        run_command_with_output("python3 client_app.py -w {} -t {} -i {}{}{}".format(
+            WINSIZE, TIMEOUT, INPUTFILE, self.netem_args(SEED), extra))
+        # the server exits as soon as it has the whole file, about one round
+        # trip after the client's shutdown, so wait for that instead of sleeping
+        self._server_thread.join(timeout=10)
+
+
+    def run_generated(self, size):
+        """send a generated payload of size (e.g. '128M') and return whether
+        the server verified it"""
+        self.start_server(" --verify {} --payload-seed {}".format(size, SEED))
+        run_command_with_output("python3 client_app.py -w {} -t {} -g {} --payload-seed {}{}".format(
+            WINSIZE, TIMEOUT, size, SEED, self.netem_args(SEED)))
+        self._server_thread.join()
+        return self._server_returncodes == [0]
+
 
     def tearDown(self):
         """Clean up after every test
@@ -90,7 +161,8 @@ class TestbTCPFramework(unittest.TestCase):
         to test your application. Feel free to use a different test setup.
         """
         # clean the environment
-        run_command(NETEM_DEL)
+        if not USERSPACE:
+            run_command(NETEM_DEL)
         
         # close server
         # no actual work to do for this for our given implementation:
@@ -98,6 +170,8 @@ class TestbTCPFramework(unittest.TestCase):
         # terminates; so the thread should terminate by itself after the client
         # application disconnects from the server. All we do is a simple check
         # to see whether the server actually terminates.
+        if self._server_thread is None:
+            return
         self._server_thread.join(timeout=10)
         if self._server_thread.is_alive():
             print("Something is keeping your server process alive. This may indicate a problem with shutting down.", file=sys.stderr)
@@ -112,12 +186,11 @@ class TestbTCPFramework(unittest.TestCase):
         # setup environment (nothing to set)
 
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
 
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE, shallow=False)
@@ -127,14 +200,13 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with bit flips 
         (which sometimes results in lower layer packet loss)"""
         # setup environment
-        run_command(NETEM_CHANGE.format(NETEM_CORRUPT))
+        self.set_netem(NETEM_CORRUPT)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
 
@@ -142,14 +214,13 @@ class TestbTCPFramework(unittest.TestCase):
     def test_duplicates_network(self):
         """reliability over network with duplicate packets"""
         # setup environment
-        run_command(NETEM_CHANGE.format(NETEM_DUP))
+        self.set_netem(NETEM_DUP)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
 
@@ -157,14 +228,13 @@ class TestbTCPFramework(unittest.TestCase):
     def test_lossy_network(self):
         """reliability over network with packet loss"""
         # setup environment
-        run_command(NETEM_CHANGE.format(NETEM_LOSS))
+        self.set_netem(NETEM_LOSS)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
 
@@ -172,14 +242,13 @@ class TestbTCPFramework(unittest.TestCase):
     def test_reordering_network(self):
         """reliability over network with packet reordering"""
         # setup environment
-        run_command(NETEM_CHANGE.format(NETEM_REORDER))
+        self.set_netem(NETEM_REORDER)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
 
@@ -187,14 +256,13 @@ class TestbTCPFramework(unittest.TestCase):
     def test_delayed_network(self):
         """reliability over network with delay relative to the timeout value"""
         # setup environment
-        run_command(NETEM_CHANGE.format(NETEM_DELAY))
+        self.set_netem(NETEM_DELAY)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
 
@@ -202,17 +270,614 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with all of the above problems"""
 
         # setup environment
-        #run_command(NETEM_CHANGE.format(NETEM_ALL))
+        #self.set_netem(NETEM_ALL)
         
         # launch localhost client connecting to server
-        run_command_with_output("python3 client_app.py -w {} -t {} -i {}".format(WINSIZE, TIMEOUT, INPUTFILE))
+        self.run_client()
         # client sends content to server
         
         # server receives content from client
-        time.sleep(1)
         # content received by server matches the content sent by client   
         assert filecmp.cmp(INPUTFILE, OUTPUTFILE)
   
+    def test_large_payload(self):
+        """reliability of a large generated payload over an ideal network"""
+        # launch localhost client sending a generated payload, which the
+        # server checks against its digest
+        assert self.run_generated(LARGE_SIZE)
+
+
+    def test_digest_ideal_network(self):
+        """reliability with a transfer digest instead of segment checksums"""
+        self.run_client(" --digest")
+        assert filecmp.cmp(INPUTFILE, OUTPUTFILE, shallow=False)
+        assert self._server_returncodes == [0]
+
+
+    def test_digest_flipping_network(self):
+        """without segment checksums, bit flips may damage the transfer, but
+        the digest must tell the server so"""
+        self.set_netem(NETEM_CORRUPT)
+        self.run_client(" --digest")
+        assert self._server_returncodes != [0] or filecmp.cmp(INPUTFILE, OUTPUTFILE, shallow=False)
+
+
+    def test_fec_lossy_network(self):
+        """reliability over network with packet loss, with parity segments
+        to rebuild lost segments"""
+        self.set_netem(NETEM_LOSS)
+        self.run_client(" --fec auto")
+        assert filecmp.cmp(INPUTFILE, OUTPUTFILE, shallow=False)
+
+
+    def test_streams_lossy_network(self):
+        """reliability of two files sent as streams of one connection over
+        network with packet loss; the server stores stream n in OUTPUTFILE.n"""
+        self.set_netem(NETEM_LOSS)
+        self.run_client(" --streams -i {} {}".format(INPUTFILE, INPUTFILE))
+        outputs = ["{}.{}".format(OUTPUTFILE, n) for n in range(2)]
+        try:
+            for output in outputs:
+                assert filecmp.cmp(INPUTFILE, output, shallow=False)
+            assert self._server_returncodes == [0]
+        finally:
+            for output in outputs:
+                if os.path.exists(output):
+                    os.remove(output)
+
+
+    def test_simulated_network(self):
+        """reliability over a simulated bad network, and the same outcome for
+        the same seed (see btcp/simulation.py)"""
+        runs = [simulate_transfer(1 << 20, WINSIZE, TIMEOUT, NETEM_ALL, seed=SEED) for _ in range(2)]
+        assert runs[0].verified
+        assert runs[0].duration == runs[1].duration
+        assert runs[0].client_stats.sent == runs[1].client_stats.sent
+
+
+    def test_simulated_recovery(self):
+        """a loss is resent about once, not once per few duplicate
+        acknowledgements of a full window"""
+        result = simulate_transfer(4 << 20, WINSIZE, TIMEOUT, "loss 1% delay 2ms", seed=SEED)
+        assert result.verified
+        segments = -(-(4 << 20) // 1008)
+        assert result.client_stats.sent < segments + 2 * result.dropped + 20
+
+    def test_simulated_send_not_held_back(self):
+        """what send hands over goes out at once, also when the application
+        then waits for something other than recv"""
+        simulation = Simulation()
+        server = BTCPServerSocket(WINSIZE, TIMEOUT, network=simulation.layer,
+                                  impairment=NetworkImpairment.from_netem("delay 5ms"))
+        client = BTCPClientSocket(WINSIZE, TIMEOUT, network=simulation.layer,
+                                  impairment=NetworkImpairment.from_netem("delay 5ms"))
+        received = []
+
+        def serve():
+            server.accept()
+            while True:
+                data = server.recv()
+                if len(data) == 0:
+                    break
+                received.append(data)
+            server.close()
+
+        def send():
+            client.connect()
+            client.send(io.BytesIO(b'x' * 2500))
+            sent_at = simulation.now()
+            arrived = simulation.wait_until(lambda: sum(map(len, received)) == 2500, 1.0)
+            waited = simulation.now() - sent_at
+            started = simulation.now()
+            client.shutdown()
+            client.close()
+            return arrived, waited, simulation.now() - started
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulation.spawn(serve)
+            sender = simulation.spawn(send)
+            simulation.run(60)
+        arrived, waited, closing = sender.result
+        assert arrived and waited < 0.01
+        assert closing < 0.015
+
+    def test_simulated_request_response(self):
+        """the server reads a whole request up to the client's FIN, takes its
+        time, and then answers over the half-closed connection"""
+        simulation = Simulation()
+        netem = "loss 10% delay 5ms"
+        server = BTCPServerSocket(WINSIZE, TIMEOUT, network=simulation.layer,
+                                  impairment=NetworkImpairment.from_netem(netem, seed=SEED))
+        client = BTCPClientSocket(WINSIZE, TIMEOUT, network=simulation.layer,
+                                  impairment=NetworkImpairment.from_netem(netem, seed=SEED + 1))
+        request = bytes(range(256)) * 200
+
+        def read_all(sock):
+            data = b''
+            while True:
+                block = sock.recv()
+                if len(block) == 0:
+                    return data
+                data += block
+
+        def serve():
+            server.accept()
+            received = read_all(server)
+            simulation.wait_until(lambda: False, 1.0)
+            server.send(io.BytesIO(received[::-1]))
+            server.shutdown()
+            with self.assertRaises(ValueError):
+                server.send(io.BytesIO(b'late'))
+            server.close()
+            return received
+
+        def ask():
+            client.connect()
+            client.send(io.BytesIO(request))
+            client.shutdown()
+            answer = read_all(client)
+            client.close()
+            return answer
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            server_actor = simulation.spawn(serve)
+            client_actor = simulation.spawn(ask)
+            simulation.run(60)
+        assert server_actor.result == request
+        assert client_actor.result == request[::-1]
+
+    def test_simulated_damaged_compression(self):
+        """a compressed stream the server cannot decode aborts the connection
+        instead of killing its network thread"""
+        simulation = Simulation()
+        server = BTCPServerSocket(WINSIZE, TIMEOUT, network=simulation.layer)
+        client = BTCPClientSocket(WINSIZE, TIMEOUT, network=simulation.layer,
+                                  compress_level=6)
+
+        def serve():
+            server.accept()
+            data = b''
+            while True:
+                block = server.recv()
+                if len(block) == 0:
+                    return data, server.aborted
+                data += block
+
+        def damage():
+            client.connect()
+            client.compressor._frame = lambda chunk: b'\x07\x00\x00\x00\x04junk'
+            client.send(io.BytesIO(b'payload'))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            server_actor = simulation.spawn(serve)
+            simulation.spawn(damage)
+            simulation.run(10)
+        assert server_actor.result == (b'', True)
+
+    def test_simulated_perf(self):
+        """btcp_perf's bulk test over a simulated lossy link reports a
+        retransmission rate close to the loss rate"""
+        netem = ["-n", "loss 1% delay 2ms", "-s", str(SEED), "-i", "0", "-J"]
+        simulation = Simulation()
+        server_output, client_output = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulation.spawn(btcp_perf.run_server, btcp_perf.parse_args(["server", "-1"] + netem),
+                             server_output, simulation.layer)
+            simulation.spawn(btcp_perf.run_client, btcp_perf.parse_args(["client", "-g", "4M"] + netem),
+                             client_output, simulation.layer)
+            simulation.run(60)
+        total = json.loads(client_output.getvalue())["total"]
+        assert total["bytes"] == 4 << 20
+        assert total["segments"] >= (4 << 20) // 1008
+        assert total["retransmission_rate"] < 0.03
+        assert json.loads(server_output.getvalue())["total"]["bytes"] == 4 << 20
+
+    def test_simulated_pacing(self):
+        """a fixed pacing rate limits the throughput instead of stalling the
+        transfer, also with segments larger than the default bucket"""
+        for mss in (1008, 4000):
+            result = simulate_transfer(1 << 20, WINSIZE, TIMEOUT, seed=SEED, limit=60,
+                                       client_options=dict(pacing_rate=4 << 20, mss=mss))
+            assert result.verified
+            assert 0.2 < result.duration < 0.4
+
+
+class TestSendWindow(unittest.TestCase):
+    """The client's send window, see btcp/send_window.py"""
+
+    def test_wraparound(self):
+        """sequence numbers wrap from 65534 to 0 inside the window"""
+        window = SendWindow(8, base=65530)
+        seqnums = [window.append(bytes([n]), float(n)) for n in range(8)]
+        assert seqnums == [65530, 65531, 65532, 65533, 65534, 0, 1, 2]
+        assert window.end() == 3
+        assert window.get(0) == bytes([5])
+        assert window.get(3) is None and window.get(65529) is None
+        assert window.free() == 0
+        assert window.acknowledge(1) == 6
+        assert window.base == 1 and len(window) == 2
+        assert window.oldest() == bytes([6])
+        assert window.sent_at(2) == 7.0
+
+    def test_old_and_duplicate_acknowledgements(self):
+        """acknowledgements at or before the base, or past the end, remove nothing"""
+        window = SendWindow(4, base=65533)
+        for n in range(3):
+            window.append(bytes([n]), 0.0)
+        assert window.acknowledge(65533) == 0
+        assert window.acknowledge(65532) == 0
+        assert window.acknowledge(2) == 0
+        assert window.acknowledge(0) == 2
+        assert window.acknowledge(1) == 1
+        assert len(window) == 0 and window.end() == 1
+
+    def test_before(self):
+        """a recovery point stays ahead of the window until it is passed"""
+        window = SendWindow(4, base=65533)
+        for n in range(4):
+            window.append(bytes([n]), 0.0)
+        recover = window.end()
+        assert recover == 2
+        assert window.before(recover)
+        window.acknowledge(1)
+        assert window.before(recover)
+        window.acknowledge(2)
+        assert not window.before(recover)
+
+    def test_resent(self):
+        """a slot records when its segment was last sent and how often again"""
+        window = SendWindow(4, base=65534)
+        window.append(b'a', 1.0)
+        window.append(b'b', 1.0)
+        assert window.mark_resent(0, 2.0) == b'b'
+        assert window.retransmits(0) == 1 and window.sent_at(0) == 2.0
+        assert window.retransmits(65534) == 0
+
+
+class TestChunkDecompressor(unittest.TestCase):
+    """Damaged compressed streams surface as ValueError"""
+
+    def test_round_trip(self):
+        compressor = ChunkCompressor(chunk_size=1000)
+        data = bytes(range(256)) * 20 + os.urandom(3000)
+        stream = compressor.compress(data) + compressor.flush()
+        decompressor = ChunkDecompressor(chunk_size=1000)
+        out = b''.join(decompressor.decompress(stream[i:i+7]) for i in range(0, len(stream), 7))
+        assert out == data
+
+    def test_unknown_frame_type(self):
+        with self.assertRaises(ValueError):
+            ChunkDecompressor().decompress(b'\x07\x00\x00\x00\x00')
+
+    def test_damaged_zlib_body(self):
+        with self.assertRaises(ValueError):
+            ChunkDecompressor().decompress(b'\x01\x00\x00\x00\x04junk')
+
+    def test_frame_longer_than_chunk(self):
+        with self.assertRaises(ValueError):
+            ChunkDecompressor(chunk_size=1000).decompress(b'\x00\x00\x00\x10\x00')
+
+    def test_body_inflating_past_chunk(self):
+        body = zlib.compress(bytes(2000))
+        frame = b'\x01' + len(body).to_bytes(4, "big") + body
+        with self.assertRaises(ValueError):
+            ChunkDecompressor(chunk_size=1000).decompress(frame)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Send pacing, see btcp/pacing.py"""
+
+    def test_segment_larger_than_bucket(self):
+        """a segment larger than the whole bucket still goes out, and the
+        next one once the debt is paid back"""
+        bucket = TokenBucket(1000, burst_size(1000, 100))
+        bucket.refill(0.0)
+        assert bucket.allowed(5000, 10) == 1
+        bucket.consume(5000)
+        assert bucket.allowed(5000, 10) == 0
+        wait = bucket.delay(0)
+        assert 4.7 < wait < 4.9
+        bucket.refill(wait)
+        assert bucket.allowed(5000, 10) == 1
+
+    def test_delay_not_below_minimum(self):
+        """rounding that leaves the bucket a hair short never asks for a
+        timer at the same moment"""
+        bucket = TokenBucket(1e6, 3000)
+        bucket.refill(0.0)
+        bucket.consume(3000 + 1e-9)
+        assert bucket.delay(0) > 0
+        assert 0.0032576 + bucket.delay(0) > 0.0032576
+
+    def test_burst(self):
+        """a full bucket lets its burst through at once, not more"""
+        bucket = TokenBucket(1e6, 4000)
+        bucket.refill(0.0)
+        assert bucket.allowed(1000, 100) == 5
+        assert bucket.allowed(1000, 3) == 3
+
+
+class TestSPSCRing(unittest.TestCase):
+    """The application to network thread ring, see btcp/ring.py"""
+
+    def test_order_and_capacity(self):
+        """items come out in order across the end of the slots, and put
+        takes only what fits"""
+        ring = SPSCRing(3)
+        assert ring.capacity == 4
+        assert ring.put_many([1, 2, 3]) == 3
+        assert ring.get_many(2) == [1, 2]
+        assert ring.put_many([4, 5, 6, 7]) == 3
+        assert not ring.put(8)
+        assert ring.free() == 0 and len(ring) == 4
+        assert ring.get_many() == [3, 4, 5, 6]
+
+    def test_wait(self):
+        """a blocked consumer wakes up for data, and times out without"""
+        ring = SPSCRing(4)
+        assert not ring.wait_for_data(0.01)
+        producer = threading.Timer(0.05, ring.put, ('x',))
+        producer.start()
+        assert ring.wait_for_data(5)
+        producer.join()
+        assert ring.get_many() == ['x']
+
+
+class TestTimerService(unittest.TestCase):
+    """Network thread timers, see btcp/timers.py"""
+
+    def test_deadline_order(self):
+        """expired timers run in deadline order, cancelled ones never"""
+        now = [0.0]
+        timers = TimerService(clock=lambda: now[0])
+        ran = []
+        timers.schedule(2.0, ran.append, 'b')
+        timers.schedule(1.0, ran.append, 'a')
+        cancelled = timers.schedule(0.5, ran.append, 'x')
+        timers.cancel(cancelled)
+        timers.cancel(None)
+        assert timers.next_deadline() == 1.0
+        now[0] = 1.5
+        assert timers.run_expired() == 1
+        now[0] = 3.0
+        assert timers.run_expired() == 1
+        assert ran == ['a', 'b'] and timers.next_deadline() is None
+
+    def test_scheduled_while_running(self):
+        """a callback can schedule a timer that is already due"""
+        timers = TimerService(clock=lambda: 10.0)
+        ran = []
+        timers.schedule(0, lambda: timers.schedule(0, ran.append, 'again'))
+        assert timers.run_expired() == 2
+        assert ran == ['again']
+
+    def test_wakeup_for_earliest(self):
+        """on_schedule is called only when a timer becomes the earliest"""
+        woken = []
+        timers = TimerService(on_schedule=lambda: woken.append(1), clock=lambda: 0.0)
+        timers.schedule(5, print)
+        timers.schedule(7, print)
+        timers.schedule(1, print)
+        assert len(woken) == 2
+
+
+class TestDelta(unittest.TestCase):
+    """rsync-style delta transfers, see btcp/delta.py"""
+
+    def round_trip(self, old, new):
+        signature, _ = Signature.decode(Signature.of_file(io.BytesIO(old), len(old)).encode())
+        encoder = DeltaEncoder(io.BytesIO(new), signature)
+        output = io.BytesIO()
+        patcher = DeltaPatcher(io.BytesIO(old) if old else None, signature.block_size, output)
+        while True:
+            # odd pieces, so operations are split over calls to feed
+            piece = encoder.read(1001)
+            if not piece:
+                break
+            patcher.feed(piece)
+        assert patcher.complete()
+        assert output.getvalue() == new
+        return encoder
+
+    def test_unchanged(self):
+        old = os.urandom(10 * MIN_BLOCK_SIZE + 123)
+        encoder = self.round_trip(old, old)
+        assert encoder.copied_bytes == 10 * MIN_BLOCK_SIZE
+        assert encoder.literal_bytes == 123
+
+    def test_edited(self):
+        """insertions and changes cost about their own size"""
+        old = os.urandom(20 * MIN_BLOCK_SIZE)
+        new = old[:5000] + b'inserted' + old[5000:30000] + bytes(100) + old[30100:]
+        encoder = self.round_trip(old, new)
+        assert encoder.literal_bytes < 3 * MIN_BLOCK_SIZE
+
+    def test_new_and_empty(self):
+        self.round_trip(b'', os.urandom(5000))
+        self.round_trip(os.urandom(5000), b'')
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            DeltaPatcher(None, MIN_BLOCK_SIZE, io.BytesIO()).feed(b'X')
+
+
+class TestFec(unittest.TestCase):
+    """XOR parity, see btcp/fec.py"""
+
+    @staticmethod
+    def parity_fields(segment):
+        first = int.from_bytes(segment[0:2], 'big')
+        lengths = int.from_bytes(segment[2:4], 'big')
+        count = segment[5]
+        return first, count, lengths, bytes(segment[10:])
+
+    def test_rebuild_one_missing(self):
+        """the parity gives back any one payload of its group, with its
+        length, also across the wrap around of the sequence numbers"""
+        payloads = [os.urandom(n) for n in (100, 37, 100, 1, 64)]
+        first = 65532
+        encoder = FecEncoder(len(payloads))
+        parity = None
+        for i, payload in enumerate(payloads):
+            parity = encoder.add(BTCPSocket.seq_add(first, i), payload)
+        assert parity is not None
+        assert BTCPSocket.in_cksum(bytes(parity)) == 0xFFFF
+        for missing in range(len(payloads)):
+            decoder = FecDecoder()
+            for i, payload in enumerate(payloads):
+                if i != missing:
+                    assert decoder.add(BTCPSocket.seq_add(first, i), payload, first) == []
+            rebuilt = decoder.add_parity(*self.parity_fields(parity), first)
+            assert rebuilt == [(BTCPSocket.seq_add(first, missing), payloads[missing])]
+
+    def test_parity_first(self):
+        """a parity that arrives ahead of the last segment but one waits for it"""
+        payloads = [b'one', b'two', b'three']
+        encoder = FecEncoder(3)
+        for i, payload in enumerate(payloads):
+            parity = encoder.add(i, payload)
+        decoder = FecDecoder()
+        decoder.add(0, payloads[0], 0)
+        assert decoder.add_parity(*self.parity_fields(parity), 0) == []
+        assert decoder.add(2, payloads[2], 0) == [(1, b'two')]
+
+    def test_two_missing(self):
+        """XOR parity cannot repair two losses in a group"""
+        encoder = FecEncoder(3)
+        for i in range(3):
+            parity = encoder.add(i, bytes([i]) * 10)
+        decoder = FecDecoder()
+        decoder.add(0, bytes(10), 0)
+        assert decoder.add_parity(*self.parity_fields(parity), 0) == []
+
+
+class TestStreams(unittest.TestCase):
+    """Streams within a connection, see btcp/streams.py"""
+
+    def test_reassembly(self):
+        """pieces of a stream are handed on in order, whatever order they
+        arrive in, and other streams are not held up"""
+        sender = StreamSender(digest=True)
+        pieces = [sender.frame(1, b'aa'), sender.frame(2, b'xyz', end=True),
+                  sender.frame(1, b'bb'), sender.frame(1, b'cc', end=True)]
+        reassembler = StreamReassembler(digest=True)
+        assert reassembler.receive(pieces[2]) is None
+        assert reassembler.receive(pieces[1]) == (2, b'xyz', True)
+        assert reassembler.receive(pieces[3]) is None
+        assert reassembler.receive(pieces[0]) == (1, b'aabbcc', True)
+        assert reassembler.receive(b'') is None
+        assert reassembler.digest() == sender.digest()
+
+    def test_ended(self):
+        sender = StreamSender()
+        sender.frame(0, b'', end=True)
+        with self.assertRaises(ValueError):
+            sender.frame(0, b'late')
+        with self.assertRaises(ValueError):
+            sender.frame(0x8000, b'')
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Resumable transfers, see btcp/checkpoint.py"""
+
+    def test_resume(self):
+        """an interrupted transfer continues at its checkpoint, and a
+        complete one leaves none behind"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out")
+            output = CheckpointedOutput(Checkpoint(path, "transfer 1"))
+            output.write(b'durable')
+            output.sync()
+            output.write(b'lost')
+            output._file.flush()
+            output._file.close()
+
+            checkpoint = find_checkpoints(directory)["transfer 1"]
+            assert checkpoint.usable_offset() == 7
+            output = CheckpointedOutput(checkpoint, checkpoint.usable_offset())
+            output.write(b' data')
+            output.close(complete=True)
+            with open(path, 'rb') as f:
+                assert f.read() == b'durable data'
+            assert find_checkpoints(directory) == {}
+
+    def test_unreadable(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out")
+            with open(path + ".checkpoint", "w") as f:
+                f.write("garbage")
+            assert Checkpoint.load(path) is None
+
+
+class TestParallelSegmenter(unittest.TestCase):
+    """Segments prepared by worker processes, see btcp/presegment.py"""
+
+    def test_segments(self):
+        """the segments hold the file in order, with valid checksums once
+        their sequence number is filled in"""
+        data = os.urandom(3 * 1024 * 1024 + 777)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            f.seek(1000)
+            segmenter = ParallelSegmenter(f, 1000, 50, workers=2)
+            assert segmenter.size == len(data) - 1000
+            received = []
+            for seqnum, segment in enumerate(segmenter.segments()):
+                BTCPSocket.set_sequence_number(segment, seqnum)
+                assert BTCPSocket.in_cksum(bytes(segment)) == 0xFFFF
+                received.append(bytes(segment[10:]))
+            assert b''.join(received) == data[1000:]
+
+
+class TestBackends(unittest.TestCase):
+    """Datagram backends, see btcp/backends.py"""
+
+    @staticmethod
+    def receive(backend, timeout=5.0):
+        # What the network thread does, see handle_incoming_segments
+        buffer = bytearray(2048)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            ready = []
+            if backend.idle():
+                ready, _, _ = select.select(backend.filenos(), [], [], 0.05)
+            if backend.has_input(ready):
+                received = backend.receive_into(buffer, len(buffer))
+                if received is not None:
+                    return bytes(buffer[:received[0]])
+        return None
+
+    def exchange(self, name):
+        a = ("127.0.0.1", 20111)
+        b = ("127.0.0.1", 20112)
+        first = open_backend(name, a, b)
+        second = open_backend(name, b, a)
+        try:
+            assert first.send(b'hello') == 5
+            assert self.receive(second) == b'hello'
+            assert second.send(b'x' * 1000) == 1000
+            assert self.receive(first) == b'x' * 1000
+            assert first.name == (name or "udp")
+        finally:
+            first.close()
+            second.close()
+
+    def test_udp(self):
+        self.exchange(None)
+
+    def test_unix(self):
+        self.exchange("unix")
+
+    @unittest.skipUnless(hasattr(os, "eventfd"), "needs eventfd (Linux)")
+    def test_shared_memory(self):
+        self.exchange("shm")
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            open_backend("carrier pigeon", ("127.0.0.1", 20111), ("127.0.0.1", 20112))
+
+
 #    def test_command(self):
 #        #command=['dir','.']
 #        out = run_command_with_output("dir .")
@@ -229,9 +894,21 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--timeout",
                         help="Define the timeout value used (ms)",
                         type=int, default=TIMEOUT)
+    parser.add_argument("-u", "--userspace",
+                        help="Emulate the netem profiles in the apps instead of using sudo tc",
+                        action="store_true")
+    parser.add_argument("-s", "--seed",
+                        help="Seed for the userspace network emulation",
+                        type=int, default=SEED)
+    parser.add_argument("-l", "--large-size",
+                        help="Size of the generated payload of test_large_payload, e.g. 128M",
+                        default=LARGE_SIZE)
     args, extra = parser.parse_known_args()
     TIMEOUT = args.timeout
     WINSIZE = args.window
+    USERSPACE = args.userspace
+    SEED = args.seed
+    LARGE_SIZE = args.large_size
     
     # Pass the extra arguments to unittest
     sys.argv[1:] = extra